@@ -0,0 +1,272 @@
+"""
+Admission control for renders, so that concurrent requests decoding large
+originals or long animated gifs can't together exhaust a host's memory.
+
+Before decoding, a render estimates its peak memory from the image's header
+(dimensions, mode and frame count) and reserves that much of the host's
+CROPDUSTER_RENDER_MEMORY_BUDGET. Reservations are recorded in a small ledger
+file under an exclusive file lock, so the budget is shared by every process
+on the host (e.g. all gunicorn workers), and entries left by processes that
+have died are discarded.
+
+Renders that don't fit wait in a first-come, first-served queue. One that
+has waited CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER seconds degrades to
+draft mode if that needs less memory: JPEGs are then decoded at a reduced
+scale (see cropduster.backends) rather than in full. A render larger than
+the whole budget is admitted when nothing else is running, and one still
+queued after CROPDUSTER_RENDER_ADMISSION_TIMEOUT seconds raises
+CropDusterAdmissionException.
+"""
+from __future__ import division
+
+import os
+import json
+import time
+import errno
+import threading
+from contextlib import contextmanager
+
+from cropduster.exceptions import CropDusterAdmissionException
+from cropduster.utils import file_lock, is_animated_gif
+from cropduster.utils.image import get_decoded_bytes
+from cropduster import settings as cropduster_settings
+
+
+__all__ = (
+    'Reservation', 'estimate_memory', 'get_draft_scale', 'admit', 'get_stats',
+    'reset_stats')
+
+
+# A render holds the decoded original and, at most, a working copy of it
+# (the crop, before it is resized) at once
+RENDER_COPIES = 2
+
+POLL_INTERVAL = 0.1
+
+
+class Reservation(object):
+
+    def __init__(self, nbytes, degraded=False, wait_time=0):
+        # The number of bytes reserved, which is 0 if admission is disabled
+        self.nbytes = nbytes
+        # Whether the render should be done in draft mode
+        self.degraded = degraded
+        # The number of seconds spent queued
+        self.wait_time = wait_time
+
+    def __repr__(self):
+        return '<Reservation %d bytes%s, waited %.2fs>' % (
+            self.nbytes, ' (degraded)' if self.degraded else '', self.wait_time)
+
+
+def estimate_memory(im, scale=1, workers=1):
+    """
+    Estimate the peak memory, in bytes, of rendering from the PIL image
+    `im` decoded at `scale` of its size, by `workers` concurrent renders.
+    Only the image's header is read (and, for animated gifs, its frame
+    count), so this can be called before decoding.
+    """
+    (w, h) = im.size
+    size = (int(round(w * scale)), int(round(h * scale)))
+    if is_animated_gif(im):
+        # Every frame is decoded, as RGBA, and each processed frame is kept
+        frames = getattr(im, 'n_frames', 1)
+        return size[0] * size[1] * 4 * frames * RENDER_COPIES
+    return get_decoded_bytes(im, size) * (1 + workers * (RENDER_COPIES - 1))
+
+
+def get_draft_scale(im, scale):
+    """
+    The scale at which draft mode decodes `im` when an image at `scale` of
+    its size is needed: libjpeg can decode JPEGs at 1/2, 1/4 or 1/8 scale.
+    Other formats are decoded in full.
+    """
+    if im.format != 'JPEG' or is_animated_gif(im):
+        return 1
+    for reduction in (8, 4, 2):
+        if scale <= 1 / reduction:
+            return 1 / reduction
+    return 1
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.update({
+            'admitted': 0,
+            'degraded': 0,
+            'timed_out': 0,
+            'wait_time_total': 0,
+            'wait_time_max': 0,
+        })
+
+
+reset_stats()
+
+
+def _update_stats(reservation=None, timed_out=False):
+    with _stats_lock:
+        if timed_out:
+            _stats['timed_out'] += 1
+            return
+        _stats['admitted'] += 1
+        _stats['degraded'] += int(reservation.degraded)
+        _stats['wait_time_total'] += reservation.wait_time
+        _stats['wait_time_max'] = max(_stats['wait_time_max'], reservation.wait_time)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _get_ledger_paths():
+    path = cropduster_settings.CROPDUSTER_RENDER_ADMISSION_FILE
+    return (path, '%s.lock' % path)
+
+
+def _read_ledger(path):
+    """
+    The ledger is {'next': next ticket, 'entries': {ticket: entry}}, where
+    each entry is a dict of the pid, bytes and state ('queued' or 'running')
+    of a render, and when it entered that state.
+    """
+    try:
+        with open(path) as f:
+            ledger = json.load(f)
+    except (IOError, OSError, ValueError):
+        ledger = {'next': 0, 'entries': {}}
+    pids = {}
+    for ticket, entry in list(ledger['entries'].items()):
+        if entry['pid'] not in pids:
+            pids[entry['pid']] = _is_running(entry['pid'])
+        if not pids[entry['pid']]:
+            del ledger['entries'][ticket]
+    return ledger
+
+
+def _write_ledger(path, ledger):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(ledger, f)
+    os.rename(temp_path, path)
+
+
+@contextmanager
+def _ledger():
+    (path, lock_path) = _get_ledger_paths()
+    with file_lock(lock_path):
+        ledger = _read_ledger(path)
+        yield ledger
+        _write_ledger(path, ledger)
+
+
+def _try_acquire(ledger, ticket, budget):
+    entries = ledger['entries']
+    queued = [int(t) for (t, e) in entries.items() if e['state'] == 'queued']
+    if int(ticket) != min(queued):
+        return False
+    running = [e['bytes'] for e in entries.values() if e['state'] == 'running']
+    if running and sum(running) + entries[ticket]['bytes'] > budget:
+        return False
+    entries[ticket].update({'state': 'running', 'since': time.time()})
+    return True
+
+
+@contextmanager
+def admit(im, scale=1, workers=1, draft_scale=None):
+    """
+    A context manager which waits until there is room in the memory budget
+    for a render from the PIL image `im` (see estimate_memory()), and holds
+    its reservation until the block exits. It yields a Reservation.
+
+    draft_scale
+        The scale of the original that the render needs, if it can be done
+        in draft mode (decoding at a reduced scale, by one worker). The
+        reservation is degraded if that needs less memory and the render has
+        waited CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER seconds.
+    """
+    nbytes = estimate_memory(im, scale=scale, workers=workers)
+    budget = cropduster_settings.CROPDUSTER_RENDER_MEMORY_BUDGET
+    if not budget:
+        yield Reservation(0)
+        return
+
+    draft_nbytes = None
+    if draft_scale is not None:
+        draft_nbytes = estimate_memory(im, scale=get_draft_scale(im, draft_scale))
+        if draft_nbytes >= nbytes:
+            draft_nbytes = None
+    degrade_after = cropduster_settings.CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER
+    timeout = cropduster_settings.CROPDUSTER_RENDER_ADMISSION_TIMEOUT
+
+    start = time.time()
+    with _ledger() as ledger:
+        ticket = str(ledger['next'])
+        ledger['next'] += 1
+        ledger['entries'][ticket] = {
+            'pid': os.getpid(), 'bytes': nbytes, 'state': 'queued', 'since': start}
+        acquired = _try_acquire(ledger, ticket, budget)
+
+    reservation = Reservation(nbytes)
+    try:
+        while not acquired:
+            time.sleep(POLL_INTERVAL)
+            waited = time.time() - start
+            with _ledger() as ledger:
+                entry = ledger['entries'].get(ticket)
+                if entry is None:
+                    # Discarded by another process (e.g. after a pid was reused)
+                    entry = ledger['entries'][ticket] = {
+                        'pid': os.getpid(), 'bytes': reservation.nbytes, 'state': 'queued',
+                        'since': start}
+                if (draft_nbytes is not None and not reservation.degraded
+                        and degrade_after is not None and waited >= degrade_after):
+                    reservation.nbytes = entry['bytes'] = draft_nbytes
+                    reservation.degraded = True
+                acquired = _try_acquire(ledger, ticket, budget)
+                if not acquired and timeout is not None and waited >= timeout:
+                    # The entry is removed below
+                    _update_stats(timed_out=True)
+                    raise CropDusterAdmissionException(
+                        u"Timed out after %.1fs waiting for %.1f MB of render memory" % (
+                            waited, reservation.nbytes / 1e6))
+        reservation.wait_time = time.time() - start
+        _update_stats(reservation)
+        yield reservation
+    finally:
+        with _ledger() as ledger:
+            ledger['entries'].pop(ticket, None)
+
+
+def get_stats():
+    """
+    Statistics of the host's render budget (the bytes reserved by running
+    renders, and the number of renders running and queued) and of the
+    renders admitted by this process (how many, how many were degraded or
+    timed out, and their total and longest waits, in seconds).
+    """
+    budget = cropduster_settings.CROPDUSTER_RENDER_MEMORY_BUDGET
+    stats = {'budget': budget, 'in_use': 0, 'running': 0, 'queued': 0, 'queued_bytes': 0}
+    if budget:
+        (path, lock_path) = _get_ledger_paths()
+        with file_lock(lock_path, shared=True):
+            ledger = _read_ledger(path)
+        for entry in ledger['entries'].values():
+            if entry['state'] == 'running':
+                stats['running'] += 1
+                stats['in_use'] += entry['bytes']
+            else:
+                stats['queued'] += 1
+                stats['queued_bytes'] += entry['bytes']
+    with _stats_lock:
+        stats.update(_stats)
+    stats['wait_time_mean'] = (
+        stats['wait_time_total'] / stats['admitted'] if stats['admitted'] else 0)
+    return stats
@@ -0,0 +1,52 @@
+"""
+Imaging backends: the library that decodes, crops, resizes and encodes
+pixels, selected with CROPDUSTER_IMAGING_BACKEND.
+
+'pillow' (the default) works on PIL images in-process, and is what render
+plans, animated gifs and the views use. Other backends, such as 'vips'
+(which needs pyvips), render non-animated derivatives straight from the
+original file with ImagingBackend.render(); cropduster opens the result
+with Pillow afterwards only to read its size and placeholders.
+"""
+from importlib import import_module
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .base import ImagingBackend
+
+
+__all__ = ('ImagingBackend', 'BACKENDS', 'get_backend', 'get_available_backends')
+
+
+BACKENDS = {
+    'pillow': 'cropduster.backends.pillow.PillowBackend',
+    'vips': 'cropduster.backends.vips.VipsBackend',
+}
+
+_backends = {}
+
+
+def get_backend(name=None):
+    """
+    Return the backend `name` (a key of BACKENDS or the dotted path of an
+    ImagingBackend subclass), defaulting to CROPDUSTER_IMAGING_BACKEND.
+    """
+    if name is None:
+        from cropduster.settings import CROPDUSTER_IMAGING_BACKEND
+        name = CROPDUSTER_IMAGING_BACKEND or 'pillow'
+    if name not in _backends:
+        path = BACKENDS.get(name, name)
+        module_name, class_name = path.rsplit('.', 1)
+        _backends[name] = getattr(import_module(module_name), class_name)()
+    return _backends[name]
+
+
+def get_available_backends():
+    """A dict of the names and instances of the builtin backends which are installed."""
+    backends = {}
+    for name in sorted(BACKENDS):
+        try:
+            backends[name] = get_backend(name)
+        except ImproperlyConfigured:
+            pass
+    return backends
@@ -0,0 +1,124 @@
+from __future__ import division
+
+import os
+import math
+import uuid
+
+from cropduster.utils.formats import get_supported_formats
+from cropduster.utils.image import get_alternate_filename
+
+
+__all__ = ('ImagingBackend',)
+
+
+class ImagingBackend(object):
+    """
+    The operations cropduster needs from an imaging library. Images are
+    whatever the backend's library uses to represent them; only the backend
+    itself needs to know.
+
+    Subclasses implement probe(), open(), get_size(), crop(), resize(),
+    orient(), correct_colorspace(), save() and to_pil(). render(), which
+    crops and resizes an original into a derivative and its alternate
+    formats, is built on them.
+    """
+
+    name = None
+
+    # Whether the backend's images are PIL images, which can be passed to
+    # the in-process pipeline (render plans, process_image) as they are.
+    # Other backends render derivatives from the original file with render().
+    pil_images = False
+
+    def probe(self, path):
+        """
+        Return the (format, (width, height)) of the image at `path`, reading
+        as little of the file as possible.
+        """
+        raise NotImplementedError
+
+    def open(self, path, size_hint=None):
+        """
+        Open the image at `path`. If given, `size_hint` is the smallest
+        (width, height) the whole image is needed at; backends may decode
+        at a reduced size that is at least as large (shrink-on-load).
+        """
+        raise NotImplementedError
+
+    def get_size(self, im):
+        raise NotImplementedError
+
+    def crop(self, im, box):
+        """Crop `im` to the (x1, y1, x2, y2) `box`."""
+        raise NotImplementedError
+
+    def resize(self, im, size):
+        """Resize `im` to exactly (width, height) `size`."""
+        raise NotImplementedError
+
+    def orient(self, im):
+        """Rotate and/or flip `im` to respect its EXIF orientation."""
+        raise NotImplementedError
+
+    def correct_colorspace(self, im, bw=False):
+        """Convert `im` to RGB (or greyscale, if `bw`), keeping any alpha."""
+        raise NotImplementedError
+
+    def save(self, im, filename, format, size_name=None, draft=False, source=None):
+        """
+        Encode `im` to `filename` with the encoder profile for `format`,
+        `size_name` and its dimensions (see cropduster.utils.profiles).
+        `source` is the image `im` was rendered from, whose metadata (such
+        as its ICC profile) is kept unless the profile strips it.
+        """
+        raise NotImplementedError
+
+    def to_pil(self, im):
+        """Return `im` as a PIL image."""
+        raise NotImplementedError
+
+    def get_temp_filename(self, filename):
+        """
+        A temporary name next to `filename`, to write to and rename into
+        place, as cropduster.utils.save_image() does.
+        """
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, '.%s.%s' % (uuid.uuid4().hex[:8], basename))
+
+    def open_region(self, path, box, scale=1):
+        """
+        Open the original at `path` for a crop of `box` that is to be resized
+        by `scale`, decoding it only at the size the crop needs. Returns a
+        tuple (source, box), where `box` is mapped onto `source` as decoded.
+        """
+        (format, (orig_w, orig_h)) = self.probe(path)
+        (x1, y1, x2, y2) = box
+        source = self.open(path, size_hint=(
+            int(math.ceil(orig_w * scale)), int(math.ceil(orig_h * scale))))
+        (src_w, src_h) = self.get_size(source)
+        (scale_x, scale_y) = (src_w / orig_w, src_h / orig_h)
+        return (source, (
+            int(round(x1 * scale_x)), int(round(y1 * scale_y)),
+            min(src_w, int(round(x2 * scale_x))), min(src_h, int(round(y2 * scale_y)))))
+
+    def render(self, path, box, size, filename, formats=None, size_name=None, draft=False):
+        """
+        Render the `box` of the original at `path`, resized to `size`, to
+        `filename` in the original's format, and to each of `formats` next
+        to it. The original is only decoded at the size the crop needs.
+        """
+        (format, _) = self.probe(path)
+        (x1, y1, x2, y2) = box
+        (w, h) = size
+        scale = min(1, max(w / (x2 - x1), h / (y2 - y1)))
+        (source, source_box) = self.open_region(path, box, scale=scale)
+        im = self.crop(source, source_box)
+        if self.get_size(im) != (w, h):
+            im = self.resize(im, (w, h))
+
+        self.save(im, filename, format, size_name=size_name, draft=draft, source=source)
+        for alt_format in get_supported_formats(formats):
+            if alt_format == format:
+                continue
+            self.save(im, get_alternate_filename(filename, alt_format), alt_format,
+                size_name=size_name, draft=draft, source=source)
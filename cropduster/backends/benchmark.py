@@ -0,0 +1,80 @@
+"""
+Compare the speed of the installed imaging backends at rendering crops of
+an image, e.g. from ``./manage.py shell``::
+
+    >>> from cropduster.backends.benchmark import benchmark, format_results
+    >>> print(format_results(benchmark('/path/to/original.jpg')))
+"""
+from __future__ import division
+
+import os
+import time
+import shutil
+import tempfile
+
+from . import get_available_backends
+
+
+__all__ = ('benchmark', 'format_results', 'DEFAULT_RENDERS')
+
+
+# (box as fractions of the original, output size) of typical derivatives
+DEFAULT_RENDERS = (
+    ((0, 0, 1, 1), (1200, None)),
+    ((0, 0.1, 1, 0.6), (600, 300)),
+    ((0.2, 0.1, 0.8, 0.9), (300, 400)),
+    ((0.25, 0.25, 0.75, 0.75), (150, 150)),
+)
+
+
+def _get_renders(size, renders):
+    (orig_w, orig_h) = size
+    for ((fx1, fy1, fx2, fy2), (w, h)) in renders:
+        box = (int(fx1 * orig_w), int(fy1 * orig_h), int(fx2 * orig_w), int(fy2 * orig_h))
+        (box_w, box_h) = (box[2] - box[0], box[3] - box[1])
+        if h is None:
+            h = int(round(box_h * w / box_w))
+        # Never upscale
+        scale = min(1, box_w / w, box_h / h)
+        yield (box, (max(1, int(w * scale)), max(1, int(h * scale))))
+
+
+def benchmark(path, renders=DEFAULT_RENDERS, repeat=3, formats=None, backends=None):
+    """
+    Time rendering each of `renders` from the image at `path` with every
+    installed backend (or those named in `backends`).
+
+    Returns a dict of backend name to the best of `repeat` wall-clock times,
+    in seconds, to render them all.
+    """
+    available = get_available_backends()
+    if backends is not None:
+        available = dict((k, v) for (k, v) in available.items() if k in backends)
+
+    results = {}
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for (name, backend) in sorted(available.items()):
+            (format, size) = backend.probe(path)
+            jobs = list(_get_renders(size, renders))
+            ext = os.path.splitext(path)[1]
+            times = []
+            for i in range(repeat):
+                start = time.time()
+                for (n, (box, output_size)) in enumerate(jobs):
+                    output_filename = os.path.join(temp_dir, '%s-%d%s' % (name, n, ext))
+                    backend.render(path, box, output_size, output_filename, formats=formats)
+                times.append(time.time() - start)
+            results[name] = min(times)
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def format_results(results):
+    fastest = min(results.values()) if results else 0
+    lines = []
+    for (name, seconds) in sorted(results.items(), key=lambda r: r[1]):
+        lines.append('%-10s %8.1f ms  %5.2fx' % (
+            name, seconds * 1000, seconds / fastest if fastest else 1))
+    return os.linesep.join(lines)
@@ -0,0 +1,66 @@
+import PIL.Image
+
+from cropduster.utils.image import (
+    exif_orientation, correct_colorspace, smart_resize, save_image)
+from cropduster.utils.formats import convert_for_format
+from cropduster.utils.roi import decode_region
+
+from .base import ImagingBackend
+
+
+__all__ = ('PillowBackend',)
+
+
+class PillowBackend(ImagingBackend):
+    """
+    The default backend. Shrink-on-load uses Pillow's JPEG draft mode, which
+    has libjpeg decode at 1/2, 1/4 or 1/8 scale, and originals whose layout
+    allows it only have the region of the crop decoded (see
+    cropduster.utils.roi).
+    """
+
+    name = 'pillow'
+    pil_images = True
+
+    def probe(self, path):
+        # Opening only reads the header; pixels are decoded on load()
+        im = PIL.Image.open(path)
+        return (im.format, im.size)
+
+    def open(self, path, size_hint=None):
+        im = PIL.Image.open(path)
+        if size_hint:
+            im.draft(im.mode, tuple(size_hint))
+        return im
+
+    def open_region(self, path, box, scale=1):
+        region = decode_region(path, box, scale=scale)
+        if region is None:
+            return super(PillowBackend, self).open_region(path, box, scale=scale)
+        return region
+
+    def get_size(self, im):
+        return im.size
+
+    def crop(self, im, box):
+        return im.crop(tuple(box))
+
+    def resize(self, im, size):
+        (w, h) = size
+        return smart_resize(im, final_w=w, final_h=h)
+
+    def orient(self, im):
+        return exif_orientation(im)
+
+    def correct_colorspace(self, im, bw=False):
+        if not bw and im.mode == 'RGBA':
+            return im
+        return correct_colorspace(im, bw=bw)
+
+    def save(self, im, filename, format, size_name=None, draft=False, source=None):
+        info = source.info if source is not None else None
+        save_image(convert_for_format(im, format), filename, format=format,
+            size_name=size_name, info=info, draft=draft)
+
+    def to_pil(self, im):
+        return im
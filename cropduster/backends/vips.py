@@ -0,0 +1,182 @@
+from __future__ import division
+
+import six
+
+import os
+import math
+
+import PIL.Image
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # OSError: pyvips is installed, but libvips is not
+    pyvips = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from cropduster.utils.formats import normalize_format
+from cropduster.utils.profiles import get_profile
+
+from .base import ImagingBackend
+
+
+__all__ = ('VipsBackend',)
+
+
+LOADER_FORMATS = {
+    'jpegload': 'JPEG',
+    'pngload': 'PNG',
+    'gifload': 'GIF',
+    'webpload': 'WEBP',
+    'heifload': 'AVIF',
+    'tiffload': 'TIFF',
+}
+
+FORMAT_SAVERS = {
+    'JPEG': 'jpegsave',
+    'PNG': 'pngsave',
+    'GIF': 'gifsave',
+    'WEBP': 'webpsave',
+    'AVIF': 'heifsave',
+    'TIFF': 'tiffsave',
+}
+
+BAND_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+
+class VipsBackend(ImagingBackend):
+    """
+    A libvips backend, through pyvips. Images are opened for sequential
+    access, so libvips streams pixels through the crop, resize and encode
+    in strips on demand rather than holding the decoded original in memory,
+    and JPEGs are shrunk on load by libjpeg when a crop is being reduced.
+    """
+
+    name = 'vips'
+
+    def __init__(self):
+        if pyvips is None:
+            raise ImproperlyConfigured(
+                u"The vips imaging backend requires pyvips and libvips to be installed.")
+
+    def _open(self, path, **kwargs):
+        return pyvips.Image.new_from_file(path, access='sequential', **kwargs)
+
+    def _get_format(self, im):
+        loader = im.get('vips-loader') if 'vips-loader' in im.get_fields() else ''
+        return LOADER_FORMATS.get(loader.split('_')[0])
+
+    def probe(self, path):
+        # libvips only reads the header until pixels are needed
+        im = self._open(path)
+        return (self._get_format(im), (im.width, im.height))
+
+    def open(self, path, size_hint=None):
+        im = self._open(path)
+        if size_hint and self._get_format(im) == 'JPEG':
+            (hint_w, hint_h) = size_hint
+            # libjpeg rounds reduced dimensions up
+            for shrink in (8, 4, 2):
+                if (math.ceil(im.width / shrink) >= hint_w
+                        and math.ceil(im.height / shrink) >= hint_h):
+                    return self._open(path, shrink=shrink)
+        return im
+
+    def get_size(self, im):
+        return (im.width, im.height)
+
+    def crop(self, im, box):
+        (x1, y1, x2, y2) = box
+        return im.crop(x1, y1, x2 - x1, y2 - y1)
+
+    def resize(self, im, size):
+        (w, h) = size
+        if (im.width, im.height) == (w, h):
+            return im
+        band_format = im.format
+        has_alpha = im.hasalpha()
+        if has_alpha:
+            im = im.premultiply()
+        im = im.resize(w / im.width, vscale=h / im.height, kernel='lanczos3')
+        if has_alpha:
+            im = im.unpremultiply().cast(band_format)
+        # Rounding can leave the result a pixel out
+        if (im.width, im.height) != (w, h):
+            im = im.crop(0, 0, min(w, im.width), min(h, im.height))
+            im = im.embed(0, 0, w, h, extend='copy')
+        return im
+
+    def orient(self, im):
+        return im.autorot()
+
+    def correct_colorspace(self, im, bw=False):
+        if bw:
+            return im if im.interpretation == 'b-w' else im.colourspace('b-w')
+        if im.interpretation in ('srgb', 'b-w'):
+            return im
+        return im.colourspace('srgb')
+
+    def get_save_kwargs(self, format, im, size_name=None, draft=False):
+        """Translate the encoder profile into the options of the libvips saver."""
+        profile = get_profile(format, size_name=size_name, width=im.width, height=im.height,
+            draft=draft)
+        quality = profile.quality
+        if six.callable(quality):
+            quality = quality(im.width, im.height)
+
+        kwargs = {}
+        if format == 'JPEG':
+            if quality is not None:
+                kwargs['Q'] = quality
+            if profile.progressive:
+                kwargs['interlace'] = True
+            if profile.optimize:
+                kwargs['optimize_coding'] = True
+            if profile.subsampling == 0:
+                kwargs['subsample_mode'] = 'off'
+        elif format == 'PNG':
+            if profile.compress_level is not None:
+                kwargs['compression'] = profile.compress_level
+        elif format == 'WEBP':
+            if quality is not None:
+                kwargs['Q'] = quality
+            if profile.method is not None:
+                kwargs['effort'] = profile.method
+        elif format == 'AVIF':
+            kwargs['compression'] = 'av1'
+            if quality is not None:
+                kwargs['Q'] = quality
+            if profile.speed is not None:
+                # libvips effort is 0 (fast) - 9 (slow)
+                kwargs['effort'] = max(0, min(9, 9 - profile.speed))
+        if profile.strip_metadata:
+            kwargs['strip'] = True
+        return kwargs
+
+    def save(self, im, filename, format, size_name=None, draft=False, source=None):
+        # Metadata such as the ICC profile travels with the pixels in
+        # libvips, so `source` isn't needed
+        format = normalize_format(format)
+        if format == 'JPEG' and im.hasalpha():
+            im = im.flatten(background=[255] * (im.bands - 1))
+        kwargs = self.get_save_kwargs(format, im, size_name=size_name, draft=draft)
+
+        temp_filename = self.get_temp_filename(filename)
+        try:
+            saver = FORMAT_SAVERS.get(format)
+            if saver:
+                getattr(im, saver)(temp_filename, **kwargs)
+            else:
+                im.write_to_file(temp_filename, **kwargs)
+            os.rename(temp_filename, filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise
+
+    def to_pil(self, im):
+        if im.format != 'uchar':
+            im = im.cast('uchar')
+        mode = 'CMYK' if im.interpretation == 'cmyk' else BAND_MODES[im.bands]
+        return PIL.Image.frombytes(mode, (im.width, im.height), im.write_to_memory())
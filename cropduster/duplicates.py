@@ -0,0 +1,260 @@
+"""
+Near-duplicate detection for uploads, using the perceptual hashes (dHash,
+see cropduster.utils.dhash) stored on each Image.
+
+The hashes of the whole library are loaded lazily, on first use, into an
+in-memory BK-tree, which finds every hash within a Hamming distance of a
+query without comparing it to every hash in the library. The index is
+per-process: each lookup first adds the images saved since the last one
+(by any process), which includes images hashed or re-hashed since, and
+results are checked against the database, which filters out images that
+have since been deleted or re-hashed.
+
+Hashes are only stored, and uploads only checked, with
+CROPDUSTER_DUPLICATE_DETECTION, which is off by default. Images saved before
+it was enabled have no hash; the `cropduster_dhash` management command
+computes them.
+"""
+import threading
+from datetime import timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from cropduster.utils.dhash import hamming_distance
+from cropduster import settings as cropduster_settings
+
+
+__all__ = ('BKTree', 'get_index', 'reset_index', 'find_similar', 'find_duplicate_groups')
+
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree of hex hashes. Each node keeps its children keyed
+    by their distance to it; by the triangle inequality only the children
+    within `max_distance` of the query's distance to a node can contain
+    matches.
+    """
+
+    def __init__(self, items=None):
+        self.root = None
+        self.size = 0
+        for (item_hash, value) in (items or []):
+            self.add(item_hash, value)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item_hash, value):
+        # A node is [hash, int(hash), values, {distance: child}]
+        item_int = int(item_hash, 16)
+        self.size += 1
+        if self.root is None:
+            self.root = [item_hash, item_int, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(node[1] ^ item_int).count('1')
+            if distance == 0:
+                node[2].append(value)
+                return
+            child = node[3].get(distance)
+            if child is None:
+                node[3][distance] = [item_hash, item_int, [value], {}]
+                return
+            node = child
+
+    def search(self, query_hash, max_distance):
+        """Return a list of (distance, value) for every item within `max_distance`."""
+        if self.root is None:
+            return []
+        query_int = int(query_hash, 16)
+        results = []
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = bin(node[1] ^ query_int).count('1')
+            if distance <= max_distance:
+                results.extend((distance, value) for value in node[2])
+            for child_distance, child in node[3].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+        return sorted(results)
+
+
+# How far back of the latest modification time seen to look for images
+# saved since, to allow for clock skew between the processes saving them
+INDEX_OVERLAP = timedelta(seconds=60)
+
+_index = None
+# The hash under which each image id was added to _index
+_index_hashes = {}
+# The latest date_modified of the images added to _index
+_index_modified = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    The BK-tree of the dHashes of every Image, keyed to image ids. It is
+    loaded on first use, and then brought up to date with the images saved
+    since, whether they are new or have been (re-)hashed.
+    """
+    global _index, _index_modified
+    from cropduster.models import Image
+
+    with _index_lock:
+        if _index is None:
+            _index = BKTree()
+        rows = Image.objects.exclude(dhash__isnull=True).exclude(dhash='')
+        if _index_modified is not None:
+            rows = rows.filter(date_modified__gte=_index_modified - INDEX_OVERLAP)
+        for (pk, dhash, modified) in rows.values_list('pk', 'dhash', 'date_modified'):
+            if _index_hashes.get(pk) != dhash:
+                # A re-hashed image's old hash is left in the tree, and
+                # filtered out of results by find_similar()
+                _index.add(dhash, pk)
+                _index_hashes[pk] = dhash
+            if modified and (_index_modified is None or modified > _index_modified):
+                _index_modified = modified
+    return _index
+
+
+def reset_index():
+    """Discard the index, to be reloaded in full on next use."""
+    global _index, _index_modified
+    with _index_lock:
+        _index = None
+        _index_hashes.clear()
+        _index_modified = None
+
+
+def find_similar(dhash, max_distance=None, exclude=None):
+    """
+    Return a list of (distance, Image) for the images whose dHash is within
+    `max_distance` (defaulting to CROPDUSTER_DUPLICATE_MAX_DISTANCE) of
+    `dhash`, nearest first.
+    """
+    from cropduster.models import Image
+
+    if max_distance is None:
+        max_distance = cropduster_settings.CROPDUSTER_DUPLICATE_MAX_DISTANCE
+    pks = set(pk for (distance, pk) in get_index().search(dhash, max_distance)) - set([exclude])
+    matches = []
+    for image in Image.objects.filter(pk__in=list(pks)):
+        # The index may hold stale hashes of images which have been re-hashed
+        if image.dhash:
+            distance = hamming_distance(image.dhash, dhash)
+            if distance <= max_distance:
+                matches.append((distance, image))
+    return sorted(matches, key=lambda m: (m[0], m[1].pk))
+
+
+def _split_blocks(value, bits, blocks):
+    """Split the `bits`-bit int `value` into `blocks` ints of (nearly) equal width."""
+    parts = []
+    for i in range(blocks):
+        width = bits // blocks + (1 if i < bits % blocks else 0)
+        parts.append(value & ((1 << width) - 1))
+        value >>= width
+    return parts
+
+
+def _matching_pairs(hashes, bits, blocks, max_distance):
+    """
+    Yield the pairs of ids of `hashes`, a list of (id, int hash), which are
+    within `max_distance`, comparing only those which share a block.
+    """
+    buckets = {}
+    for (pk, value) in hashes:
+        for (block, part) in enumerate(_split_blocks(value, bits, blocks)):
+            buckets.setdefault((block, part), []).append((pk, value))
+
+    for bucket in buckets.values():
+        for i, (pk, value) in enumerate(bucket):
+            for (other_pk, other_value) in bucket[i + 1:]:
+                if bin(value ^ other_value).count('1') <= max_distance:
+                    yield (pk, other_pk)
+
+
+def _matching_pairs_numpy(hashes, bits, blocks, max_distance):
+    """
+    A vectorized _matching_pairs() for hashes of up to 64 bits: for each
+    block, sort the hashes by the block, and compare each hash with the
+    following ones for as long as they share it.
+    """
+    pks = numpy.array([pk for (pk, value) in hashes])
+    values = numpy.array([value for (pk, value) in hashes], dtype=numpy.uint64)
+    popcount = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+    shift = 0
+    for i in range(blocks):
+        width = bits // blocks + (1 if i < bits % blocks else 0)
+        parts = (values >> numpy.uint64(shift)) & numpy.uint64((1 << width) - 1)
+        shift += width
+
+        order = numpy.argsort(parts, kind='mergesort')
+        sorted_parts, sorted_values, sorted_pks = parts[order], values[order], pks[order]
+        offset = 1
+        while offset < len(order):
+            candidates = numpy.nonzero(sorted_parts[offset:] == sorted_parts[:-offset])[0]
+            if not len(candidates):
+                break
+            xor = numpy.bitwise_xor(sorted_values[candidates], sorted_values[candidates + offset])
+            distances = popcount[xor.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+            for j in candidates[distances <= max_distance]:
+                yield (int(sorted_pks[j]), int(sorted_pks[j + offset]))
+            offset += 1
+
+
+def find_duplicate_groups(max_distance=None):
+    """
+    Return a list of the groups (lists of image ids) of near-duplicate
+    images across the whole library, largest first. Images are grouped
+    transitively: a group holds every image within `max_distance` of
+    another image in the group.
+
+    Rather than searching for each image in turn, this uses multi-index
+    hashing: the hashes are split into max_distance + 1 blocks, and any two
+    hashes within max_distance of each other must be identical in at least
+    one block, so only hashes which share a block are compared.
+    """
+    from cropduster.models import Image
+
+    if max_distance is None:
+        max_distance = cropduster_settings.CROPDUSTER_DUPLICATE_MAX_DISTANCE
+    rows = list(Image.objects.exclude(dhash__isnull=True).exclude(dhash='')
+        .values_list('pk', 'dhash'))
+    if not rows:
+        return []
+    bits = max(len(dhash) for (pk, dhash) in rows) * 4
+    blocks = min(max_distance + 1, bits)
+    hashes = [(pk, int(dhash, 16)) for (pk, dhash) in rows]
+
+    parents = {}
+
+    def find(pk):
+        root = pk
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while pk != root:
+            parents[pk], pk = root, parents.get(pk, pk)
+        return root
+
+    if numpy is not None and bits <= 64:
+        pairs = _matching_pairs_numpy(hashes, bits, blocks, max_distance)
+    else:
+        pairs = _matching_pairs(hashes, bits, blocks, max_distance)
+    for (pk, other_pk) in pairs:
+        root, other_root = find(pk), find(other_pk)
+        if root != other_root:
+            parents[other_root] = root
+
+    groups = {}
+    for pk in list(parents):
+        root = find(pk)
+        groups.setdefault(root, set([root])).add(pk)
+    return sorted([sorted(group) for group in groups.values()],
+        key=lambda group: (-len(group), group[0]))
@@ -242,3 +242,7 @@ class CropDusterFileException(CropDusterException):
 
 class CropDusterResizeException(CropDusterException):
     pass
+
+
+class CropDusterAdmissionException(CropDusterException):
+    pass
@@ -169,3 +169,27 @@ class CropDusterInlineFormSet(BaseGenericFileInlineFormSet):
                     thumbs_field.queryset = Thumb.objects.filter(pk__in=thumb_pks)
 
         return form
+
+    def save(self, commit=True):
+        instances = super(CropDusterInlineFormSet, self).save(commit=commit)
+        if commit:
+            self.render_drafts()
+        else:
+            save_m2m = self.save_m2m
+
+            def save_m2m_and_render_drafts():
+                save_m2m()
+                self.render_drafts()
+
+            self.save_m2m = save_m2m_and_render_drafts
+        return instances
+
+    def render_drafts(self):
+        """
+        Re-encode the draft thumbs which saving the formset promoted (see
+        cropduster.models.Image.render_drafts), one image at a time.
+        """
+        for form in self.forms:
+            thumbs = (getattr(form, 'cleaned_data', None) or {}).get('thumbs')
+            if thumbs and form.instance.pk:
+                form.instance.render_drafts(thumbs)
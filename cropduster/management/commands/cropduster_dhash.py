@@ -0,0 +1,46 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cropduster.models import Image
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Compute the perceptual hash (dHash) of the images which do not have "
+        "one, e.g. those saved before CROPDUSTER_DUPLICATE_DETECTION was "
+        "enabled, so that duplicate detection can find them.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help="Re-hash every image, not only those without a hash."),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help="The number of images to load from the database at a time."),
+    )
+
+    def handle(self, *args, **options):
+        images = Image.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            images = images.filter(dhash__isnull=True)
+
+        hashed = failed = 0
+        last_pk = 0
+        while True:
+            batch = list(images.filter(pk__gt=last_pk).order_by('pk')[:options['batch_size']])
+            if not batch:
+                break
+            for image in batch:
+                last_pk = image.pk
+                image.set_dhash()
+                if not image.dhash:
+                    failed += 1
+                    continue
+                # Bumping date_modified has every process's duplicates index
+                # pick up the new hash (see cropduster.duplicates.get_index)
+                Image.objects.filter(pk=image.pk).update(
+                    dhash=image.dhash, date_modified=datetime.now())
+                hashed += 1
+
+        self.stdout.write("Hashed %d images (%d could not be read)\n" % (hashed, failed))
@@ -0,0 +1,21 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cropduster import renders
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Delete the files in CROPDUSTER_RENDER_STORE_DIR which no derivative "
+        "links to any more, e.g. after images or their thumbs were deleted.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--store-dir', dest='store_dir', default=None,
+            help="The render store to prune, if not CROPDUSTER_RENDER_STORE_DIR."),
+    )
+
+    def handle(self, *args, **options):
+        deleted = renders.prune(options.get('store_dir'))
+        self.stdout.write("Deleted %d unreferenced renders\n" % deleted)
@@ -4,28 +4,39 @@ import six
 
 from six.moves import xrange
 
+import re
+import time
 import hashlib
 import random
 import types
 import os
+import posixpath
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from django.core.files.storage import FileSystemStorage
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.db import models, connection
 
 import PIL.Image
 
 from generic_plus.utils import get_relative_media_url
 
-from .exceptions import CropDusterResizeException
+from .exceptions import CropDusterResizeException, CropDusterAdmissionException
 from .fields import (
     CropDusterField, ReverseForeignRelation, CropDusterImageField,
     CropDusterSimpleImageField)
 from .files import VirtualFieldFile
 from .resizing import Size, Box, Crop
+from .storage import StrFileSystemStorage, get_storage
+from . import storage as cropduster_storage
+from . import renders
+from . import admission
+from .backends import get_backend
+from .utils.formats import FORMAT_EXTENSIONS, get_format_extension, normalize_format
+from .utils.image import save_image, is_animated_gif
+from .utils.profiles import get_save_params
 from . import settings as cropduster_settings
 
 
@@ -62,6 +73,23 @@ class Thumb(models.Model):
 
     image = models.ForeignKey('Image', related_name='+', null=True, blank=True)
 
+    # The hash in the thumb's filename, with CROPDUSTER_HASHED_FILENAMES
+    content_hash = models.CharField(max_length=8, blank=True, null=True)
+
+    # Placeholders computed from the rendered pixels, with
+    # CROPDUSTER_PLACEHOLDERS (see cropduster.utils.placeholders)
+    blurhash = models.CharField(max_length=64, blank=True, null=True)
+    lqip = models.TextField(blank=True, null=True)
+    dominant_color = models.CharField(max_length=7, blank=True, null=True)
+
+    # The alternate formats (e.g. 'WEBP,AVIF') written alongside the thumb's
+    # file, or None for thumbs rendered before they were recorded
+    formats = models.CharField(max_length=255, blank=True, null=True)
+
+    # Set by promote_tmp_files() when the files it moved into place are
+    # draft encodes (see Image.render_drafts)
+    draft_formats = None
+
     class Meta:
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_thumb' % cropduster_settings.CROPDUSTER_DB_PREFIX
@@ -71,7 +99,10 @@ class Thumb(models.Model):
 
     @property
     def image_file(self):
-        return Image.get_file_for_size(image=self.image, size_name=self.name)
+        if not self.image:
+            return None
+        return Image.get_file_for_size(image=self.image.image, size_name=self.name,
+            content_hash=self.content_hash)
 
     @property
     def url(self):
@@ -88,15 +119,172 @@ class Thumb(models.Model):
             except Thumb.DoesNotExist:
                 pass
             else:
-                if self.image_id and not orig_thumb.image_id:                    
-                    try:
-                        os.rename(
-                            self.image.get_image_path(self.name, tmp=True),
-                            self.image.get_image_path(self.name))
-                    except (IOError, OSError):
-                        pass
+                if self.image_id and not orig_thumb.image_id:
+                    self.promote_tmp_files()
         return super(Thumb, self).save(*args, **kwargs)
 
+    def promote_tmp_files(self):
+        """
+        Move the thumb's `_tmp` files into place.
+
+        The `_tmp` files of a crop edited in the dialog are encoded with the
+        draft encoder profile. If that differs from the final profile, the
+        thumb's `draft_formats` is set to the alternate formats it was
+        rendered in, and Image.render_drafts() should be called once all of
+        the image's thumbs have been saved, to re-encode them in one pass.
+        """
+        image = self.image
+        storage = image.image.storage
+        tmp_name = image.get_image_name(self.name, tmp=True)
+        if not cropduster_storage.exists(tmp_name, storage):
+            return
+
+        # The source format maps to the `_tmp` file itself, not an alternate
+        source_format = normalize_format(image.extension)
+        formats = [f for f in FORMAT_EXTENSIONS if f != source_format and cropduster_storage.exists(
+            image.get_image_name(self.name, tmp=True, format=f), storage)]
+
+        is_draft = (not self._is_final_copy(tmp_name, storage)
+            and self._has_draft_profile(tmp_name, formats))
+
+        for format in [None] + formats:
+            try:
+                cropduster_storage.move(
+                    image.get_image_name(self.name, tmp=True, format=format),
+                    image.get_image_name(self.name, format=format), storage)
+            except (IOError, OSError):
+                pass
+
+        self.set_formats(formats)
+        if is_draft:
+            self.draft_formats = formats
+            return
+        if cropduster_settings.CROPDUSTER_PLACEHOLDERS and not self.blurhash:
+            # Drafts have no placeholders; this one is final as it is
+            self.set_placeholders(cropduster_storage.open_image(
+                image.get_image_name(self.name), storage))
+        if cropduster_settings.CROPDUSTER_HASHED_FILENAMES:
+            self.hash_files(formats=formats, image=image)
+
+    def _is_final_copy(self, tmp_name, storage):
+        """
+        Whether the `_tmp` file is a link to the final file, which the crop
+        view makes for thumbs whose crop did not change.
+        """
+        if not cropduster_storage.is_local(storage):
+            return False
+        final_path = storage.path(self.image.get_image_name(self.name))
+        try:
+            return os.path.samefile(storage.path(tmp_name), final_path)
+        except (IOError, OSError):
+            return False
+
+    def _has_draft_profile(self, tmp_name, formats):
+        """
+        Whether the draft encoder profile of any of the thumb's formats
+        differs from the final one.
+        """
+        for format in [os.path.splitext(tmp_name)[1]] + list(formats):
+            params = [get_save_params(format, size_name=self.name, width=self.width,
+                          height=self.height, draft=draft)
+                      for draft in (True, False)]
+            if params[0] != params[1]:
+                return True
+        return False
+
+    def render(self, formats=None, xmp_from=None):
+        """
+        Render the thumb's final file (and any alternate `formats`) from the
+        original image, using the thumb's crop geometry, and save the thumb.
+        If `xmp_from` is given, the XMP metadata of the file at that path is
+        copied onto it.
+        """
+        image = self.image
+        storage = image.image.storage
+        crop_box = self.get_crop_box()
+        if crop_box is None:
+            raise CropDusterResizeException("Cannot crop thumbnail without crop data")
+        # Every thumb of an image is rendered from the same original when
+        # they're promoted, so keep it decoded
+        original_image = cropduster_storage.open_image(image.image.name, storage, decoded=True)
+        scale = 1
+        if crop_box.w and crop_box.h:
+            scale = min(1, max((self.width or 0) / crop_box.w, (self.height or 0) / crop_box.h)) or 1
+        with admission.admit(original_image, draft_scale=scale) as reservation:
+            original_image.shrink_on_load = reservation.degraded
+            with cropduster_storage.local_path(image.get_image_name(self.name), storage) as path:
+                new_image = self.crop(path, original_image, w=self.width, h=self.height,
+                    formats=formats, placeholders=True)
+                if xmp_from and not new_image.reused:
+                    from cropduster.standalone.metadata import copy_xmp
+                    copy_xmp(xmp_from, path)
+                if new_image.render_key:
+                    renders.publish(new_image.render_key, path, formats)
+        cropduster_storage.cache_decoded_image(original_image)
+        self.set_formats(set(self.get_formats() or []) | set(formats or []))
+        if cropduster_settings.CROPDUSTER_HASHED_FILENAMES:
+            self.hash_files(formats=formats)
+        if self.pk:
+            self.save()
+
+    def hash_files(self, formats=None, image=None):
+        """
+        Copy the thumb's final files to names containing the hash of their
+        content (<size>.<hash>.<ext>), and delete stale hashed files.
+        """
+        image = image or self.image
+        storage = image.image.storage
+        md5 = hashlib.md5()
+        with storage.open(image.get_image_name(self.name), 'rb') as f:
+            for chunk in f.chunks():
+                md5.update(chunk)
+        content_hash = md5.hexdigest()[:8]
+
+        for format in [None] + list(formats or []):
+            src = image.get_image_name(self.name, format=format)
+            if cropduster_storage.exists(src, storage):
+                cropduster_storage.copy(src, image.get_image_name(
+                    self.name, format=format, content_hash=content_hash), storage)
+
+        self.content_hash = content_hash
+        if self.pk:
+            Thumb.objects.filter(pk=self.pk).update(content_hash=content_hash)
+        self.delete_stale_files(image=image)
+
+    def delete_stale_files(self, grace_period=None, image=None):
+        """
+        Delete the thumb's hashed files, other than the current ones, which
+        are older than `grace_period` seconds (defaulting to
+        CROPDUSTER_HASHED_FILENAMES_GRACE_PERIOD).
+        """
+        if grace_period is None:
+            grace_period = cropduster_settings.CROPDUSTER_HASHED_FILENAMES_GRACE_PERIOD
+        image = image or self.image
+        storage = image.image.storage
+        dir_name = posixpath.dirname(image.get_image_name(self.name))
+        hashed_re = re.compile(r'^%s\.([0-9a-f]{8})\.\w+$' % re.escape(self.name))
+        cutoff = time.time() - grace_period
+        for filename in cropduster_storage.listdir(dir_name, storage):
+            match = hashed_re.match(filename)
+            if not match or match.group(1) == self.content_hash:
+                continue
+            name = posixpath.join(dir_name, filename)
+            modified = cropduster_storage.get_modified_time(name, storage)
+            if time.mktime(modified.timetuple()) < cutoff:
+                cropduster_storage.delete(name, storage)
+
+    def get_formats(self):
+        """
+        The alternate formats that the thumb's file was written in, or None
+        if they are unknown.
+        """
+        if self.formats is None:
+            return None
+        return [f for f in self.formats.split(',') if f]
+
+    def set_formats(self, formats):
+        self.formats = ','.join(sorted(formats or []))
+
     def to_dict(self):
         """Returns a dict of the thumb's values which are JSON serializable."""
         dct = {}
@@ -118,7 +306,20 @@ class Thumb(models.Model):
             return None
         return Box(x1, y1, x2, y2)
 
-    def crop(self, output_filename, original_image=None, w=None, h=None, min_w=None, min_h=None, max_w=None, max_h=None):
+    def crop(self, output_filename, original_image=None, w=None, h=None, min_w=None, min_h=None, max_w=None, max_h=None,
+            formats=None, size_name=None, draft=False, reuse_renders=True, placeholders=False):
+        """
+        Render the thumb to `output_filename`, returning the new PIL image.
+        With `placeholders`, which final renders should pass, the thumb's
+        placeholders are set from it (see set_rendered).
+
+        With CROPDUSTER_RENDER_STORE_DIR and `reuse_renders`, an identical
+        render of an identical original is hard-linked into place instead of
+        rendering it again, in which case the returned image's `reused` is
+        True. Otherwise its `render_key` is the key under which the caller
+        should publish the file (see cropduster.renders) once it is complete.
+        Reused files are shared, so must not be modified in place.
+        """
         if original_image is None:
             if not self.pk:
                 raise Exception(
@@ -132,6 +333,58 @@ class Thumb(models.Model):
 
             original_image = self.image
 
+        render_crop = self._get_render_crop(original_image, w=w, h=h, min_w=min_w, min_h=min_h)
+        create_kwargs = {
+            'max_w': max_w,
+            'max_h': max_h,
+            'formats': formats,
+            'size_name': size_name or self.name,
+            'draft': draft,
+        }
+        new_image = self._create_image(render_crop, output_filename, create_kwargs, reuse_renders)
+        self.set_rendered(new_image, placeholders=placeholders)
+        return new_image
+
+    def plan_crop(self, plan, source, output_filename, w=None, h=None, min_w=None, min_h=None,
+            max_w=None, max_h=None, formats=None, size_name=None, draft=False, reuse_renders=True):
+        """
+        Add the rendering of the thumb to `output_filename` to a RenderPlan
+        (see cropduster.plan), from the plan's decode node `source`, rather
+        than rendering it now. Takes the same arguments as crop().
+
+        Returns the plan node whose result is the rendered image, which
+        should be passed to set_rendered() once the plan has been executed.
+        The node's `crop`, `reused` and `render_key` attributes are those
+        that crop() sets on the image it returns.
+        """
+        render_crop = self._get_render_crop(source.value, w=w, h=h, min_w=min_w, min_h=min_h)
+        create_kwargs = {
+            'max_w': max_w,
+            'max_h': max_h,
+            'formats': formats,
+            'size_name': size_name or self.name,
+            'draft': draft,
+        }
+        key = None
+        if reuse_renders:
+            key = renders.get_key(render_crop, self.width, self.height, create_kwargs)
+        reused_image = key and renders.reuse(key, output_filename, formats)
+        if reused_image:
+            node = plan.reuse(reused_image, label=output_filename)
+            node.reused, node.render_key = True, None
+        else:
+            size = render_crop.get_output_size(self.width, self.height, max_w=max_w, max_h=max_h)
+            node = plan.render(source, render_crop.box.as_tuple(), size, output_filename,
+                formats=formats, size_name=create_kwargs['size_name'], draft=draft)
+            node.reused, node.render_key = False, key
+        node.crop = render_crop
+        return node
+
+    def _get_render_crop(self, original_image, w=None, h=None, min_w=None, min_h=None):
+        """
+        Return the Crop to render the thumb from, setting the thumb's width
+        and height to the dimensions it should be rendered at.
+        """
         crop_box = self.get_crop_box()
         if crop_box is None:
             raise Exception("Cannot crop thumbnail without crop data")
@@ -156,39 +409,60 @@ class Thumb(models.Model):
             elif not self.height:
                 height = fit.box.h * (self.width / fit.box.w)
                 self.height = min(int(round(height)), crop.bounds.h)
-            new_image = fit.create_image(output_filename, width=self.width, height=self.height, max_w=max_w, max_h=max_h)
+            return fit
+
+        if w and h:
+            self.width = w
+            self.height = h
+        elif w:
+            height = crop_box.h * (w / crop_box.w)
+            self.height = min(int(round(height)), crop.bounds.h)
+        elif h:
+            width = crop_box.w * (h / crop_box.h)
+            self.width = min(int(round(width)), crop.bounds.w)
         else:
-            if w and h:
-                self.width = w
-                self.height = h
-            elif w:
-                height = crop_box.h * (w / crop_box.w)
-                self.height = min(int(round(height)), crop.bounds.h)
-            elif h:
-                width = crop_box.w * (h / crop_box.h)
-                self.width = min(int(round(width)), crop.bounds.w)
-            else:
-                self.width, self.height = crop.box.size
-
-            new_image = crop.create_image(output_filename, width=self.width, height=self.height, max_w=max_w, max_h=max_h)
+            self.width, self.height = crop.box.size
+        return crop
 
+    def set_rendered(self, new_image, placeholders=False):
+        """
+        Update the thumb from its newly rendered image. With `placeholders`
+        and CROPDUSTER_PLACEHOLDERS, the thumb's placeholders are computed
+        from the rendered pixels, where they are still in memory, and are
+        saved with the thumb.
+        """
         self.width, self.height = new_image.size
+        if placeholders and cropduster_settings.CROPDUSTER_PLACEHOLDERS:
+            processed = getattr(new_image, 'processed', None)
+            self.set_placeholders(new_image if processed is None else processed)
+
+    def _create_image(self, crop, output_filename, create_kwargs, reuse_renders=True):
+        key = None
+        if reuse_renders:
+            key = renders.get_key(crop, self.width, self.height, create_kwargs)
+        if key:
+            new_image = renders.reuse(key, output_filename, create_kwargs.get('formats'))
+            if new_image is not None:
+                new_image.crop = crop
+                new_image.reused, new_image.render_key = True, None
+                return new_image
+        new_image = crop.create_image(output_filename, width=self.width, height=self.height,
+            **create_kwargs)
+        new_image.reused, new_image.render_key = False, key
         return new_image
 
+    def set_placeholders(self, im):
+        """Set the thumb's placeholder fields from the rendered image `im`."""
+        from cropduster.utils.placeholders import get_placeholders
 
-class StrFileSystemStorage(FileSystemStorage):
-    """Converts paths to byte-strings.
-
-    Linux uses str/bytes for file paths, but Django tries to use unicode.
-    """
-    def path(self, name):
-        path = super(StrFileSystemStorage, self).path(name)
-        if six.PY2 and isinstance(path, unicode):
-            path = path.encode('utf-8')
-        return path
+        placeholders = get_placeholders(im,
+            lqip_size=cropduster_settings.CROPDUSTER_PLACEHOLDER_SIZE,
+            lqip_format=cropduster_settings.CROPDUSTER_PLACEHOLDER_FORMAT)
+        for k, v in six.iteritems(placeholders):
+            setattr(self, k, v)
 
 
-image_storage = StrFileSystemStorage()
+image_storage = get_storage()
 
 
 class Image(models.Model):
@@ -221,6 +495,10 @@ class Image(models.Model):
     attribution_link = models.URLField(max_length=255, blank=True, null=True)
     caption = models.TextField(blank=True, null=True)
 
+    # The perceptual hash of the image, for finding near-duplicates
+    # (see cropduster.duplicates), with CROPDUSTER_DUPLICATE_DETECTION
+    dhash = models.CharField(max_length=16, blank=True, null=True, db_index=True)
+
     class Meta:
         app_label = cropduster_settings.CROPDUSTER_APP_LABEL
         db_table = '%s_image' % cropduster_settings.CROPDUSTER_DB_PREFIX
@@ -242,28 +520,35 @@ class Image(models.Model):
         ''' returns the file extension with a dot (.) prepended to it '''
         if not self.image:
             return u''
-        return os.path.splitext(safe_str_path(self.image.path))[1]
+        return os.path.splitext(safe_str_path(self.image.name))[1]
 
     @staticmethod
-    def get_file_for_size(image, size_name='original', tmp=False):
+    def get_file_for_size(image, size_name='original', tmp=False, format=None, content_hash=None):
         if isinstance(image, six.string_types):
-            image = VirtualFieldFile(image)
+            image = VirtualFieldFile(image, storage=get_storage())
         if not image:
             return None
-        path, basename = os.path.split(safe_str_path(image.path))
+        storage = image.storage
+        if cropduster_storage.is_local(storage):
+            path, basename = os.path.split(safe_str_path(image.path))
+            path = get_relative_media_url(path)
+        else:
+            path, basename = posixpath.split(image.name)
         filename, extension = os.path.splitext(basename)
+        if format:
+            extension = get_format_extension(format)
         if size_name == 'preview':
             size_name = '_preview'
         if tmp:
             size_name = '%s_tmp' % size_name
+        elif content_hash:
+            size_name = '%s.%s' % (size_name, content_hash)
         return VirtualFieldFile(
-            '/'.join([
-                get_relative_media_url(path),
-                safe_str_path(size_name) + extension]))
+            '/'.join([path, safe_str_path(size_name) + extension]), storage=storage)
 
     @classmethod
     def save_preview_file(cls, image_file, preview_w=None, preview_h=None):
-        pil_img = PIL.Image.open(safe_str_path(image_file.path))
+        pil_img = cropduster_storage.open_image(image_file.name, image_file.storage)
         orig_w, orig_h = pil_img.size
 
         preview_w = preview_w or cropduster_settings.CROPDUSTER_PREVIEW_WIDTH
@@ -273,17 +558,16 @@ class Image(models.Model):
         if resize_ratio < 1:
             w = int(round(orig_w * resize_ratio))
             h = int(round(orig_h * resize_ratio))
+            # Let JPEGs decode at a reduced scale, when it is at least (w, h)
+            pil_img.draft(pil_img.mode, (w, h))
             preview_img = pil_img.resize((w, h), PIL.Image.ANTIALIAS)
         else:
             w, h = orig_w, orig_h
             preview_img = pil_img
         preview_file = cls.get_file_for_size(image_file, '_preview')
-        img_save_params = {}
-        if preview_img.format == 'JPEG':
-            img_save_params['quality'] = cropduster_settings.get_jpeg_quality(w, h)
-        if preview_img.format in ('JPEG', 'PNG') and cropduster_settings.JPEG_SAVE_ICC_SUPPORTED:
-            img_save_params['icc_profile'] = pil_img.info.get('icc_profile')
-        preview_img.save(safe_str_path(preview_file.path), **img_save_params)
+        with cropduster_storage.local_path(preview_file.name, preview_file.storage) as path:
+            save_image(preview_img, safe_str_path(path), format=pil_img.format,
+                size_name='_preview', info=pil_img.info, draft=True)
         return preview_file
 
     def save_preview(self, preview_w=None, preview_h=None):
@@ -301,17 +585,28 @@ class Image(models.Model):
         size_name = size_name or 'original'
         if size_name != 'original' and not self.has_thumb(size_name):
             return 0
-        return os.path.getsize(self.get_image_path(size_name))
+        return self.image.storage.size(self.get_image_name(size_name))
 
     def get_image_filename(self, size_name='original'):
         size_name = size_name or 'original'
         if size_name != 'original' and not self.has_thumb(size_name):
             return ''
-        return os.path.basename(self.get_image_path(size_name))
+        return posixpath.basename(self.get_image_name(size_name))
+
+    def get_image_name(self, size_name='original', tmp=False, format=None, content_hash=None):
+        """The name of a derivative in the image's storage."""
+        size_name = size_name or 'original'
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format,
+            content_hash=content_hash)
+        if not converted:
+            return u''
+        else:
+            return converted.name
 
-    def get_image_path(self, size_name='original', tmp=False):
+    def get_image_path(self, size_name='original', tmp=False, format=None, content_hash=None):
         size_name = size_name or 'original'
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format,
+            content_hash=content_hash)
         if not converted:
             return u''
         else:
@@ -334,6 +629,9 @@ class Image(models.Model):
                 original.object_id = None
                 original.save()
 
+        if not self.dhash and self.image and cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION:
+            self.set_dhash()
+
         super(Image, self).save(**kwargs)
 
         # If the Image has changed, we need to make sure the related field on the
@@ -344,10 +642,61 @@ class Image(models.Model):
                     field.generic_field.field_identifier == self.field_identifier):
                 model_class.objects.filter(pk=self.object_id).update(**{field.attname: self.path or ''})
 
-    def get_image_url(self, size_name='original', tmp=False):
-        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp)
+    def set_dhash(self):
+        """
+        Set the image's perceptual hash from its original. Saving the image
+        afterwards updates its date_modified, through which the duplicates
+        index of each process picks up the new hash.
+        """
+        from cropduster.utils.dhash import get_dhash
+
+        try:
+            self.dhash = get_dhash(cropduster_storage.open_image(self.image.name, self.image.storage))
+        except (IOError, OSError):
+            self.dhash = None
+
+    def get_image_url(self, size_name='original', tmp=False, format=None, content_hash=None):
+        converted = Image.get_file_for_size(self.image, size_name, tmp=tmp, format=format,
+            content_hash=content_hash)
         return getattr(converted, 'url', None) or u''
 
+    @staticmethod
+    def is_preview_name(name):
+        """
+        Whether a storage name is that of a `_preview` or `_tmp` file, which
+        may be served by cropduster.views.preview.
+        """
+        if not name or name.startswith('/') or '..' in name.split('/'):
+            return False
+        return bool(re.search(r'(?:^|/)(?:_preview|[^/]+_tmp)\.\w+$', name))
+
+    def get_preview_url(self, size_name='_preview', tmp=False, format=None):
+        """
+        The URL of cropduster.views.preview for a `_preview` or `_tmp` file,
+        which supports conditional and Range requests.
+        """
+        from django.core.urlresolvers import reverse
+
+        name = self.get_image_name(size_name, tmp=tmp, format=format)
+        return reverse('cropduster-preview', kwargs={'name': name})
+
+    def get_lazy_url(self, size_name='original', format=None, content_hash=None):
+        """
+        The URL of cropduster.views.derivative for a size, which renders the
+        derivative on first request if its file does not exist yet.
+        """
+        from django.core.urlresolvers import reverse
+
+        extension = get_format_extension(format) if format else self.extension
+        size_name = size_name or 'original'
+        if content_hash:
+            size_name = '%s.%s' % (size_name, content_hash)
+        return reverse('cropduster-derivative', kwargs={
+            'image_id': self.pk,
+            'size_name': size_name,
+            'extension': extension.lstrip('.'),
+        })
+
     def get_image_size(self, size_name=None):
         """
         Returns tuple of a thumbnail's size (width, height).
@@ -363,13 +712,13 @@ class Image(models.Model):
                 return (thumb.width, thumb.height)
 
         # Get the original size
-        if not self.image or not os.path.exists(safe_str_path(self.image.path)):
+        if not self.image or not cropduster_storage.exists(self.image.name, self.image.storage):
             return (0, 0)
         elif self.width and self.height:
             return (self.width, self.height)
         else:
             try:
-                img = PIL.Image.open(safe_str_path(self.image.path))
+                img = cropduster_storage.open_image(self.image.name, self.image.storage)
             except (IOError, ValueError, TypeError):
                 return (0, 0)
             else:
@@ -404,7 +753,7 @@ class Image(models.Model):
         if not image and not self.image:
             raise Exception("Cannot save sizes without an image")
 
-        image = image or PIL.Image.open(safe_str_path(self.image.path))
+        image = image or cropduster_storage.open_image(self.image.name, self.image.storage)
 
         if standalone:
             if not StandaloneImage:
@@ -427,13 +776,172 @@ class Image(models.Model):
                 thumbs[sz.name] = new_thumb
         return thumbs
 
-    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, standalone=False):
-        img_save_params = {}
-        if image.format == 'JPEG':
-            img_save_params['quality'] = cropduster_settings.get_jpeg_quality(self.width, self.height)
-        if image.format in ('JPEG', 'PNG') and cropduster_settings.JPEG_SAVE_ICC_SUPPORTED:
-            img_save_params['icc_profile'] = image.info.get('icc_profile')
+    def save_sizes(self, sizes, image=None, tmp=False, standalone=False, permissive=False, threads=None):
+        """
+        Render several sizes from a single decode of the original image.
+
+        sizes
+            A list of (size, thumb) tuples, as would be passed to save_size()
+        threads
+            The number of threads across which the sizes are rendered.
+            Defaults to CROPDUSTER_RENDER_THREADS.
+
+        Returns a list of the return values of save_size(), in the same
+        order as `sizes`.
+        """
+        if not image and not self.image:
+            raise Exception("Cannot save sizes without an image")
+
+        image = image or cropduster_storage.open_image(self.image.name, self.image.storage)
+
+        if threads is None:
+            threads = cropduster_settings.CROPDUSTER_RENDER_THREADS
+        threads = min(threads or 1, len(sizes))
+
+        with admission.admit(image, workers=threads,
+                draft_scale=self._get_render_scale(sizes)) as reservation:
+            if reservation.degraded:
+                # Render the sizes one at a time, each decoding only as much
+                # of the original as it needs
+                image.shrink_on_load = True
+                return [self.save_size(size, thumb, image=image, tmp=tmp,
+                            standalone=standalone, permissive=permissive)
+                        for (size, thumb) in sizes]
+            return self._save_sizes(sizes, image, tmp=tmp, standalone=standalone,
+                permissive=permissive, threads=threads)
+
+    def render_drafts(self, thumbs, image=None):
+        """
+        Re-encode with the final encoder profile those of `thumbs` whose
+        promoted files are draft encodes (see Thumb.promote_tmp_files). All
+        of them are rendered by a single save_sizes() call, from one decode
+        of the original. If they cannot be rendered the drafts are kept.
+        """
+        thumbs = [t for t in thumbs if t.draft_formats is not None]
+        if not thumbs:
+            return
+
+        sizes = []
+        for thumb in thumbs:
+            size = Size(thumb.name, w=thumb.width, h=thumb.height, formats=thumb.draft_formats)
+            if thumb.reference_thumb_id:
+                # Rendered from the crop of its reference thumb
+                size.parent = Size(thumb.reference_thumb.name)
+                sizes.append((size, thumb.reference_thumb))
+            else:
+                sizes.append((size, thumb))
 
+        try:
+            self.save_sizes(sizes, image=image)
+        except (IOError, OSError, CropDusterResizeException, CropDusterAdmissionException):
+            if cropduster_settings.CROPDUSTER_HASHED_FILENAMES:
+                for thumb in thumbs:
+                    thumb.hash_files(formats=thumb.draft_formats, image=self)
+        for thumb in thumbs:
+            thumb.draft_formats = None
+
+    def _save_sizes(self, sizes, image, tmp=False, standalone=False, permissive=False, threads=1):
+        if (not standalone and not is_animated_gif(image) and get_backend().pil_images
+                and cropduster_storage.is_local(self.image.storage)):
+            return self.plan_sizes(sizes, image, tmp=tmp, permissive=permissive,
+                threads=threads).execute()
+
+        if not is_animated_gif(image):
+            # Decode once, up front, rather than in whichever thread gets
+            # to it first
+            image.load()
+
+        def render(size_thumb):
+            size, thumb = size_thumb
+            return self.save_size(size, thumb, image=image, tmp=tmp,
+                standalone=standalone, permissive=permissive)
+
+        if threads <= 1:
+            return [render(s) for s in sizes]
+
+        def render_in_thread(size_thumb):
+            try:
+                return render(size_thumb)
+            finally:
+                # Each thread gets its own database connection
+                connection.close()
+
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(render_in_thread, sizes)
+        finally:
+            pool.close()
+
+    def _get_render_scale(self, sizes):
+        """
+        The largest scale, relative to the original, at which any of `sizes`
+        (a list of (size, thumb) tuples) is rendered from its thumb's crop.
+        """
+        scale = 0
+        for (size, thumb) in sizes:
+            if not thumb or not thumb.crop_w or not thumb.crop_h:
+                return 1
+            for sz in Size.flatten([size]):
+                w = sz.w or thumb.width
+                h = sz.h or thumb.height
+                if not w and not h:
+                    return 1
+                scale = max(scale, (w or 0) / thumb.crop_w, (h or 0) / thumb.crop_h)
+        return min(scale, 1) or 1
+
+    def plan_sizes(self, sizes, image=None, tmp=False, permissive=False, threads=None):
+        """
+        Compile the rendering of several sizes into a single RenderPlan (see
+        cropduster.plan), in which the steps shared between sizes are only
+        done once. Takes the same arguments as save_sizes(), which uses this
+        for images in local storages.
+
+        Returns a SizesPlan, whose `plan` can be inspected (e.g. with
+        plan.explain()) before calling its execute() method, which renders
+        and saves the thumbs and returns what save_sizes() would.
+        """
+        from cropduster.plan import RenderPlan
+
+        image = image or cropduster_storage.open_image(self.image.name, self.image.storage)
+        plan = RenderPlan()
+        source = plan.decode(image, label=self.image.name)
+        storage = self.image.storage
+
+        # For each entry of `sizes`, the (size, thumb, crop kwargs, path,
+        # plan node) of each size it renders
+        jobs = []
+        for (size, thumb) in sizes:
+            size_jobs = []
+            for sz in Size.flatten([size]):
+                if sz.is_auto:
+                    prepared = self._prepare_thumb(sz, ref_thumb=thumb, tmp=tmp)
+                else:
+                    prepared = self._prepare_thumb(sz, thumb, tmp=tmp)
+                if not prepared:
+                    if not sz.is_auto:
+                        thumb = None
+                    continue
+                (new_thumb, crop_kwargs, thumb_name) = prepared
+                thumb_path = storage.path(thumb_name)
+                try:
+                    node = new_thumb.plan_crop(plan, source, thumb_path, **crop_kwargs)
+                except CropDusterResizeException:
+                    if permissive or not sz.required:
+                        continue
+                    raise
+                if not sz.is_auto:
+                    thumb = new_thumb
+                size_jobs.append((sz, new_thumb, crop_kwargs, thumb_path, node))
+            jobs.append(size_jobs)
+
+        return SizesPlan(self, plan, jobs, tmp=tmp, threads=threads)
+
+    def _prepare_thumb(self, size, thumb=None, ref_thumb=None, tmp=False, standalone=False):
+        """
+        Find or create the thumb for `size`, returning a tuple of the thumb,
+        the kwargs with which to render it (see Thumb.crop) and the storage
+        name to render it to, or None if the thumb has no crop geometry.
+        """
         if not thumb:
             if standalone:
                 thumb = Thumb(
@@ -468,30 +976,107 @@ class Image(models.Model):
 
         crop_kwargs = dict([(k, getattr(size, k))
                             for k in ['w', 'h', 'min_w', 'min_h', 'max_w', 'max_h']])
+        crop_kwargs['size_name'] = size.name
+        # tmp thumbs are re-encoded with the final profile when promoted
+        crop_kwargs['draft'] = tmp and not standalone
         if standalone and not(size.w or size.h) and (thumb.crop_w and thumb.crop_h):
             crop_kwargs['w'] = thumb.crop_w
             crop_kwargs['h'] = thumb.crop_h
+        if not standalone:
+            crop_kwargs['formats'] = size.output_formats
 
         if standalone:
-            thumb_path = self.get_image_path(thumb.name)
+            thumb_name = self.get_image_name(thumb.name)
         else:
-            thumb_path = self.get_image_path(size.name, tmp=tmp)
+            thumb_name = self.get_image_name(size.name, tmp=tmp)
 
-        thumb_image = thumb.crop(thumb_path, image, **crop_kwargs)
+        # Standalone crops are renamed and have metadata written to them
+        crop_kwargs['reuse_renders'] = not standalone
+        return (thumb, crop_kwargs, thumb_name)
 
-        if StandaloneImage:
+    def _finish_thumb_file(self, size, thumb_image, thumb_path, crop_kwargs):
+        """Post-process a thumb's newly rendered (or reused) file."""
+        if StandaloneImage and not thumb_image.reused:
             thumb_image.crop.add_xmp_to_crop(thumb_path, size)
 
+        if thumb_image.render_key:
+            renders.publish(thumb_image.render_key, thumb_path, crop_kwargs.get('formats'))
+
+    def _save_thumb(self, size, image=None, thumb=None, ref_thumb=None, tmp=False, standalone=False):
+        prepared = self._prepare_thumb(size, thumb, ref_thumb, tmp=tmp, standalone=standalone)
+        if not prepared:
+            return None
+        (thumb, crop_kwargs, thumb_name) = prepared
+
+        storage = self.image.storage
+        with cropduster_storage.local_path(thumb_name, storage) as thumb_path:
+            thumb_image = thumb.crop(thumb_path, image,
+                placeholders=not (tmp or standalone), **crop_kwargs)
+            self._finish_thumb_file(size, thumb_image, thumb_path, crop_kwargs)
+
+            if standalone:
+                md5 = hashlib.md5()
+                with open(thumb_path, mode='rb') as f:
+                    md5.update(f.read())
+
         if standalone:
-            md5 = hashlib.md5()
-            with open(thumb_path, mode='rb') as f:
-                md5.update(f.read())
             thumb.name = md5.hexdigest()[0:9]
-            os.rename(thumb_path, self.get_image_path(thumb.name))
+            cropduster_storage.move(thumb_name, self.get_image_name(thumb.name), storage)
         else:
-            thumb.save()
+            self._save_rendered_thumb(thumb, crop_kwargs, tmp=tmp)
         return thumb
 
+    def _save_rendered_thumb(self, thumb, crop_kwargs, tmp=False):
+        if thumb.reference_thumb is not None and not thumb.reference_thumb_id:
+            # The reference thumb was unsaved when it was assigned, and has
+            # been saved since (see SizesPlan.execute)
+            thumb.reference_thumb = thumb.reference_thumb
+        thumb.set_formats(crop_kwargs.get('formats'))
+        if not tmp and cropduster_settings.CROPDUSTER_HASHED_FILENAMES:
+            thumb.hash_files(formats=crop_kwargs.get('formats'), image=self)
+        thumb.save()
+
+
+class SizesPlan(object):
+    """The RenderPlan of Image.plan_sizes(), and the thumbs it renders."""
+
+    def __init__(self, image, plan, jobs, tmp=False, threads=None):
+        self.image = image
+        self.plan = plan
+        self.jobs = jobs
+        self.tmp = tmp
+        self.threads = threads
+
+    def execute(self, executor=None):
+        """
+        Render the plan, then post-process and save each thumb. Returns a
+        list with a dict of size name to thumb for each entry of the sizes
+        that were planned.
+        """
+        nodes = [job[-1] for size_jobs in self.jobs for job in size_jobs]
+        pool = None
+        if executor is None and self.threads and self.threads > 1:
+            executor = pool = ThreadPool(self.threads)
+        try:
+            values = self.plan.execute(executor=executor, keep=nodes)
+        finally:
+            if pool:
+                pool.close()
+
+        results = []
+        for size_jobs in self.jobs:
+            thumbs = {}
+            for (size, thumb, crop_kwargs, thumb_path, node) in size_jobs:
+                thumb_image = values[node.index]
+                thumb_image.crop = node.crop
+                thumb_image.reused, thumb_image.render_key = node.reused, node.render_key
+                thumb.set_rendered(thumb_image, placeholders=not self.tmp)
+                self.image._finish_thumb_file(size, thumb_image, thumb_path, crop_kwargs)
+                self.image._save_rendered_thumb(thumb, crop_kwargs, tmp=self.tmp)
+                thumbs[size.name] = thumb
+            results.append(thumbs)
+        return results
+
 
 try:
     from cropduster.standalone.models import StandaloneImage
@@ -0,0 +1,231 @@
+"""
+Render plans: the steps that render a set of derivatives from one original,
+as an explicit graph of decode, crop, resize and encode nodes.
+
+Adding a step which is identical to one already in the plan (the same
+operation with the same parameters on the same input) returns the existing
+node, so work shared between sizes, such as decoding the original or
+cropping and resizing to the same box and dimensions, is done once::
+
+    plan = RenderPlan()
+    source = plan.decode(original)
+    plan.render(source, box, (300, 150), '/path/to/wide.jpg')
+    plan.render(source, box, (300, 150), '/path/to/wide.jpg')  # deduplicated
+    print(plan.explain())
+    results = plan.execute(executor=ThreadPool(4))
+
+Nodes are executed in dependency order, one level of independent nodes at a
+time, with `executor.map()`: the builtin map() by default, or anything with
+the same interface, such as a multiprocessing.pool.ThreadPool (Pillow
+releases the GIL while resizing and encoding). The result of a node is
+released as soon as every node which uses it has run, unless it was asked
+to be kept.
+"""
+from __future__ import division
+
+import os
+
+from cropduster.utils.image import (
+    crop_image, smart_resize, save_image, save_alternate_formats, is_animated_gif)
+
+
+__all__ = ('PlanNode', 'RenderPlan', 'OPERATIONS')
+
+
+def _decode(im):
+    if not is_animated_gif(im):
+        im.load()
+    return im
+
+
+def _crop(im, box):
+    return crop_image(im, box)
+
+
+def _resize(im, size):
+    (w, h) = size
+    return smart_resize(im, final_w=w, final_h=h)
+
+
+def _encode(im, source, filename, formats=(), size_name=None, draft=False):
+    save_image(im, filename, format=source.format, size_name=size_name, info=source.info,
+        draft=draft)
+    save_alternate_formats(source, im, filename, formats, size_name=size_name, draft=draft)
+    return im
+
+
+# The functions that execute each type of node. Each is called with the
+# results of the node's inputs followed by the node's params.
+OPERATIONS = {
+    'decode': _decode,
+    'crop': _crop,
+    'resize': _resize,
+    'encode': _encode,
+}
+
+
+class PlanNode(object):
+
+    def __init__(self, index, op, inputs, params, size, value=None, label=None):
+        self.index = index
+        self.op = op
+        self.inputs = tuple(inputs)
+        self.params = params
+        # The (width, height) of the node's result
+        self.size = size
+        # For source nodes, the value the node returns
+        self.value = value
+        self.label = label
+        self.uses = 0
+
+    @property
+    def depth(self):
+        return 1 + max([n.depth for n in self.inputs] or [-1])
+
+    @property
+    def cost(self):
+        """A rough cost of the node, in pixels read and written."""
+        (w, h) = self.size
+        pixels = w * h
+        if self.op == 'decode':
+            return pixels
+        elif self.op == 'crop':
+            return pixels
+        elif self.op == 'resize':
+            (in_w, in_h) = self.inputs[0].size
+            return in_w * in_h + pixels
+        elif self.op == 'encode':
+            return pixels * (1 + len(self.params.get('formats') or ()))
+        return 0
+
+    def run(self, input_values):
+        if self.op == 'decode':
+            return OPERATIONS['decode'](self.value)
+        elif self.op == 'reuse':
+            return self.value
+        return OPERATIONS[self.op](*input_values, **self.params)
+
+    def describe(self):
+        params = self.label
+        if params is None:
+            params = ', '.join('%s=%r' % (k, v) for (k, v) in sorted(self.params.items()) if v)
+        inputs = ' '.join('#%d' % n.index for n in self.inputs)
+        return '#%-3d %-7s %-8s %s' % (self.index, self.op, inputs, params)
+
+    def __repr__(self):
+        return '<PlanNode %s>' % self.describe()
+
+
+class RenderPlan(object):
+
+    def __init__(self):
+        self.nodes = []
+        self._nodes_by_key = {}
+        # The number of nodes requested, including those deduplicated
+        self.requested = 0
+
+    def add(self, op, inputs, size, params=None, value=None, label=None):
+        """
+        Add a node to the plan, returning the identical node already in the
+        plan if there is one. `size` is the (width, height) of its result.
+        """
+        params = params or {}
+        self.requested += 1
+        if op in ('decode', 'reuse'):
+            key = (op, id(value))
+        else:
+            key = (op, tuple(n.index for n in inputs), tuple(sorted(params.items())))
+        node = self._nodes_by_key.get(key)
+        if node is None:
+            node = PlanNode(len(self.nodes), op, inputs, params, size, value=value, label=label)
+            for input_node in node.inputs:
+                input_node.uses += 1
+            self.nodes.append(node)
+            self._nodes_by_key[key] = node
+        return node
+
+    def decode(self, im, label=None):
+        """A source node which decodes (loads) the PIL image `im`."""
+        return self.add('decode', [], im.size, value=im,
+            label=label or getattr(im, 'filename', None) or repr(im))
+
+    def reuse(self, im, label=None):
+        """A source node for an image which has already been rendered."""
+        return self.add('reuse', [], im.size, value=im,
+            label=label or getattr(im, 'filename', None) or repr(im))
+
+    def crop(self, node, box):
+        box = tuple(box)
+        (x1, y1, x2, y2) = box
+        return self.add('crop', [node], (int(round(x2 - x1)), int(round(y2 - y1))), {'box': box})
+
+    def resize(self, node, size):
+        size = tuple(size)
+        (in_w, in_h) = node.size
+        (w, h) = size
+        if in_w <= w and in_h <= h:
+            # smart_resize() leaves images which are small enough as they are
+            size = node.size
+        return self.add('resize', [node], size, {'size': size})
+
+    def encode(self, node, source, filename, formats=None, size_name=None, draft=False):
+        return self.add('encode', [node, source], node.size, {
+            'filename': filename,
+            'formats': tuple(formats or ()),
+            'size_name': size_name,
+            'draft': bool(draft),
+        })
+
+    def render(self, source, box, size, filename, **encode_kwargs):
+        """Add the nodes which crop `source` to `box`, resize, and encode it."""
+        resized = self.resize(self.crop(source, box), size)
+        return self.encode(resized, source, filename, **encode_kwargs)
+
+    def get_levels(self):
+        """The nodes grouped by depth; the nodes in each level are independent."""
+        levels = {}
+        for node in self.nodes:
+            levels.setdefault(node.depth, []).append(node)
+        return [levels[depth] for depth in sorted(levels)]
+
+    def execute(self, executor=None, keep=None):
+        """
+        Run the plan, returning a dict of node index to result for the nodes
+        in `keep` (all nodes if None).
+        """
+        keep = set(n.index for n in (self.nodes if keep is None else keep))
+        remaining_uses = dict((n.index, n.uses) for n in self.nodes)
+        values = {}
+
+        def run(node):
+            return node.run([values[n.index] for n in node.inputs])
+
+        for level in self.get_levels():
+            if executor is None:
+                results = [run(node) for node in level]
+            else:
+                results = executor.map(run, level)
+            for node, result in zip(level, results):
+                values[node.index] = result
+            for node in level:
+                for input_node in node.inputs:
+                    remaining_uses[input_node.index] -= 1
+                    if not remaining_uses[input_node.index] and input_node.index not in keep:
+                        del values[input_node.index]
+        return dict((k, v) for (k, v) in values.items() if k in keep)
+
+    @property
+    def cost(self):
+        return sum(node.cost for node in self.nodes)
+
+    def explain(self):
+        """A description of the plan and of its cost, for debugging."""
+        lines = []
+        for node in self.nodes:
+            line = '%s  (%.2f Mpx)' % (node.describe(), node.cost / 1e6)
+            if node.uses > 1:
+                line += ' shared by %d' % node.uses
+            lines.append(line)
+        lines.append('%d nodes (%d requested), %.2f Mpx' % (
+            len(self.nodes), self.requested, self.cost / 1e6))
+        return os.linesep.join(lines)
@@ -0,0 +1,160 @@
+"""
+A content-addressed store of rendered derivatives, so that images with
+byte-identical originals (standalone re-use, repeated URL imports, copied
+articles) share their derivatives rather than each rendering and storing
+their own.
+
+Every rendered derivative is hard-linked into CROPDUSTER_RENDER_STORE_DIR
+under a key made of everything that determines its content: the md5 of the
+original, the crop box, the output size, the alternate formats and the
+encoder settings. Before rendering, a derivative whose key is already in
+the store is hard-linked into place instead.
+
+The store holds no references of its own: a file's link count is the number
+of derivatives sharing it, plus one for the store. Files which no
+derivative links to any more (st_nlink == 1) are removed by prune(), which
+the cropduster_prune_renders management command runs.
+
+Only local storages are supported, and MEDIA_ROOT and the store must be on
+the same filesystem for files to be shared. As with clone_file(), shared
+files must only ever be replaced, never written to in place.
+"""
+import os
+import errno
+import hashlib
+import threading
+
+import PIL.Image
+
+from cropduster.utils import clone_file
+from cropduster.utils.image import get_alternate_filename
+from cropduster.utils.formats import normalize_format
+from cropduster import settings as cropduster_settings
+
+
+__all__ = ('get_key', 'get_store_path', 'reuse', 'publish', 'prune')
+
+
+# Bump to invalidate every stored render, e.g. when resizing changes
+RENDER_STORE_VERSION = 1
+
+_original_hashes = {}
+_original_hashes_lock = threading.Lock()
+
+
+def get_original_hash(path):
+    """The md5 of the file at `path`, memoized by its size and mtime."""
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime)
+    with _original_hashes_lock:
+        if memo_key in _original_hashes:
+            return _original_hashes[memo_key]
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    with _original_hashes_lock:
+        if len(_original_hashes) > 10000:
+            _original_hashes.clear()
+        _original_hashes[memo_key] = md5.hexdigest()
+    return _original_hashes[memo_key]
+
+
+def get_key(crop, width, height, create_kwargs):
+    """
+    The key of the derivative rendered by crop.create_image(width=width,
+    height=height, **create_kwargs), or None if the render store is disabled
+    or the original is not a local file.
+    """
+    if not cropduster_settings.CROPDUSTER_RENDER_STORE_DIR:
+        return None
+    filename = getattr(crop.image, 'filename', None)
+    if not filename or not os.path.exists(filename):
+        return None
+    value = '|'.join(str(v) for v in [
+        RENDER_STORE_VERSION,
+        get_original_hash(filename),
+        crop.box.as_tuple(),
+        (width, height),
+        (create_kwargs.get('max_w'), create_kwargs.get('max_h')),
+        sorted(set(normalize_format(f) for f in create_kwargs.get('formats') or [])
+            - set([normalize_format(crop.image.format)])),
+        create_kwargs.get('size_name'),
+        bool(create_kwargs.get('draft')),
+        cropduster_settings.CROPDUSTER_ENCODER_PROFILES,
+    ])
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def get_store_path(key, extension):
+    return os.path.join(cropduster_settings.CROPDUSTER_RENDER_STORE_DIR,
+        key[:2], '%s%s' % (key, extension))
+
+
+def _get_filenames(output_filename, formats=None):
+    """The paths of a derivative and of its alternate formats."""
+    filenames = [output_filename]
+    filenames += [get_alternate_filename(output_filename, f) for f in (formats or [])]
+    return filenames
+
+
+def reuse(key, output_filename, formats=None):
+    """
+    If the derivative `key` (and its alternate `formats`) is in the store,
+    link it to `output_filename` (and its siblings) and return it opened
+    with PIL. Otherwise return None.
+    """
+    filenames = _get_filenames(output_filename, formats)
+    store_paths = [get_store_path(key, os.path.splitext(f)[1]) for f in filenames]
+    if not all(os.path.exists(p) for p in store_paths):
+        return None
+    try:
+        for (store_path, filename) in zip(store_paths, filenames):
+            clone_file(store_path, filename)
+    except (IOError, OSError) as e:
+        # Pruned since it was checked
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return PIL.Image.open(output_filename)
+
+
+def publish(key, output_filename, formats=None):
+    """Add the rendered derivative at `output_filename` to the store as `key`."""
+    for filename in _get_filenames(output_filename, formats):
+        if not os.path.exists(filename):
+            continue
+        store_path = get_store_path(key, os.path.splitext(filename)[1])
+        store_dir = os.path.dirname(store_path)
+        try:
+            if not os.path.isdir(store_dir):
+                os.makedirs(store_dir)
+            os.link(filename, store_path)
+        except OSError as e:
+            # EEXIST: published concurrently by another process, which is
+            # fine as they have the same content. EXDEV: the store is on
+            # another filesystem, so there's nothing to share.
+            if e.errno not in (errno.EEXIST, errno.EXDEV):
+                raise
+
+
+def prune(store_dir=None):
+    """
+    Delete the files in the store which are no longer linked to by any
+    derivative. Returns the number of files deleted.
+    """
+    store_dir = store_dir or cropduster_settings.CROPDUSTER_RENDER_STORE_DIR
+    deleted = 0
+    if not store_dir or not os.path.isdir(store_dir):
+        return deleted
+    for dirpath, dirnames, filenames in os.walk(store_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+                    deleted += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    return deleted
@@ -29,7 +29,7 @@ class Size(object):
     parent = None
 
     def __init__(self, name, label=None, w=None, h=None, retina=False, auto=None, min_w=None, min_h=None,
-            max_w=None, max_h=None, required=True):
+            max_w=None, max_h=None, required=True, formats=None):
 
         self.min_w = max(w or 1, min_w or 1) or 1
         self.min_h = max(h or 1, min_h or 1) or 1
@@ -54,6 +54,7 @@ class Size(object):
         self.height = h
         self.label = label or u' '.join(filter(None, re.split(r'[_\-]', name))).title()
         self.required = required
+        self.formats = formats
 
     def __unicode__(self):
         name = u'Size %s (%s):' % (self.label, self.name)
@@ -96,6 +97,23 @@ class Size(object):
             return None
         return self.width / self.height
 
+    @property
+    def output_formats(self):
+        """
+        The alternate formats (in addition to the source image's format) that
+        should be written for this size, limited to those supported by the
+        installed version of Pillow.
+        """
+        from cropduster.settings import CROPDUSTER_OUTPUT_FORMATS
+        from cropduster.utils.formats import get_supported_formats
+
+        formats = self.formats
+        if formats is None:
+            formats = self.parent.formats if self.parent else None
+        if formats is None:
+            formats = CROPDUSTER_OUTPUT_FORMATS
+        return get_supported_formats(formats)
+
     def fit_image(self, original_image):
         orig_w, orig_h = original_image.size
         crop = Crop(Box(0, 0, orig_w, orig_h), original_image)
@@ -132,6 +150,8 @@ class Size(object):
             'required': self.required,
             '__type__': 'Size',
         }
+        if self.formats is not None:
+            data['formats'] = self.formats
         if self.auto:
             data['auto'] = [sz.__serialize__() for sz in self.auto]
 
@@ -191,9 +211,70 @@ class Crop(object):
         self.image = image
         self.bounds = Box(0, 0, *image.size)
 
-    def create_image(self, output_filename, width=None, height=None, max_w=None, max_h=None):
+    def create_image(self, output_filename, width=None, height=None, max_w=None, max_h=None, formats=None,
+            size_name=None, draft=False):
+        from cropduster.utils import process_image, get_image_extension, is_animated_gif
+        from cropduster.backends import get_backend
+
+        (width, height) = self.get_output_size(width, height, max_w=max_w, max_h=max_h)
+
+        backend = get_backend()
+        filename = getattr(self.image, 'filename', None)
+        # Originals marked `shrink_on_load` (renders degraded to draft mode by
+        # cropduster.admission) are decoded by the backend at reduced scale
+        shrink_on_load = getattr(self.image, 'shrink_on_load', False)
+        if ((shrink_on_load or not backend.pil_images) and not is_animated_gif(self.image)
+                and filename and os.path.exists(filename)):
+            backend.render(filename, self.box.as_tuple(), (width, height), output_filename,
+                formats=formats, size_name=size_name, draft=draft)
+            new_image = PIL.Image.open(output_filename)
+            new_image.crop = self
+            return new_image
+
+        if is_animated_gif(self.image):
+            # Frames are read from the file, so work from a private copy
+            temp_file = tempfile.NamedTemporaryFile(suffix=get_image_extension(self.image), delete=False)
+            temp_filename = temp_file.name
+            with open(self.image.filename, mode='rb') as f:
+                temp_file.write(f.read())
+            temp_file.seek(0)
+            image = PIL.Image.open(temp_filename)
+        else:
+            # Cropping leaves the source untouched, so the pixels of an image
+            # that is already decoded can be shared by every crop made from it
+            temp_file = None
+            image = self.image
+
+        crop_args = self.box.as_tuple()
+
+        from cropduster.utils.roi import decode_region, is_decoded
+        if not temp_file and not is_decoded(image) and filename and os.path.exists(filename):
+            # The original hasn't been decoded yet, so decode only the part of
+            # it that the crop needs, where its format allows
+            scale = min(1, max(width / self.box.w, height / self.box.h))
+            region = decode_region(filename, crop_args, scale=scale)
+            if region is not None:
+                (image, crop_args) = region
+
+        def crop_and_resize_callback(im):
+            from cropduster.utils.image import crop_image, smart_resize
+            im = crop_image(im, crop_args)
+            return smart_resize(im, final_w=width, final_h=height)
+
+        new_image = process_image(image, output_filename, crop_and_resize_callback,
+            formats=formats, size_name=size_name, draft=draft)
+        new_image.crop = self
+        if temp_file:
+            temp_file.close()
+            os.unlink(temp_filename)
+        return new_image
+
+    def get_output_size(self, width=None, height=None, max_w=None, max_h=None):
+        """
+        The (width, height) that create_image() resizes the crop to. Raises
+        CropDusterResizeException if the crop box is too small.
+        """
         from cropduster.exceptions import CropDusterResizeException
-        from cropduster.utils import process_image, get_image_extension
 
         new_w, new_h = self.box.size
         if new_w < width or new_h < height:
@@ -210,26 +291,7 @@ class Crop(object):
             max_scale = min(max_scales)
             width = int(round(width * max_scale))
             height = int(round(height * max_scale))
-
-        temp_file = tempfile.NamedTemporaryFile(suffix=get_image_extension(self.image), delete=False)
-        temp_filename = temp_file.name
-        with open(self.image.filename, mode='rb') as f:
-            temp_file.write(f.read())
-        temp_file.seek(0)
-        image = PIL.Image.open(temp_filename)
-
-        crop_args = self.box.as_tuple()
-
-        def crop_and_resize_callback(im):
-            from cropduster.utils import smart_resize
-            im = im.crop(crop_args)
-            return smart_resize(im, final_w=width, final_h=height)
-
-        new_image = process_image(image, output_filename, crop_and_resize_callback)
-        new_image.crop = self
-        temp_file.close()
-        os.unlink(temp_filename)
-        return new_image
+        return (width, height)
 
     def best_fit(self, w=None, h=None, min_w=None, min_h=None, max_w=None, max_h=None):
         if w and h:
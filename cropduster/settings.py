@@ -1,4 +1,6 @@
+import os
 import math
+import tempfile
 import PIL
 from distutils.version import LooseVersion
 from django.conf import settings
@@ -16,9 +18,166 @@ try:
 except AttributeError:
     CROPDUSTER_DB_PREFIX = getattr(settings, 'CROPDUSTER_DB_PREFIX', 'cropduster4')
 
+# The dotted path of the Storage class holding cropduster images and their
+# derivatives. Defaults to the local filesystem under MEDIA_ROOT.
+CROPDUSTER_STORAGE = getattr(settings, 'CROPDUSTER_STORAGE', None)
+
+# When CROPDUSTER_STORAGE is not local, originals fetched from it are kept in
+# an LRU cache in this directory, shared between processes, and evicted once
+# it grows beyond CROPDUSTER_ORIGINALS_CACHE_MAX_BYTES. None disables it.
+CROPDUSTER_ORIGINALS_CACHE_DIR = getattr(settings, 'CROPDUSTER_ORIGINALS_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'cropduster-originals'))
+CROPDUSTER_ORIGINALS_CACHE_MAX_BYTES = getattr(settings, 'CROPDUSTER_ORIGINALS_CACHE_MAX_BYTES',
+    1024 * 1024 * 1024)
+
+# The bytes of decoded originals each process keeps in memory, so that the
+# repeated crops of an image in an editing session don't decode it again.
+# Originals are evicted least recently used first. None disables it.
+CROPDUSTER_DECODED_CACHE_MAX_BYTES = getattr(settings, 'CROPDUSTER_DECODED_CACHE_MAX_BYTES', None)
+
+# A directory in which originals of at least CROPDUSTER_RAW_CACHE_MIN_PIXELS
+# are kept decoded, as raw pixels which every process maps into memory
+# rather than decoding the original again (see RawPixelCache). Entries
+# unused for MAX_AGE seconds, and the least recently used entries beyond
+# MAX_BYTES, are evicted. None disables it.
+CROPDUSTER_RAW_CACHE_DIR = getattr(settings, 'CROPDUSTER_RAW_CACHE_DIR', None)
+CROPDUSTER_RAW_CACHE_MAX_BYTES = getattr(settings, 'CROPDUSTER_RAW_CACHE_MAX_BYTES',
+    10 * 1024 * 1024 * 1024)
+CROPDUSTER_RAW_CACHE_MAX_AGE = getattr(settings, 'CROPDUSTER_RAW_CACHE_MAX_AGE', 7 * 24 * 60 * 60)
+CROPDUSTER_RAW_CACHE_MIN_PIXELS = getattr(settings, 'CROPDUSTER_RAW_CACHE_MIN_PIXELS',
+    10 * 1000 * 1000)
+
+# When True, {% get_crop %} links to cropduster.views.derivative, which
+# renders a thumb's file on first request if it does not exist yet.
+CROPDUSTER_LAZY_DERIVATIVES = getattr(settings, 'CROPDUSTER_LAZY_DERIVATIVES', False)
+
+# Directory holding the lock files which ensure that concurrent requests for
+# a missing derivative render it only once.
+CROPDUSTER_LOCK_DIR = getattr(settings, 'CROPDUSTER_LOCK_DIR',
+    os.path.join(tempfile.gettempdir(), 'cropduster-locks'))
+
+# Hand derivatives served by cropduster.views.derivative off to the web server:
+# 'X-Sendfile' (Apache, lighttpd) sends the absolute path of the file;
+# 'X-Accel-Redirect' (nginx) sends CROPDUSTER_SENDFILE_PREFIX followed by the
+# file's storage name, which should map to an internal location.
+CROPDUSTER_SENDFILE_HEADER = getattr(settings, 'CROPDUSTER_SENDFILE_HEADER', None)
+CROPDUSTER_SENDFILE_PREFIX = getattr(settings, 'CROPDUSTER_SENDFILE_PREFIX', settings.MEDIA_URL)
+
+# The widths at which cropduster.transforms renders crops; requested widths
+# are rounded up to the nearest of these. Renders are kept in an LRU cache in
+# CROPDUSTER_TRANSFORM_CACHE_DIR, bounded by CROPDUSTER_TRANSFORM_CACHE_MAX_BYTES.
+CROPDUSTER_TRANSFORM_WIDTHS = getattr(settings, 'CROPDUSTER_TRANSFORM_WIDTHS',
+    (160, 320, 480, 640, 800, 960, 1280, 1600, 1920))
+CROPDUSTER_TRANSFORM_CACHE_DIR = getattr(settings, 'CROPDUSTER_TRANSFORM_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'cropduster-transforms'))
+CROPDUSTER_TRANSFORM_CACHE_MAX_BYTES = getattr(settings, 'CROPDUSTER_TRANSFORM_CACHE_MAX_BYTES',
+    1024 * 1024 * 1024)
+
+# When True, final derivatives are also written as <size>.<hash>.<ext>, where
+# <hash> is the first 8 hex digits of the md5 of the file, and their urls use
+# that name. The urls of these files change whenever their content does, so
+# they can be served with far-future, immutable Cache-Control headers.
+# Superseded hashed files are deleted once older than the grace period (in
+# seconds), to allow for pages and CDNs still referencing them.
+CROPDUSTER_HASHED_FILENAMES = getattr(settings, 'CROPDUSTER_HASHED_FILENAMES', False)
+CROPDUSTER_HASHED_FILENAMES_GRACE_PERIOD = getattr(settings,
+    'CROPDUSTER_HASHED_FILENAMES_GRACE_PERIOD', 7 * 24 * 60 * 60)
+
+# The deep zoom tile pyramids that the crop dialog uses to zoom into originals
+# larger than the preview (see cropduster.tiles): square tiles of TILE_SIZE
+# pixels, overlapping by TILE_OVERLAP pixels, kept in an LRU cache in
+# CROPDUSTER_TILE_CACHE_DIR bounded by CROPDUSTER_TILE_CACHE_MAX_BYTES.
+CROPDUSTER_TILE_SIZE = getattr(settings, 'CROPDUSTER_TILE_SIZE', 256)
+CROPDUSTER_TILE_OVERLAP = getattr(settings, 'CROPDUSTER_TILE_OVERLAP', 1)
+CROPDUSTER_TILE_CACHE_DIR = getattr(settings, 'CROPDUSTER_TILE_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'cropduster-tiles'))
+CROPDUSTER_TILE_CACHE_MAX_BYTES = getattr(settings, 'CROPDUSTER_TILE_CACHE_MAX_BYTES',
+    1024 * 1024 * 1024)
+
 CROPDUSTER_PREVIEW_WIDTH = getattr(settings, 'CROPDUSTER_PREVIEW_WIDTH', 800)
 CROPDUSTER_PREVIEW_HEIGHT = getattr(settings, 'CROPDUSTER_PREVIEW_HEIGHT', 500)
 
+# Uploads larger than these budgets are rejected from their header, before
+# anything is written to disk. None disables the check, which is the default
+# for CROPDUSTER_MAX_PIXELS (Pillow's own PIL.Image.MAX_IMAGE_PIXELS guard
+# against decompression bombs still applies).
+CROPDUSTER_MAX_PIXELS = getattr(settings, 'CROPDUSTER_MAX_PIXELS', None)
+CROPDUSTER_MAX_FRAMES = getattr(settings, 'CROPDUSTER_MAX_FRAMES', 500)
+
+# Normalize originals once, when they are uploaded, so that no render has to
+# rotate or convert them (see cropduster.utils.normalize): apply the rotation
+# or flip of their EXIF orientation tag, and convert CMYK and other unusual
+# modes to RGB. Normalized JPEGs are re-encoded at NORMALIZE_JPEG_QUALITY.
+CROPDUSTER_NORMALIZE_ORIENTATION = getattr(settings, 'CROPDUSTER_NORMALIZE_ORIENTATION', False)
+CROPDUSTER_NORMALIZE_COLORSPACE = getattr(settings, 'CROPDUSTER_NORMALIZE_COLORSPACE', False)
+CROPDUSTER_NORMALIZE_JPEG_QUALITY = getattr(settings, 'CROPDUSTER_NORMALIZE_JPEG_QUALITY', 95)
+
+# How get_upload_foldername() makes upload directories unique: 'sequential'
+# (name, name-1, name-2, ...), 'random' (name-<random hex>) or 'hash'
+# (name-<md5 of the upload>). With sharding, directories are nested under two
+# levels of fan-out (ab/cd/name-abcd...) taken from the suffix.
+CROPDUSTER_UPLOAD_FOLDER_STRATEGY = getattr(settings, 'CROPDUSTER_UPLOAD_FOLDER_STRATEGY', 'sequential')
+CROPDUSTER_UPLOAD_FOLDER_SHARDING = getattr(settings, 'CROPDUSTER_UPLOAD_FOLDER_SHARDING', False)
+
+# The ways, in order of preference, that cropduster.utils.clone_file() tries
+# to copy files before falling back to a byte copy: 'link' (a hard link) and
+# 'reflink' (a copy-on-write clone, on filesystems such as btrfs and XFS)
+CROPDUSTER_CLONE_METHODS = getattr(settings, 'CROPDUSTER_CLONE_METHODS', ('link', 'reflink'))
+
+# A directory, on the same filesystem as MEDIA_ROOT, in which rendered
+# derivatives are stored by content so that images with identical originals
+# share them through hard links rather than rendering them again (see
+# cropduster.renders). Disabled if None. Files stay in the store after the
+# derivatives linking to them are deleted; run `manage.py
+# cropduster_prune_renders` periodically (e.g. from cron) to delete them.
+CROPDUSTER_RENDER_STORE_DIR = getattr(settings, 'CROPDUSTER_RENDER_STORE_DIR', None)
+
+# The number of threads used to render the sizes changed in a single request
+# to the crop view. Pillow releases the GIL while resizing and encoding.
+CROPDUSTER_RENDER_THREADS = getattr(settings, 'CROPDUSTER_RENDER_THREADS', 1)
+
+# The library that renders derivatives: 'pillow', 'vips' (which requires
+# pyvips, and streams crops from the original with shrink-on-load) or the
+# dotted path of a cropduster.backends.ImagingBackend subclass. Animated
+# gifs are always rendered with Pillow.
+CROPDUSTER_IMAGING_BACKEND = getattr(settings, 'CROPDUSTER_IMAGING_BACKEND', 'pillow')
+
+# The memory, in bytes, that renders on a host may use at once, estimated
+# from image headers before decoding (see cropduster.admission). Renders
+# which don't fit are queued, and those that can be degraded to draft mode
+# (decoding JPEGs at a reduced scale) are after waiting DEGRADE_AFTER
+# seconds. A render still queued after TIMEOUT seconds fails. The budget is
+# shared by every process on the host through the ADMISSION_FILE ledger.
+# Disabled if None.
+CROPDUSTER_RENDER_MEMORY_BUDGET = getattr(settings, 'CROPDUSTER_RENDER_MEMORY_BUDGET', None)
+CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER = getattr(settings,
+    'CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER', 5)
+CROPDUSTER_RENDER_ADMISSION_TIMEOUT = getattr(settings, 'CROPDUSTER_RENDER_ADMISSION_TIMEOUT', 120)
+CROPDUSTER_RENDER_ADMISSION_FILE = getattr(settings, 'CROPDUSTER_RENDER_ADMISSION_FILE',
+    os.path.join(tempfile.gettempdir(), 'cropduster-render-admission.json'))
+
+# Alternate formats (e.g. ['WEBP', 'AVIF']) written alongside every derivative
+# in the source format, for sizes that do not specify their own `formats`.
+CROPDUSTER_OUTPUT_FORMATS = getattr(settings, 'CROPDUSTER_OUTPUT_FORMATS', [])
+
+# Whether to compute low-quality placeholders (a BlurHash, a tiny data URI of
+# CROPDUSTER_PLACEHOLDER_SIZE pixels across, and the dominant colour) from each
+# final rendered crop. They are stored on the Thumb and returned by get_crop.
+# Off by default: computing them costs every render a little CPU, and get_crop
+# has to load the image's thumbs to return them.
+CROPDUSTER_PLACEHOLDERS = getattr(settings, 'CROPDUSTER_PLACEHOLDERS', False)
+CROPDUSTER_PLACEHOLDER_SIZE = getattr(settings, 'CROPDUSTER_PLACEHOLDER_SIZE', 20)
+CROPDUSTER_PLACEHOLDER_FORMAT = getattr(settings, 'CROPDUSTER_PLACEHOLDER_FORMAT', 'JPEG')
+
+# Whether to store a perceptual hash (dHash) of every image, and offer images
+# within CROPDUSTER_DUPLICATE_MAX_DISTANCE bits of an upload's hash for reuse
+# (see cropduster.duplicates). Off by default: hashing decodes the original
+# when an image is first saved, and each process keeps an index of every
+# hash in memory. Run `manage.py cropduster_dhash` after enabling it to hash
+# the existing images.
+CROPDUSTER_DUPLICATE_DETECTION = getattr(settings, 'CROPDUSTER_DUPLICATE_DETECTION', False)
+CROPDUSTER_DUPLICATE_MAX_DISTANCE = getattr(settings, 'CROPDUSTER_DUPLICATE_MAX_DISTANCE', 4)
+
 
 def get_jpeg_quality(width, height):
     p = math.sqrt(width * height)
@@ -31,5 +190,11 @@ def get_jpeg_quality(width, height):
 
 get_jpeg_quality = getattr(settings, 'get_jpeg_quality', get_jpeg_quality)
 
+# A list of dicts, each with the EncoderProfile kwargs (quality, progressive,
+# optimize, subsampling, compress_level, method, speed, strip_metadata) and
+# optional conditions (format, size_name, min_pixels, max_pixels, draft) under
+# which it applies. See cropduster.utils.profiles.
+CROPDUSTER_ENCODER_PROFILES = getattr(settings, 'CROPDUSTER_ENCODER_PROFILES', [])
+
 JPEG_SAVE_ICC_SUPPORTED = (LooseVersion(getattr(PIL, 'PILLOW_VERSION', '0'))
     >= LooseVersion('2.2.1'))
@@ -150,6 +150,30 @@ def file_format_supported(file_path):
     return bool(format_options & FormatOptions.XMP_FMT_CAN_INJECT_XMP)
 
 
+def copy_xmp(src_path, dst_path):
+    """
+    Copy the XMP metadata of one image file onto another. Returns True if
+    metadata was copied.
+    """
+    if not libxmp:
+        return False
+    src_file = libxmp.XMPFiles(file_path=src_path)
+    try:
+        xmp_meta = src_file.get_xmp()
+    finally:
+        src_file.close_file()
+    if not xmp_meta:
+        return False
+    dst_file = libxmp.XMPFiles(file_path=dst_path, open_forupdate=True)
+    try:
+        if not dst_file.can_put_xmp(xmp_meta):
+            return False
+        dst_file.put_xmp(xmp_meta)
+    finally:
+        dst_file.close_file()
+    return True
+
+
 class MetadataDict(dict):
     """
     Normalizes the key/values returned from libxmp.file_to_dict()
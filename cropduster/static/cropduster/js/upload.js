@@ -220,7 +220,9 @@
                 $('#cropbox').css({width: '', height: ''});
                 // 0x0 gif
                 $('#cropbox').attr('src', 'data:image/gif;base64,R0lGODlhAQABAAAAACH5BAEKAAEALAAAAAABAAEAAAICTAEAOw==');
-                $('#cropbox').attr('src', data.url);
+                // Served by the preview view, which answers conditional and
+                // range requests, where available
+                $('#cropbox').attr('src', data.preview_url || data.url);
                 this._waitForImageLoad();
             } else if (this.jcrop && sizeData) {
                 this.setCropOptions(sizeData);
@@ -522,6 +524,7 @@
             }
             data = $.extend({}, data, getFormData());
             delete data['url'];
+            delete data['preview_url'];
             cropBox.onSuccess(data, cropBox.index + move);
         });
 
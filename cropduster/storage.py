@@ -0,0 +1,309 @@
+"""
+Access to original images and their derivatives through the Django
+``Storage`` API, so that cropduster can be used with storages that do not
+live on the local filesystem (e.g. object storage).
+
+Rendering always happens against local files: originals held by a remote
+storage are spooled to a temporary file to be decoded, and derivatives are
+rendered into a temporary directory (see `local_path`) and then streamed to
+the storage.
+"""
+import six
+
+import os
+import errno
+import shutil
+import tempfile
+import posixpath
+from importlib import import_module
+from contextlib import contextmanager
+
+import PIL.Image
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from cropduster.utils.cache import DiskCache, DecodedImageCache, RawPixelCache
+from cropduster.utils.image import is_animated_gif
+from cropduster.utils.roi import is_decoded
+
+
+__all__ = (
+    'StrFileSystemStorage', 'get_storage', 'is_local', 'get_originals_cache',
+    'get_decoded_cache', 'get_raw_cache', 'open_image', 'cache_decoded_image', 'exists',
+    'save_file', 'copy', 'move', 'delete', 'listdir', 'get_modified_time', 'local_path')
+
+
+class StrFileSystemStorage(FileSystemStorage):
+    """Converts paths to byte-strings.
+
+    Linux uses str/bytes for file paths, but Django tries to use unicode.
+    """
+    def path(self, name):
+        path = super(StrFileSystemStorage, self).path(name)
+        if six.PY2 and isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return path
+
+
+_storage = None
+
+
+def get_storage():
+    """
+    Return the storage used for cropduster images, as configured by
+    CROPDUSTER_STORAGE (the dotted path of a Storage class), defaulting to
+    the local filesystem under MEDIA_ROOT.
+    """
+    global _storage
+    if _storage is None:
+        from cropduster.settings import CROPDUSTER_STORAGE
+        if CROPDUSTER_STORAGE:
+            module_name, class_name = CROPDUSTER_STORAGE.rsplit('.', 1)
+            _storage = getattr(import_module(module_name), class_name)()
+        else:
+            _storage = StrFileSystemStorage()
+    return _storage
+
+
+def is_local(storage=None):
+    """Whether files in `storage` can be accessed with a local path."""
+    storage = storage or get_storage()
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+_originals_cache = None
+
+
+def get_originals_cache():
+    """The DiskCache of originals fetched from remote storages, if enabled."""
+    global _originals_cache
+    if _originals_cache is None:
+        from cropduster.settings import (
+            CROPDUSTER_ORIGINALS_CACHE_DIR, CROPDUSTER_ORIGINALS_CACHE_MAX_BYTES)
+        if not CROPDUSTER_ORIGINALS_CACHE_DIR:
+            return None
+        _originals_cache = DiskCache(
+            CROPDUSTER_ORIGINALS_CACHE_DIR, CROPDUSTER_ORIGINALS_CACHE_MAX_BYTES)
+    return _originals_cache
+
+
+_decoded_cache = None
+_raw_cache = None
+
+
+def get_decoded_cache():
+    """The per-process DecodedImageCache of originals, if enabled."""
+    global _decoded_cache
+    if _decoded_cache is None:
+        from cropduster.settings import CROPDUSTER_DECODED_CACHE_MAX_BYTES
+        if not CROPDUSTER_DECODED_CACHE_MAX_BYTES:
+            return None
+        _decoded_cache = DecodedImageCache(CROPDUSTER_DECODED_CACHE_MAX_BYTES)
+    return _decoded_cache
+
+
+def get_raw_cache():
+    """The RawPixelCache of large decoded originals, if enabled."""
+    global _raw_cache
+    if _raw_cache is None:
+        from cropduster.settings import (
+            CROPDUSTER_RAW_CACHE_DIR, CROPDUSTER_RAW_CACHE_MAX_BYTES,
+            CROPDUSTER_RAW_CACHE_MAX_AGE)
+        if not CROPDUSTER_RAW_CACHE_DIR:
+            return None
+        _raw_cache = RawPixelCache(CROPDUSTER_RAW_CACHE_DIR, CROPDUSTER_RAW_CACHE_MAX_BYTES,
+            max_age=CROPDUSTER_RAW_CACHE_MAX_AGE)
+    return _raw_cache
+
+
+def open_image(name, storage=None, content_hash=None, decoded=False):
+    """
+    Open an image in `storage` with PIL.
+
+    Images in remote storages are read through the originals cache, keyed by
+    `content_hash` if given, or otherwise by name (the names of originals
+    are unique to each upload, so are never reused for different content).
+
+    decoded
+        Look the image up in the caches of decoded originals first: the
+        per-process cache (see get_decoded_cache), then the raw pixel cache
+        shared by every process (see get_raw_cache). A cached image is
+        returned already decoded, and read-only. Otherwise the image is
+        opened as usual, and should be passed to cache_decoded_image() once
+        it has been decoded.
+    """
+    storage = storage or get_storage()
+    # The caches define __len__, so are compared to None: an empty cache is
+    # falsy, but still has to be keyed and filled
+    decoded_cache = get_decoded_cache() if decoded else None
+    raw_cache = get_raw_cache() if decoded else None
+    if decoded_cache is not None or raw_cache is not None:
+        path = None
+        if is_local(storage):
+            path = storage.path(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return PIL.Image.open(path)
+            key = (path, stat.st_mtime, stat.st_size)
+        else:
+            key = (name, content_hash)
+        image = decoded_cache.get(key) if decoded_cache is not None else None
+        if image is None and raw_cache is not None:
+            image = raw_cache.get_image(raw_cache.get_key(repr(key)))
+            if image is not None and path:
+                image.filename = path
+        if image is not None:
+            return image
+        image = open_image(name, storage, content_hash=content_hash)
+        image._cropduster_decoded_key = (key, image.size)
+        return image
+
+    if is_local(storage):
+        return PIL.Image.open(storage.path(name))
+
+    def fetch(f):
+        with storage.open(name, 'rb') as storage_file:
+            for chunk in storage_file.chunks():
+                f.write(chunk)
+
+    cache = get_originals_cache()
+    if cache:
+        return PIL.Image.open(cache.get_or_fill(cache.get_key(content_hash or name), fetch))
+
+    # Spool the file to disk rather than memory; some code paths (e.g.
+    # animated gifs) need to re-read the image by filename.
+    extension = os.path.splitext(name)[1]
+    temp_file = tempfile.NamedTemporaryFile(suffix=extension)
+    fetch(temp_file)
+    temp_file.flush()
+    image = PIL.Image.open(temp_file.name)
+    # Keep the temporary file around for as long as the image is
+    image._cropduster_temp_file = temp_file
+    return image
+
+
+def cache_decoded_image(image):
+    """
+    Add an image opened with open_image(decoded=True), which has since been
+    decoded in full, to the cache of decoded originals.
+    """
+    (key, size) = getattr(image, '_cropduster_decoded_key', (None, None))
+    if key is None:
+        return
+    # Skip images which were not decoded, or were decoded in draft mode
+    if not is_decoded(image) or image.size != size or is_animated_gif(image):
+        return
+
+    decoded_cache = get_decoded_cache()
+    if decoded_cache is not None:
+        decoded_cache.put(key, image)
+
+    from cropduster.settings import CROPDUSTER_RAW_CACHE_MIN_PIXELS
+    raw_cache = get_raw_cache()
+    if (raw_cache is not None and RawPixelCache.is_supported(image)
+            and size[0] * size[1] >= (CROPDUSTER_RAW_CACHE_MIN_PIXELS or 0)):
+        raw_key = raw_cache.get_key(repr(key))
+        if not raw_cache.get(raw_key):
+            raw_cache.put_image(raw_key, image)
+
+
+def exists(name, storage=None):
+    storage = storage or get_storage()
+    return bool(name) and storage.exists(name)
+
+
+def delete(name, storage=None):
+    storage = storage or get_storage()
+    if exists(name, storage):
+        storage.delete(name)
+
+
+def listdir(path, storage=None):
+    """The names of the files in directory `path`, or [] if it is missing."""
+    storage = storage or get_storage()
+    try:
+        return storage.listdir(path)[1]
+    except (IOError, OSError):
+        return []
+
+
+def get_modified_time(name, storage=None):
+    storage = storage or get_storage()
+    if hasattr(storage, 'get_modified_time'):
+        # Django >= 1.10
+        return storage.get_modified_time(name)
+    return storage.modified_time(name)
+
+
+def save_file(name, content, storage=None):
+    """
+    Save a file object to `name`, replacing any existing file, and streaming
+    its contents in chunks.
+    """
+    storage = storage or get_storage()
+    if not isinstance(content, File):
+        content = File(content, name=name)
+    delete(name, storage)
+    saved_name = storage.save(name, content)
+    if saved_name != name:
+        raise IOError(errno.EEXIST, "Could not save %s (saved as %s)" % (name, saved_name))
+    return saved_name
+
+
+def copy(src, dst, storage=None):
+    """Copy `src` to `dst`, cloning the file on local storages."""
+    from cropduster.utils import clone_file
+
+    storage = storage or get_storage()
+    if is_local(storage):
+        return clone_file(storage.path(src), storage.path(dst))
+    with storage.open(src, 'rb') as f:
+        save_file(dst, f, storage)
+    return 'copy'
+
+
+def move(src, dst, storage=None):
+    storage = storage or get_storage()
+    if is_local(storage):
+        src_path, dst_path = storage.path(src), storage.path(dst)
+        if os.path.exists(dst_path) and os.path.samefile(src_path, dst_path):
+            # os.rename() is a no-op for two links to the same file
+            os.unlink(src_path)
+        else:
+            os.rename(src_path, dst_path)
+        return
+    with storage.open(src, 'rb') as f:
+        save_file(dst, f, storage)
+    storage.delete(src)
+
+
+@contextmanager
+def local_path(name, storage=None):
+    """
+    A context manager yielding a local path to which the file `name` can be
+    written. For local storages this is the path of the file itself. For
+    remote storages it is a path in a temporary directory; when the block
+    exits, every file written to that directory (i.e. the file and any
+    siblings, such as alternate formats) is saved to the storage alongside
+    `name`.
+    """
+    storage = storage or get_storage()
+    if is_local(storage):
+        yield storage.path(name)
+        return
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        yield os.path.join(temp_dir, posixpath.basename(name))
+        dir_name = posixpath.dirname(name)
+        for filename in sorted(os.listdir(temp_dir)):
+            with open(os.path.join(temp_dir, filename), 'rb') as f:
+                save_file(posixpath.join(dir_name, filename), f, storage)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
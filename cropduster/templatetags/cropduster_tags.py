@@ -7,13 +7,17 @@ import six
 from django import template
 from cropduster.models import Image
 from cropduster.resizing import Size
+from cropduster.settings import (
+    CROPDUSTER_LAZY_DERIVATIVES, CROPDUSTER_HASHED_FILENAMES, CROPDUSTER_PLACEHOLDERS)
+from cropduster.transforms import get_transform_url
+from cropduster.utils.formats import FORMAT_PREFERENCE, get_format_mimetype, select_format
 
 
 register = template.Library()
 
 
 @register.assignment_tag
-def get_crop(image, crop_name, exact_size=False, **kwargs):
+def get_crop(image, crop_name, exact_size=False, accept=None, **kwargs):
     """
     Get the crop of an image. Usage:
 
@@ -34,6 +38,39 @@ def get_crop(image, crop_name, exact_size=False, **kwargs):
 
         <img src="{{ img.url }}">
 
+    If the size is configured with alternate output `formats`, the dictionary
+    also has a "sources" list of {"type", "url"} dicts, in order of preference,
+    suitable for the <source> elements of a <picture> tag. Formats which the
+    crop's thumb was not rendered in point to the lazy derivative view (see
+    CROPDUSTER_LAZY_DERIVATIVES), which renders them on first request.
+
+    Passing the request's Accept header as the `accept` kwarg will instead
+    set "url" to the best format that the client accepts, e.g.:
+
+    {% get_crop article.image 'lead' accept=request.META.HTTP_ACCEPT as img %}
+
+    Views rendering templates that use `accept` should vary on the
+    Accept header.
+
+    With CROPDUSTER_LAZY_DERIVATIVES, the urls point to a view which renders
+    the crop on first request if its file does not exist yet.
+
+    With CROPDUSTER_HASHED_FILENAMES, the urls contain a hash of the file's
+    content instead of a cache-busting query string.
+
+    With CROPDUSTER_PLACEHOLDERS (off by default), the dictionary also has
+    "blurhash", "lqip" (a data URI of a tiny version of the crop) and
+    "dominant_color" ('#rrggbb') placeholders to show while the crop loads,
+    e.g.:
+
+        <img src="{{ img.lqip }}" data-src="{{ img.url }}"
+             style="background-color: {{ img.dominant_color }}">
+
+    With either setting, and with `exact_size`, the image's thumbs are read
+    once per image, from its prefetched thumbs if there are any; pages that
+    show many images should prefetch them, e.g.
+    Article.objects.prefetch_related('image__thumbs').
+
     The `size` kwarg is deprecated.
 
     Omitting the `attribution` kwarg will omit the attribution, attribution_link,
@@ -50,23 +87,61 @@ def get_crop(image, crop_name, exact_size=False, **kwargs):
     if "size" in kwargs:
         warnings.warn("The size kwarg is deprecated.", DeprecationWarning)
 
+    db_image = getattr(image, 'related_object', None)
+    has_db_image = bool(getattr(db_image, 'pk', None))
+
+    sizes = Size.flatten(image.sizes)
+    try:
+        size = six.next(size_obj for size_obj in sizes if size_obj.name == crop_name)
+    except StopIteration:
+        size = None
+        formats = []
+    else:
+        formats = [f for f in FORMAT_PREFERENCE if f in size.output_formats]
+
+    crop_thumb = None
+    if (CROPDUSTER_HASHED_FILENAMES or CROPDUSTER_PLACEHOLDERS or formats) and has_db_image:
+        crop_thumb = get_thumbs(db_image).get(crop_name)
+    content_hash = getattr(crop_thumb, 'content_hash', None) if CROPDUSTER_HASHED_FILENAMES else None
+
+    def get_url(format=None):
+        if CROPDUSTER_LAZY_DERIVATIVES and has_db_image:
+            return db_image.get_lazy_url(crop_name, format=format, content_hash=content_hash)
+        return getattr(Image.get_file_for_size(
+            image, crop_name, format=format, content_hash=content_hash), 'url', None)
+
+    def get_format_url(format):
+        if format in (crop_thumb.get_formats() or []):
+            return get_url(format)
+        # Not written (yet), so have the lazy view render it on request
+        return db_image.get_lazy_url(crop_name, format=format, content_hash=content_hash)
+
     data = {}
-    data['url'] = getattr(Image.get_file_for_size(image, crop_name), 'url', None)
+    data['url'] = get_url()
+
+    if CROPDUSTER_PLACEHOLDERS:
+        for k in ('blurhash', 'lqip', 'dominant_color'):
+            data[k] = getattr(crop_thumb, k, None)
+
+    if crop_thumb is not None and formats:
+        data['sources'] = [{
+            'type': get_format_mimetype(format),
+            'url': get_format_url(format),
+        } for format in formats]
+        if accept:
+            best_format = select_format(accept, formats)
+            if best_format:
+                data['url'] = data['sources'][formats.index(best_format)]['url']
 
     if not exact_size:
-        sizes = Size.flatten(image.sizes)
-        try:
-            size = six.next(size_obj for size_obj in sizes if size_obj.name == crop_name)
-        except StopIteration:
-            pass
-        else:
+        if size:
             if size.width:
                 data['width'] = size.width
 
             if size.height:
                 data['height'] = size.height
     elif image.related_object:
-        thumbs = {thumb.name: thumb for thumb in image.related_object.thumbs.all()}
+        thumbs = get_thumbs(image.related_object)
 
         try:
             thumb = thumbs[crop_name]
@@ -76,9 +151,12 @@ def get_crop(image, crop_name, exact_size=False, **kwargs):
             else:
                 return None
 
-        cache_buster = base64.b32encode(str(time.mktime(thumb.date_modified.timetuple())))
+        if not content_hash:
+            cache_buster = base64.b32encode(str(time.mktime(thumb.date_modified.timetuple())))
+            for source in data.get('sources', []):
+                source['url'] = "%s?%s" % (source['url'], cache_buster)
+            data["url"] = "%s?%s" % (data["url"], cache_buster)
         data.update({
-            "url": "%s?%s" % (data["url"], cache_buster),
             "width": thumb.width,
             "height": thumb.height,
             "attribution": image.related_object.attribution,
@@ -87,3 +165,31 @@ def get_crop(image, crop_name, exact_size=False, **kwargs):
         })
 
     return data
+
+
+def get_thumbs(db_image):
+    """
+    The thumbs of `db_image` by name, loaded once per image instance (and
+    from its prefetched thumbs, if they were prefetched).
+    """
+    thumbs = getattr(db_image, '_cropduster_thumbs', None)
+    if thumbs is None:
+        thumbs = dict((thumb.name, thumb) for thumb in db_image.thumbs.all())
+        db_image._cropduster_thumbs = thumbs
+    return thumbs
+
+
+@register.simple_tag
+def crop_url(image, crop_name, width, format=None):
+    """
+    The signed URL of a crop rendered at an arbitrary width (rounded up to
+    CROPDUSTER_TRANSFORM_WIDTHS). Usage:
+
+    <img src="{% crop_url article.image 'lead' 640 %}"
+         srcset="{% crop_url article.image 'lead' 320 %} 320w,
+                 {% crop_url article.image 'lead' 640 %} 640w">
+    """
+    db_image = getattr(image, 'related_object', None)
+    if not getattr(db_image, 'pk', None):
+        return ''
+    return get_transform_url(db_image, crop_name, width, format=format)
@@ -1,8 +1,12 @@
 import os
+import errno
 import shutil
 import uuid
+import collections
 
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
 
 PATH = os.path.split(__file__)[0]
 ORIG_IMG_PATH = os.path.join(PATH, 'data')
@@ -26,3 +30,45 @@ class CropdusterTestCaseMediaMixin(object):
 
         # Remove all generated images
         shutil.rmtree(self.TEST_IMG_ROOT, ignore_errors=True)
+
+
+class FakeStorage(Storage):
+    """
+    An in-memory storage which records the number of calls made to it and
+    the number of bytes read from and written to it.
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.calls = collections.Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _open(self, name, mode='rb'):
+        self.calls['open'] += 1
+        if name not in self.files:
+            raise IOError(errno.ENOENT, "No such file: %s" % name)
+        content = self.files[name]
+        self.bytes_read += len(content)
+        return ContentFile(content, name=name)
+
+    def _save(self, name, content):
+        self.calls['save'] += 1
+        data = b''.join(content.chunks())
+        self.bytes_written += len(data)
+        self.files[name] = data
+        return name
+
+    def exists(self, name):
+        self.calls['exists'] += 1
+        return name in self.files
+
+    def delete(self, name):
+        self.calls['delete'] += 1
+        self.files.pop(name, None)
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def url(self, name):
+        return '/fake/%s' % name
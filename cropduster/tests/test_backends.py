@@ -0,0 +1,81 @@
+from __future__ import division
+
+import os
+
+import PIL.Image
+import PIL.ImageChops
+import PIL.ImageStat
+
+from django import test
+
+from .helpers import CropdusterTestCaseMediaMixin
+from ..backends import get_available_backends
+
+
+class TestBackendConformance(CropdusterTestCaseMediaMixin, test.TestCase):
+    """Run the same checks against every installed imaging backend."""
+
+    def setUp(self):
+        super(TestBackendConformance, self).setUp()
+        self.backends = get_available_backends()
+        self.assertIn('pillow', self.backends)
+
+    def _path(self, filename):
+        return os.path.join(self.TEST_IMG_DIR, filename)
+
+    def test_probe(self):
+        for name, backend in self.backends.items():
+            self.assertEqual(backend.probe(self._path('img.jpg')), ('JPEG', (674, 800)), name)
+            self.assertEqual(backend.probe(self._path('img.png'))[0], 'PNG', name)
+
+    def test_shrink_on_load(self):
+        for name, backend in self.backends.items():
+            im = backend.open(self._path('img.jpg'), size_hint=(100, 100))
+            (w, h) = backend.get_size(im)
+            self.assertTrue(100 <= w < 674 and 100 <= h < 800, name)
+
+    def test_crop_and_resize(self):
+        for name, backend in self.backends.items():
+            im = backend.open(self._path('img.jpg'))
+            im = backend.crop(im, (10, 20, 610, 320))
+            self.assertEqual(backend.get_size(im), (600, 300), name)
+            im = backend.resize(im, (301, 149))
+            self.assertEqual(backend.get_size(im), (301, 149), name)
+
+    def test_correct_colorspace(self):
+        for name, backend in self.backends.items():
+            im = backend.correct_colorspace(backend.open(self._path('cmyk.jpg')))
+            self.assertEqual(backend.to_pil(im).mode, 'RGB', name)
+            im = backend.correct_colorspace(backend.open(self._path('img.jpg')), bw=True)
+            self.assertEqual(backend.to_pil(im).mode, 'L', name)
+
+    def test_orient(self):
+        for name, backend in self.backends.items():
+            # No EXIF orientation: left as it is
+            im = backend.orient(backend.open(self._path('img.jpg')))
+            self.assertEqual(backend.get_size(im), (674, 800), name)
+
+    def test_render(self):
+        reference = None
+        for name, backend in sorted(self.backends.items()):
+            output = self._path('render-%s.jpg' % name)
+            backend.render(self._path('img.jpg'), (0, 0, 600, 300), (300, 150), output,
+                formats=['PNG'])
+            im = PIL.Image.open(output)
+            self.assertEqual((im.format, im.size), ('JPEG', (300, 150)), name)
+            self.assertEqual(PIL.Image.open(self._path('render-%s.png' % name)).size, (300, 150))
+
+            im = im.convert('RGB')
+            if reference is None:
+                reference = im
+            else:
+                # Different resampling filters, but the same picture
+                diff = PIL.ImageStat.Stat(PIL.ImageChops.difference(reference, im))
+                self.assertLess(max(diff.mean), 8, name)
+
+    def test_benchmark(self):
+        from ..backends.benchmark import benchmark, format_results
+
+        results = benchmark(self._path('img.jpg'), repeat=1)
+        self.assertEqual(set(results), set(self.backends))
+        self.assertIn('pillow', format_results(results))
@@ -5,13 +5,16 @@ import PIL
 import uuid
 import shutil
 
+import six
+
 from django import test
 from django.contrib.contenttypes.models import ContentType
 
 from .helpers import CropdusterTestCaseMediaMixin
 from .models import Article, Author, TestForOptionalSizes
-from ..models import Size, Image
+from ..models import Size, Image, Thumb
 from ..exceptions import CropDusterResizeException
+from .. import settings as cropduster_settings
 
 
 class TestImage(CropdusterTestCaseMediaMixin, test.TestCase):
@@ -281,3 +284,268 @@ class TestModelSaving(CropdusterTestCaseMediaMixin, test.TestCase):
             object_id=test_b.pk)
         num_thumbs = len(image.thumbs.all())
         self.assertEqual(num_thumbs, 2, "Expected one thumb; instead got %d" % num_thumbs)
+
+
+class TestThumbPromotion(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_tmp_thumb_promoted_with_final_encode(self):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        size = Size('wide', w=600, h=300)
+        fit = size.fit_image(PIL.Image.open(image.image.path))
+        thumb = image.save_size(size, thumb=Thumb(
+            name='wide', crop_x=fit.box.x1, crop_y=fit.box.y1,
+            crop_w=fit.box.w, crop_h=fit.box.h), tmp=True)['wide']
+
+        tmp_path = image.get_image_path('wide', tmp=True)
+        final_path = image.get_image_path('wide')
+        self.assertTrue(os.path.exists(tmp_path))
+        self.assertFalse(os.path.exists(final_path))
+
+        thumb.image = image
+        thumb.save()
+
+        # The draft is moved into place, then re-encoded
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertTrue(os.path.exists(final_path))
+        self.assertEqual(thumb.draft_formats, [])
+        draft_inode = os.stat(final_path).st_ino
+
+        image.render_drafts([thumb])
+        self.assertIsNone(thumb.draft_formats)
+        self.assertNotEqual(os.stat(final_path).st_ino, draft_inode)
+        self.assertEqual(PIL.Image.open(final_path).size, (600, 300))
+
+
+class TestHashedFilenames(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestHashedFilenames, self).setUp()
+        self.hashed_filenames = cropduster_settings.CROPDUSTER_HASHED_FILENAMES
+        cropduster_settings.CROPDUSTER_HASHED_FILENAMES = True
+
+    def tearDown(self):
+        super(TestHashedFilenames, self).tearDown()
+        cropduster_settings.CROPDUSTER_HASHED_FILENAMES = self.hashed_filenames
+
+    def test_hashed_filenames(self):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        thumb = Thumb.objects.create(name='wide', image=image, width=300, height=150,
+            crop_x=0, crop_y=0, crop_w=600, crop_h=300)
+
+        thumb.render()
+        first_hash = thumb.content_hash
+        self.assertRegexpMatches(first_hash, r'^[0-9a-f]{8}$')
+        self.assertEqual(Thumb.objects.get(pk=thumb.pk).content_hash, first_hash)
+        first_path = image.get_image_path('wide', content_hash=first_hash)
+        self.assertTrue(os.path.exists(first_path))
+        self.assertTrue(thumb.url.endswith('/wide.%s.jpg' % first_hash))
+
+        # Re-rendering the same pixels keeps the same name
+        thumb.render()
+        self.assertEqual(thumb.content_hash, first_hash)
+
+        thumb.crop_x = 50
+        thumb.render()
+        self.assertNotEqual(thumb.content_hash, first_hash)
+        # The superseded file is kept until the grace period has passed
+        self.assertTrue(os.path.exists(first_path))
+        thumb.delete_stale_files(grace_period=-60)
+        self.assertFalse(os.path.exists(first_path))
+        self.assertTrue(os.path.exists(image.get_image_path('wide', content_hash=thumb.content_hash)))
+
+
+class TestPlaceholders(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestPlaceholders, self).setUp()
+        self.placeholders = cropduster_settings.CROPDUSTER_PLACEHOLDERS
+        cropduster_settings.CROPDUSTER_PLACEHOLDERS = True
+
+    def tearDown(self):
+        super(TestPlaceholders, self).tearDown()
+        cropduster_settings.CROPDUSTER_PLACEHOLDERS = self.placeholders
+
+    def test_placeholders(self):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        thumb = Thumb.objects.create(name='wide', image=image, width=300, height=150,
+            crop_x=0, crop_y=0, crop_w=600, crop_h=300)
+        thumb.render()
+
+        thumb = Thumb.objects.get(pk=thumb.pk)
+        # 4x3 components: 1 + 1 + 4 + 2 * 11 characters
+        self.assertEqual(len(thumb.blurhash), 28)
+        self.assertRegexpMatches(thumb.dominant_color, r'^#[0-9a-f]{6}$')
+        self.assertTrue(thumb.lqip.startswith('data:image/jpeg;base64,'))
+
+
+class TestDuplicates(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        from .. import duplicates
+
+        super(TestDuplicates, self).setUp()
+        duplicates.reset_index()
+        self.duplicate_detection = cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION
+        cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION = True
+
+    def tearDown(self):
+        from .. import duplicates
+
+        super(TestDuplicates, self).tearDown()
+        duplicates.reset_index()
+        cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION = self.duplicate_detection
+
+    def create_image(self, filename):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        return Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, filename))
+
+    def test_find_similar(self):
+        from ..duplicates import find_similar, find_duplicate_groups
+
+        # A resized, re-encoded copy of img.jpg
+        img = PIL.Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        img.resize((img.size[0] // 3, img.size[1] // 3)).save(
+            os.path.join(self.TEST_IMG_DIR, 'img-small.jpg'), quality=50)
+
+        image = self.create_image('img.jpg')
+        self.assertRegexpMatches(image.dhash, r'^[0-9a-f]{16}$')
+        self.assertEqual(find_similar(image.dhash, exclude=image.pk), [])
+
+        # Images created after the index is loaded are found too
+        copy = self.create_image('img-small.jpg')
+        similar = find_similar(image.dhash, exclude=image.pk)
+        self.assertEqual([i.pk for (distance, i) in similar], [copy.pk])
+        self.assertEqual(find_similar(image.dhash, max_distance=-1), [])
+
+        self.assertIn(sorted([image.pk, copy.pk]), find_duplicate_groups())
+
+    def test_backfilled_images_are_indexed(self):
+        from django.core.management import call_command
+        from ..duplicates import find_similar
+
+        shutil.copy(os.path.join(self.TEST_IMG_DIR, 'img.jpg'),
+            os.path.join(self.TEST_IMG_DIR, 'img-copy.jpg'))
+        image = self.create_image('img.jpg')
+
+        cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION = False
+        copy = self.create_image('img-copy.jpg')
+        self.assertIsNone(copy.dhash)
+        cropduster_settings.CROPDUSTER_DUPLICATE_DETECTION = True
+        self.create_image('img2.jpg')
+        self.assertEqual(find_similar(image.dhash, exclude=image.pk), [])
+
+        # Hashed after the index was loaded with a newer image
+        call_command('cropduster_dhash', stdout=six.StringIO())
+        similar = find_similar(image.dhash, exclude=image.pk)
+        self.assertEqual([i.pk for (distance, i) in similar], [copy.pk])
+
+
+class TestRenderStore(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestRenderStore, self).setUp()
+        self.render_store_dir = cropduster_settings.CROPDUSTER_RENDER_STORE_DIR
+        cropduster_settings.CROPDUSTER_RENDER_STORE_DIR = os.path.join(self.TEST_IMG_ROOT, 'renders')
+
+    def tearDown(self):
+        super(TestRenderStore, self).tearDown()
+        cropduster_settings.CROPDUSTER_RENDER_STORE_DIR = self.render_store_dir
+
+    def create_thumb(self, name):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=name)
+        return Thumb.objects.create(name='wide', image=image, width=300, height=150,
+            crop_x=0, crop_y=0, crop_w=600, crop_h=300)
+
+    def test_identical_originals_share_renders(self):
+        from django.core.management import call_command
+        from ..resizing import Crop
+        from .. import renders
+
+        # Each upload gets a folder of its own, as do their derivatives
+        copy_dir = os.path.join(self.TEST_IMG_ROOT, 'copy')
+        os.makedirs(copy_dir)
+        shutil.copy(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), copy_dir)
+        thumb = self.create_thumb(os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        copy_thumb = self.create_thumb(
+            os.path.join(os.path.dirname(self.TEST_IMG_DIR_RELATIVE), 'copy', 'img.jpg'))
+
+        thumb.render()
+        create_image = Crop.create_image
+        def fail_create_image(*args, **kwargs):
+            raise AssertionError("Derivative was rendered again")
+        Crop.create_image = fail_create_image
+        try:
+            copy_thumb.render()
+        finally:
+            Crop.create_image = create_image
+
+        path = thumb.image.get_image_path('wide')
+        copy_path = copy_thumb.image.get_image_path('wide')
+        self.assertNotEqual(path, copy_path)
+        # Both derivatives are links to the one file in the store
+        store_files = [
+            os.path.join(dirpath, filename)
+            for (dirpath, dirnames, filenames) in os.walk(cropduster_settings.CROPDUSTER_RENDER_STORE_DIR)
+            for filename in filenames]
+        self.assertEqual(len(store_files), 1)
+        self.assertTrue(os.path.samefile(path, store_files[0]))
+        self.assertTrue(os.path.samefile(copy_path, store_files[0]))
+        self.assertEqual(os.stat(path).st_nlink, 3)
+        self.assertEqual(copy_thumb.width, 300)
+
+        os.unlink(copy_path)
+        self.assertEqual(renders.prune(), 0)
+        os.unlink(path)
+        stdout = six.StringIO()
+        call_command('cropduster_prune_renders', stdout=stdout)
+        self.assertIn("Deleted 1 unreferenced renders", stdout.getvalue())
+        self.assertEqual(renders.prune(), 0)
+
+
+class TestRenderPlan(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_shared_steps_are_deduplicated(self):
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        sizes = [
+            (Size(name, w=300, h=150), Thumb(name=name, crop_x=0, crop_y=0, crop_w=600, crop_h=300))
+            for name in ['wide', 'wide-copy', 'wide-2']]
+        sizes[2][1].crop_y = 10
+
+        sizes_plan = image.plan_sizes(sizes)
+        ops = [node.op for node in sizes_plan.plan.nodes]
+        # One decode, two distinct crops and resizes, and an encode per size
+        self.assertEqual(ops.count('decode'), 1)
+        self.assertEqual(ops.count('crop'), 2)
+        self.assertEqual(ops.count('resize'), 2)
+        self.assertEqual(ops.count('encode'), 3)
+        self.assertIn('shared by', sizes_plan.plan.explain())
+
+        results = sizes_plan.execute()
+        self.assertEqual([list(r) for r in results], [['wide'], ['wide-copy'], ['wide-2']])
+        for name in ['wide', 'wide-copy', 'wide-2']:
+            self.assertEqual(PIL.Image.open(image.get_image_path(name)).size, (300, 150))
+        self.assertEqual(results[2]['wide-2'].width, 300)
+        self.assertTrue(results[2]['wide-2'].pk)
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+import tempfile
+
+import PIL.Image
+
+from django import test
+
+from .helpers import CropdusterTestCaseMediaMixin, FakeStorage
+from ..models import Size, Image, Thumb
+from .. import storage as cropduster_storage
+from ..utils.cache import DiskCache, DecodedImageCache, RawPixelCache
+
+
+class TestStorage(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestStorage, self).setUp()
+        with open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), 'rb') as f:
+            self.contents = f.read()
+        self.storage = FakeStorage({'test/img.jpg': self.contents})
+        self.cache_dir = tempfile.mkdtemp()
+        cropduster_storage._originals_cache = DiskCache(self.cache_dir, 10 * 1024 * 1024)
+
+    def tearDown(self):
+        super(TestStorage, self).tearDown()
+        cropduster_storage._originals_cache = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def get_image(self):
+        image = Image(image='test/img.jpg', width=674, height=800)
+        image.image.storage = self.storage
+        return image
+
+    def test_is_local(self):
+        self.assertFalse(cropduster_storage.is_local(self.storage))
+        self.assertTrue(cropduster_storage.is_local(cropduster_storage.get_storage()))
+
+    def test_save_size(self):
+        image = self.get_image()
+        thumb = Thumb(name='thumb', crop_x=0, crop_y=0, crop_w=400, crop_h=300)
+        image.save_size(Size('thumb', w=200, h=150), thumb, tmp=True)
+
+        self.assertEqual(image.get_image_url('thumb', tmp=True), '/fake/test/thumb_tmp.jpg')
+        self.assertIn('test/thumb_tmp.jpg', self.storage.files)
+        thumb_contents = self.storage.files['test/thumb_tmp.jpg']
+        self.assertEqual(PIL.Image.open(io.BytesIO(thumb_contents)).size, (200, 150))
+
+        # The original is read once, and only the thumb is written
+        self.assertEqual(self.storage.calls['open'], 1)
+        self.assertEqual(self.storage.bytes_read, len(self.contents))
+        self.assertEqual(self.storage.calls['save'], 1)
+        self.assertEqual(self.storage.bytes_written, len(thumb_contents))
+
+    def test_originals_cache(self):
+        image = self.get_image()
+        for i in range(3):
+            thumb = Thumb(name='thumb', crop_x=0, crop_y=0, crop_w=400, crop_h=300)
+            image.save_size(Size('thumb', w=200, h=150), thumb, tmp=True)
+        # Repeated crops never re-fetch the original
+        self.assertEqual(self.storage.calls['open'], 1)
+        self.assertEqual(self.storage.bytes_read, len(self.contents))
+
+    def test_copy_and_move(self):
+        cropduster_storage.copy('test/img.jpg', 'test/copy.jpg', self.storage)
+        cropduster_storage.move('test/copy.jpg', 'test/moved.jpg', self.storage)
+        self.assertEqual(sorted(self.storage.files), ['test/img.jpg', 'test/moved.jpg'])
+        self.assertEqual(self.storage.files['test/moved.jpg'], self.contents)
+        self.assertEqual(self.storage.bytes_written, 2 * len(self.contents))
+
+
+class TestDecodedCache(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestDecodedCache, self).setUp()
+        cropduster_storage._decoded_cache = DecodedImageCache(10 * 1024 * 1024)
+        self.name = os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg')
+
+    def tearDown(self):
+        super(TestDecodedCache, self).tearDown()
+        cropduster_storage._decoded_cache = None
+
+    def test_repeated_opens_skip_decoding(self):
+        cache = cropduster_storage._decoded_cache
+        im = cropduster_storage.open_image(self.name, decoded=True)
+        self.assertIsNone(im.im)
+        # Not decoded yet, so not cached
+        cropduster_storage.cache_decoded_image(im)
+        self.assertEqual(len(cache), 0)
+        im.load()
+        cropduster_storage.cache_decoded_image(im)
+        self.assertEqual(len(cache), 1)
+
+        cached = cropduster_storage.open_image(self.name, decoded=True)
+        self.assertIsNotNone(cached.im)
+        self.assertEqual((cached.format, cached.size), ('JPEG', (674, 800)))
+        self.assertEqual(cached.filename, im.filename)
+        self.assertEqual(cache.hits, 1)
+
+        # Copy-on-write: modifying one image leaves the cached pixels alone
+        pixel = cached.getpixel((0, 0))
+        cached.paste((255, 0, 0), (0, 0, 10, 10))
+        self.assertEqual(cropduster_storage.open_image(self.name, decoded=True).getpixel((0, 0)), pixel)
+
+        # A new mtime is a different key
+        os.utime(im.filename, (1, 1))
+        self.assertIsNone(cropduster_storage.open_image(self.name, decoded=True).im)
+
+    def test_lru_eviction(self):
+        im = PIL.Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        im.load()
+        cache = DecodedImageCache(674 * 800 * 3 * 2)
+        for key in ['a', 'b']:
+            cache.put(key, im)
+        cache.get('a')
+        cache.put('c', im)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.total, 674 * 800 * 3 * 2)
+        # Larger than the whole budget
+        cache = DecodedImageCache(100)
+        cache.put('a', im)
+        self.assertEqual(len(cache), 0)
+
+
+class TestRawPixelCache(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        from .. import settings as cropduster_settings
+
+        super(TestRawPixelCache, self).setUp()
+        self.min_pixels = cropduster_settings.CROPDUSTER_RAW_CACHE_MIN_PIXELS
+        cropduster_settings.CROPDUSTER_RAW_CACHE_MIN_PIXELS = 0
+        self.cache_dir = tempfile.mkdtemp()
+        cropduster_storage._raw_cache = RawPixelCache(self.cache_dir, 100 * 1024 * 1024)
+
+    def tearDown(self):
+        from .. import settings as cropduster_settings
+
+        super(TestRawPixelCache, self).tearDown()
+        cropduster_settings.CROPDUSTER_RAW_CACHE_MIN_PIXELS = self.min_pixels
+        cropduster_storage._raw_cache = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_mapped_crops(self):
+        from ..utils.image import crop_image
+
+        name = os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg')
+        im = cropduster_storage.open_image(name, decoded=True)
+        im.load()
+        cropduster_storage.cache_decoded_image(im)
+
+        mapped = cropduster_storage.open_image(name, decoded=True)
+        self.assertEqual((mapped.format, mapped.size, mapped.mode), ('JPEG', (674, 800), 'RGBX'))
+        self.assertEqual(mapped.filename, im.filename)
+        box = (10, 20, 300, 200)
+        crop = crop_image(mapped, box)
+        self.assertEqual(crop.mode, 'RGB')
+        self.assertEqual(crop.tobytes(), im.crop(box).tobytes())
+
+    def test_modes(self):
+        cache = cropduster_storage._raw_cache
+        for filename in ['cmyk.jpg', 'transparent.png']:
+            im = PIL.Image.open(os.path.join(self.TEST_IMG_DIR, filename))
+            im.load()
+            cache.put_image(filename, im)
+            mapped = cache.get_image(filename)
+            self.assertEqual((mapped.mode, mapped.format), (im.mode, im.format))
+            self.assertEqual(mapped.tobytes(), im.tobytes())
+        palette = PIL.Image.new('P', (10, 10))
+        self.assertFalse(RawPixelCache.is_supported(palette))
+
+    def test_eviction_by_age(self):
+        im = PIL.Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        im.load()
+        cache = RawPixelCache(self.cache_dir, None, max_age=60)
+        cache.put_image('old', im)
+        cache.put_image('new', im)
+        os.utime(cache.get_path('old'), (1, 1))
+        cache.evict()
+        self.assertIsNone(cache.get_image('old'))
+        self.assertIsNotNone(cache.get_image('new'))
@@ -1,3 +1,5 @@
+from __future__ import division
+
 import os
 import shutil
 from PIL import Image
@@ -74,6 +76,83 @@ class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
                          os.path.join(path, 'my_img-1'))
         shutil.rmtree(path)
 
+    def test_get_upload_foldername_strategies(self):
+        import uuid
+        from ..utils import get_upload_foldername
+
+        random = uuid.uuid4().hex
+        path = os.path.join(settings.MEDIA_ROOT, random)
+        content_hash = 'abcdef0123456789abcdef0123456789'
+
+        self.assertEqual(
+            get_upload_foldername('my img.jpg', upload_to=random, strategy='hash',
+                content_hash=content_hash),
+            os.path.join(path, 'my_img-abcdef0123456789'))
+        # The same content under the same name gets a new random folder
+        folder = get_upload_foldername('my img.jpg', upload_to=random, strategy='hash',
+            content_hash=content_hash)
+        self.assertRegexpMatches(os.path.basename(folder), r'^my_img-[0-9a-f]{12}$')
+
+        folder = get_upload_foldername('my img.jpg', upload_to=random, strategy='hash',
+            content_hash=content_hash, shard=True)
+        self.assertTrue(folder.startswith(os.path.join(path, 'ab', 'cd', 'my_img-')))
+
+        folders = set([
+            get_upload_foldername('my img.jpg', upload_to=random, strategy='random')
+            for i in range(10)])
+        self.assertEqual(len(folders), 10)
+        for folder in folders:
+            self.assertTrue(os.path.isdir(folder))
+            self.assertEqual(os.listdir(folder), [])
+        shutil.rmtree(path)
+
+    def test_disk_cache(self):
+        import time
+        from ..utils.cache import DiskCache
+
+        cache = DiskCache(os.path.join(self.TEST_IMG_ROOT, 'cache'), max_bytes=25)
+        fills = []
+
+        def writer(contents):
+            def write(f):
+                fills.append(contents)
+                f.write(contents)
+            return write
+
+        path_a = cache.get_or_fill(cache.get_key('a'), writer(b'a' * 10))
+        self.assertEqual(cache.get_or_fill(cache.get_key('a'), writer(b'a' * 10)), path_a)
+        self.assertEqual(len(fills), 1)
+        with open(path_a, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 10)
+
+        path_b = cache.get_or_fill(cache.get_key('b'), writer(b'b' * 10))
+        # Make 'b' the least recently used entry
+        os.utime(path_b, (time.time() - 60, time.time() - 60))
+        cache.get_or_fill(cache.get_key('c'), writer(b'c' * 10))
+        self.assertIsNone(cache.get(cache.get_key('b')))
+        self.assertEqual(cache.get(cache.get_key('a')), path_a)
+
+    def test_clone_file(self):
+        from ..utils import clone_file, save_image
+
+        src = os.path.join(self.TEST_IMG_DIR, 'img.jpg')
+        dst = os.path.join(self.TEST_IMG_DIR, 'img_tmp.jpg')
+        with open(src, 'rb') as f:
+            src_contents = f.read()
+
+        for methods in [('link', 'reflink'), ('reflink',), ()]:
+            method = clone_file(src, dst, methods=methods)
+            self.assertIn(method, ('copy',) + methods)
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), src_contents)
+
+        clone_file(src, dst, methods=('link',))
+        # Saving over a clone must not modify the file it was cloned from
+        save_image(Image.open(src).resize((10, 10)), dst)
+        self.assertEqual(Image.open(dst).size, (10, 10))
+        with open(src, 'rb') as f:
+            self.assertEqual(f.read(), src_contents)
+
     def test_get_min_size(self):
         from ..utils import get_min_size
         from ..resizing import Size
@@ -99,3 +178,300 @@ class TestUtilsPaths(CropdusterTestCaseMediaMixin, test.TestCase):
         from_url = settings.MEDIA_URL + img_name
         to_url = settings.MEDIA_ROOT + img_name
         self.assertEqual(get_media_path(from_url), to_url)
+
+
+class TestUtilsFormats(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_select_format(self):
+        from ..utils.formats import select_format
+
+        chrome_accept = 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+        self.assertEqual(select_format(chrome_accept, ['WEBP', 'AVIF'], 'JPEG'), 'AVIF')
+        self.assertEqual(select_format(chrome_accept, ['WEBP'], 'JPEG'), 'WEBP')
+        self.assertEqual(select_format('image/webp;q=0, */*', ['WEBP'], 'JPEG'), 'JPEG')
+        self.assertEqual(select_format('*/*', ['WEBP', 'AVIF'], 'jpg'), 'JPEG')
+        self.assertEqual(select_format(None, ['WEBP'], 'PNG'), 'PNG')
+
+    def test_process_image_alternate_formats(self):
+        from ..utils import process_image
+        from ..utils.formats import is_format_supported
+
+        if not is_format_supported('WEBP'):
+            return
+
+        img = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        save_filename = os.path.join(self.TEST_IMG_DIR, 'alt.jpg')
+        process_image(img, save_filename, lambda im: im.resize((100, 100)), formats=['WEBP'])
+        webp_filename = os.path.join(self.TEST_IMG_DIR, 'alt.webp')
+        self.assertTrue(os.path.exists(webp_filename))
+        webp_img = Image.open(webp_filename)
+        self.assertEqual(webp_img.format, 'WEBP')
+        self.assertEqual(webp_img.size, (100, 100))
+
+    def test_format_report(self):
+        from ..utils.formats import format_report
+
+        img = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        report = format_report(img, ['WEBP'])
+        self.assertEqual(report[0]['format'], 'JPEG')
+        self.assertEqual(report[0]['ratio'], 1)
+        for row in report:
+            self.assertTrue(row['bytes'] > 0)
+
+
+class TestUtilsProfiles(test.TestCase):
+
+    def test_profile_registry(self):
+        from ..utils.profiles import EncoderProfile, EncoderProfileRegistry
+
+        registry = EncoderProfileRegistry()
+        registry.register(EncoderProfile(quality=lambda w, h: 90, optimize=True), format='JPEG')
+        registry.register(EncoderProfile(quality=70, progressive=True), size_name='thumb')
+        registry.register(EncoderProfile(subsampling=0), format='JPEG', min_pixels=1000 * 1000)
+        registry.register(EncoderProfile(compress_level=1, strip_metadata=True), format='PNG')
+
+        info = {'icc_profile': b'icc'}
+        params = registry.get_profile('jpg', 'main', 600, 480).get_save_params('JPEG', 600, 480, info)
+        self.assertEqual(params, {'quality': 90, 'optimize': True, 'icc_profile': b'icc'})
+
+        params = registry.get_profile('JPEG', 'thumb', 110, 90).get_save_params('JPEG', 110, 90)
+        self.assertEqual(params, {'quality': 70, 'optimize': True, 'progressive': True})
+
+        params = registry.get_profile('JPEG', 'main', 2000, 1000).get_save_params('JPEG', 2000, 1000)
+        self.assertEqual(params['subsampling'], 0)
+
+        params = registry.get_profile('PNG', 'thumb', 110, 90).get_save_params('PNG', 110, 90, info)
+        self.assertEqual(params, {'compress_level': 1})
+
+
+class TestUtilsPlaceholders(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_placeholders(self):
+        from cropduster.utils import placeholders
+
+        im = Image.new('RGB', (40, 30), (255, 0, 0))
+        self.assertEqual(placeholders.get_dominant_color(im), '#ff0000')
+        blurhash = placeholders.get_blurhash(im)
+        # The size flag for 4x3 components, then the DC component (red)
+        self.assertEqual(blurhash[0], 'L')
+        self.assertEqual(blurhash[2:6], 'TI:j')
+        self.assertEqual(len(blurhash), 28)
+
+        lqip = placeholders.get_lqip(im, size=20)
+        self.assertTrue(lqip.startswith('data:image/jpeg;base64,'))
+
+        # The pure-python and numpy implementations agree
+        im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        if placeholders.numpy is not None:
+            blurhash = placeholders.get_blurhash(im)
+            numpy, placeholders.numpy = placeholders.numpy, None
+            try:
+                self.assertEqual(placeholders.get_blurhash(im), blurhash)
+            finally:
+                placeholders.numpy = numpy
+
+
+class TestUtilsDuplicates(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_dhash(self):
+        from cropduster.utils.dhash import get_dhash, hamming_distance
+
+        im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        dhash = get_dhash(im)
+        self.assertEqual(len(dhash), 16)
+        small = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        small = small.resize((small.size[0] // 4, small.size[1] // 4))
+        self.assertLessEqual(hamming_distance(dhash, get_dhash(small)), 4)
+        flipped = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg')).transpose(Image.FLIP_LEFT_RIGHT)
+        self.assertGreater(hamming_distance(dhash, get_dhash(flipped)), 16)
+
+    def test_bk_tree(self):
+        import random
+        from cropduster.duplicates import BKTree
+        from cropduster.utils.dhash import hamming_distance
+
+        rand = random.Random(0)
+        hashes = ['%016x' % rand.getrandbits(64) for i in range(500)]
+        tree = BKTree((h, i) for (i, h) in enumerate(hashes))
+        self.assertEqual(len(tree), 500)
+        for query in hashes[:20]:
+            expected = sorted(
+                (hamming_distance(query, h), i) for (i, h) in enumerate(hashes)
+                if hamming_distance(query, h) <= 24)
+            self.assertEqual(tree.search(query, 24), expected)
+
+
+class TestUtilsAdmission(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    settings_names = [
+        'CROPDUSTER_RENDER_MEMORY_BUDGET', 'CROPDUSTER_RENDER_ADMISSION_FILE',
+        'CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER', 'CROPDUSTER_RENDER_ADMISSION_TIMEOUT']
+
+    def setUp(self):
+        from cropduster import settings as cropduster_settings, admission
+
+        super(TestUtilsAdmission, self).setUp()
+        self.settings = dict((n, getattr(cropduster_settings, n)) for n in self.settings_names)
+        cropduster_settings.CROPDUSTER_RENDER_ADMISSION_FILE = os.path.join(
+            self.TEST_IMG_ROOT, 'admission.json')
+        admission.reset_stats()
+        self.im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+
+    def tearDown(self):
+        from cropduster import settings as cropduster_settings
+
+        super(TestUtilsAdmission, self).tearDown()
+        for name, value in self.settings.items():
+            setattr(cropduster_settings, name, value)
+
+    def test_estimate_memory(self):
+        from cropduster.admission import estimate_memory, get_draft_scale
+
+        self.assertEqual(estimate_memory(self.im), 674 * 800 * 3 * 2)
+        self.assertEqual(get_draft_scale(self.im, 0.2), 0.25)
+        self.assertEqual(get_draft_scale(self.im, 0.6), 1)
+        png = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.png'))
+        self.assertEqual(get_draft_scale(png, 0.2), 1)
+        gif = Image.open(os.path.join(self.TEST_IMG_DIR, 'animated.gif'))
+        self.assertEqual(estimate_memory(gif),
+            gif.size[0] * gif.size[1] * 4 * gif.n_frames * 2)
+
+    def test_queue_and_degrade(self):
+        import threading
+        import time
+        from cropduster import settings as cropduster_settings, admission
+
+        cropduster_settings.CROPDUSTER_RENDER_MEMORY_BUDGET = admission.estimate_memory(self.im)
+        cropduster_settings.CROPDUSTER_RENDER_ADMISSION_DEGRADE_AFTER = 0.2
+
+        reservations = []
+        running = threading.Event()
+        release = threading.Event()
+
+        def render(**kwargs):
+            with admission.admit(self.im, **kwargs) as reservation:
+                reservations.append(reservation)
+                running.set()
+                release.wait(5)
+
+        first = threading.Thread(target=render)
+        first.start()
+        running.wait(5)
+        second = threading.Thread(target=render, kwargs={'draft_scale': 0.2})
+        second.start()
+        time.sleep(0.4)
+
+        stats = admission.get_stats()
+        self.assertEqual((stats['running'], stats['queued']), (1, 1))
+
+        release.set()
+        first.join()
+        second.join()
+        self.assertFalse(reservations[0].degraded)
+        self.assertTrue(reservations[1].degraded)
+        self.assertGreater(reservations[1].wait_time, 0.2)
+        self.assertLess(reservations[1].nbytes, reservations[0].nbytes)
+
+        stats = admission.get_stats()
+        self.assertEqual((stats['running'], stats['queued'], stats['in_use']), (0, 0, 0))
+        self.assertEqual((stats['admitted'], stats['degraded']), (2, 1))
+
+    def test_timeout(self):
+        from cropduster import settings as cropduster_settings, admission
+        from cropduster.exceptions import CropDusterAdmissionException
+
+        cropduster_settings.CROPDUSTER_RENDER_MEMORY_BUDGET = admission.estimate_memory(self.im)
+        cropduster_settings.CROPDUSTER_RENDER_ADMISSION_TIMEOUT = 0.2
+        with admission.admit(self.im):
+            with self.assertRaises(CropDusterAdmissionException):
+                with admission.admit(self.im):
+                    pass
+        self.assertEqual(admission.get_stats()['timed_out'], 1)
+        self.assertEqual(admission.get_stats()['queued'], 0)
+
+
+class TestUtilsRegionDecoding(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def setUp(self):
+        super(TestUtilsRegionDecoding, self).setUp()
+        self.im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg')).convert('RGB')
+        self.box = (50, 120, 250, 200)
+
+    def _assert_region(self, filename, max_size):
+        from ..utils.roi import decode_region
+
+        path = os.path.join(self.TEST_IMG_DIR, filename)
+        self.im.save(path)
+        (region, region_box) = decode_region(path, self.box)
+        self.assertEqual(region.format, Image.open(path).format)
+        self.assertLessEqual(region.size[1], max_size[1])
+        self.assertEqual(
+            list(region.crop(region_box).getdata()),
+            list(Image.open(path).crop(self.box).getdata()))
+
+    def test_decode_raw_rows(self):
+        # Only the rows of the box are read
+        self._assert_region('region.tif', (self.im.size[0], 80))
+
+    def test_decode_png_rows(self):
+        # Decoding stops after the last row of the box
+        self._assert_region('region.png', (self.im.size[0], 200))
+
+    def test_decode_jpeg_draft(self):
+        from ..utils.roi import decode_region
+
+        path = os.path.join(self.TEST_IMG_DIR, 'img.jpg')
+        (region, region_box) = decode_region(path, self.box, scale=0.25)
+        self.assertLess(region.size[0], self.im.size[0])
+        (x1, y1, x2, y2) = region_box
+        self.assertAlmostEqual((x2 - x1) / (y2 - y1), 200 / 80, places=1)
+        self.assertIsNone(decode_region(path, self.box))
+
+    def test_is_decoded(self):
+        from ..utils.roi import is_decoded
+
+        im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        self.assertFalse(is_decoded(im))
+        im.load()
+        self.assertTrue(is_decoded(im))
+
+
+class TestUtilsNormalize(CropdusterTestCaseMediaMixin, test.TestCase):
+
+    def test_normalize_orientation(self):
+        from ..utils.normalize import (
+            get_exif_orientation, get_normalized_size, normalize_original)
+
+        if not hasattr(Image, 'Exif'):
+            return
+
+        path = os.path.join(self.TEST_IMG_DIR, 'rotated.jpg')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        im = Image.open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'))
+        (w, h) = im.size
+        im.save(path, exif=exif.tobytes())
+
+        rotated = Image.open(path)
+        self.assertEqual(get_normalized_size(rotated, orientation=False), (w, h))
+        self.assertEqual(get_normalized_size(rotated, orientation=True), (h, w))
+        self.assertFalse(normalize_original(path, orientation=False, colorspace=False))
+        self.assertTrue(normalize_original(path, orientation=True))
+
+        normalized = Image.open(path)
+        self.assertEqual(normalized.size, (h, w))
+        self.assertEqual(get_exif_orientation(normalized), 1)
+        # Normalizing again leaves the file alone
+        self.assertFalse(normalize_original(path, orientation=True))
+
+    def test_normalize_colorspace(self):
+        from ..utils.normalize import needs_normalization, normalize_original
+
+        path = os.path.join(self.TEST_IMG_DIR, 'normalized_cmyk.jpg')
+        shutil.copyfile(os.path.join(self.TEST_IMG_DIR, 'cmyk.jpg'), path)
+        self.assertFalse(needs_normalization(Image.open(path), colorspace=False))
+        self.assertTrue(needs_normalization(Image.open(path), colorspace=True))
+        self.assertTrue(normalize_original(path, colorspace=True))
+        normalized = Image.open(path)
+        self.assertEqual(normalized.mode, 'RGB')
+        self.assertEqual(normalized.size, Image.open(os.path.join(self.TEST_IMG_DIR, 'cmyk.jpg')).size)
@@ -1,16 +1,27 @@
 import os
+import re
+import shutil
+import tempfile
+
+import six
+
+import PIL.Image
 
 from django import test
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.http import HttpRequest
 
 from generic_plus.utils import get_media_path
 
-from cropduster import views
+from cropduster import views, transforms, tiles
+from cropduster.utils.cache import DiskCache
+from cropduster.models import Image, Thumb, Size
 from cropduster.utils import json
 
 from .helpers import CropdusterTestCaseMediaMixin
+from .models import Article, Author
 
 
 class CropdusterViewTestRunner(CropdusterTestCaseMediaMixin, test.TestCase):
@@ -108,3 +119,293 @@ class TestUpload(CropdusterViewTestRunner):
 
         self.assertEqual(response.status_code, 200)
         self.assertTrue(os.path.exists(uploaded_img_path))
+        # The same file, through the preview view
+        self.assertTrue(data['preview_url'].endswith('/' + os.path.basename(uploaded_img_path)))
+
+
+    def test_post_request_over_max_pixels(self):
+        from cropduster import settings as cropduster_settings
+
+        upload_to = os.path.join(self.TEST_IMG_DIR_RELATIVE, 'uploads')
+        img_file = open(os.path.join(self.TEST_IMG_DIR, 'img.jpg'), 'rb')
+        data = {
+            u'image': img_file,
+            u'upload_to': [upload_to],
+            u'sizes': u'[]',
+        }
+        request = self.factory.post(reverse('cropduster-upload'), data)
+        request.user = self.user
+
+        max_pixels = cropduster_settings.CROPDUSTER_MAX_PIXELS
+        cropduster_settings.CROPDUSTER_MAX_PIXELS = 100 * 100
+        try:
+            response = views.upload(request)
+        finally:
+            cropduster_settings.CROPDUSTER_MAX_PIXELS = max_pixels
+
+        self.assertIn('error', json.loads(response.content))
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_IMG_ROOT, 'data', 'uploads')))
+
+    def test_large_image_accepted_without_max_pixels(self):
+        from cropduster import settings as cropduster_settings
+        from cropduster.views.forms import check_upload_size
+
+        # 60 megapixels, over the limit that used to be the default
+        img_path = os.path.join(self.TEST_IMG_DIR, 'large.png')
+        PIL.Image.new('1', (10000, 6000)).save(img_path)
+
+        max_pixels = cropduster_settings.CROPDUSTER_MAX_PIXELS
+        cropduster_settings.CROPDUSTER_MAX_PIXELS = None
+        try:
+            check_upload_size(PIL.Image.open(img_path))
+        finally:
+            cropduster_settings.CROPDUSTER_MAX_PIXELS = max_pixels
+
+class TestCrop(CropdusterViewTestRunner):
+
+    def test_formset_is_rendered_from_one_decode(self):
+        img_path = os.path.join(self.TEST_IMG_DIR, 'img.jpg')
+        sizes = [{
+            "__type__": "Size", "name": "size%d" % i, "label": "Size %d" % i,
+            "w": 40 + 10 * i, "h": 30 + 10 * i,
+        } for i in range(10)]
+        data = {
+            'crop-orig_image': os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'),
+            'crop-sizes': json.dumps(sizes),
+            'crop-thumbs': '{}',
+            'thumbs-TOTAL_FORMS': str(len(sizes)),
+            'thumbs-INITIAL_FORMS': '0',
+            'thumbs-MAX_NUM_FORMS': '1000',
+        }
+        for i, size in enumerate(sizes):
+            data.update({
+                'thumbs-%d-name' % i: size['name'],
+                'thumbs-%d-size' % i: json.dumps(size),
+                'thumbs-%d-crop_x' % i: '0',
+                'thumbs-%d-crop_y' % i: '0',
+                'thumbs-%d-crop_w' % i: '400',
+                'thumbs-%d-crop_h' % i: '300',
+            })
+
+        opened = []
+        orig_open = PIL.Image.open
+
+        def counting_open(fp, *args, **kwargs):
+            if isinstance(fp, six.string_types) and os.path.abspath(fp) == img_path:
+                opened.append(fp)
+            return orig_open(fp, *args, **kwargs)
+
+        request = self.factory.post(reverse('cropduster-crop'), data)
+        request.user = self.user
+        PIL.Image.open = counting_open
+        try:
+            response = views.crop(request)
+        finally:
+            PIL.Image.open = orig_open
+
+        self.assertEqual(response.status_code, 200)
+        response_data = json.loads(response.content)
+        self.assertEqual(len(response_data['thumbs']), len(sizes))
+        for thumb_data in response_data['thumbs']:
+            self.assertTrue(thumb_data['changed'])
+        self.assertEqual(len(opened), 1)
+
+
+class DerivativeTestRunner(CropdusterViewTestRunner):
+
+    def setUp(self):
+        super(DerivativeTestRunner, self).setUp()
+        article = Article.objects.create(title="test", author=Author.objects.create(name='test'))
+        self.image = Image.objects.create(
+            content_type=ContentType.objects.get(app_label='cropduster', model='article'),
+            object_id=article.pk,
+            image=os.path.join(self.TEST_IMG_DIR_RELATIVE, 'img.jpg'))
+        # A thumb whose file was never rendered, e.g. a newly added size
+        Thumb.objects.create(name='wide', image=self.image, width=300, height=150,
+            crop_x=0, crop_y=0, crop_w=600, crop_h=300)
+
+
+class TestDerivative(DerivativeTestRunner):
+
+    def get(self, size_name, extension='jpg'):
+        url = self.image.get_lazy_url(size_name, format=extension)
+        request = self.factory.get(url)
+        return views.derivative(request, image_id=str(self.image.pk),
+            size_name=size_name, extension=extension)
+
+    def test_renders_missing_derivative(self):
+        path = self.image.get_image_path('wide')
+        self.assertFalse(os.path.exists(path))
+
+        response = self.get('wide')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(PIL.Image.open(path).size, (300, 150))
+
+        # The second request serves the existing file
+        mtime = os.path.getmtime(path)
+        self.assertEqual(self.get('wide').status_code, 200)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_unknown_size_is_404(self):
+        from django.http import Http404
+        self.assertRaises(Http404, self.get, 'missing')
+
+
+class TestTransform(DerivativeTestRunner):
+
+    def setUp(self):
+        super(TestTransform, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        transforms._transform_cache = DiskCache(self.cache_dir, 10 * 1024 * 1024)
+
+    def tearDown(self):
+        super(TestTransform, self).tearDown()
+        transforms._transform_cache = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def get(self, url):
+        match = re.search(
+            r'/t/(?P<signature>[^/]+)/(?P<image_id>\d+)/(?P<crop_name>[^/.]+)/w(?P<width>\d+)\.(?P<extension>\w+)$',
+            url)
+        return views.transform(self.factory.get(url), **match.groupdict())
+
+    def test_quantize_width(self):
+        ladder = (160, 320, 640)
+        self.assertEqual(transforms.quantize_width(100, ladder), 160)
+        self.assertEqual(transforms.quantize_width(320, ladder), 320)
+        self.assertEqual(transforms.quantize_width(321, ladder), 640)
+        self.assertEqual(transforms.quantize_width(5000, ladder), 640)
+
+    def test_transform(self):
+        url = transforms.get_transform_url(self.image, 'wide', 300)
+        self.assertIn('/w320.jpg', url)
+
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        contents = b''.join(response)
+        self.assertEqual(PIL.Image.open(six.BytesIO(contents)).size, (320, 160))
+
+        # The second request is served from the cache
+        cache_files = os.listdir(self.cache_dir)
+        self.assertEqual(b''.join(self.get(url)), contents)
+        self.assertEqual(os.listdir(self.cache_dir), cache_files)
+
+    def test_bad_signature_is_404(self):
+        from django.http import Http404
+        url = transforms.get_transform_url(self.image, 'wide', 320)
+        self.assertRaises(Http404, self.get, url.replace('/w320.', '/w640.'))
+
+
+class TestTiles(DerivativeTestRunner):
+
+    def setUp(self):
+        super(TestTiles, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        tiles._tile_cache = DiskCache(self.cache_dir, 10 * 1024 * 1024)
+        self.name = self.image.image.name
+        self.signature = tiles.get_signature(self.name)
+
+    def tearDown(self):
+        super(TestTiles, self).tearDown()
+        tiles._tile_cache = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def get_tile(self, level, col, row, extension='jpg', signature=None):
+        return views.tile(self.factory.get('/'), signature=signature or self.signature,
+            name=self.name, level=str(level), col=str(col), row=str(row), extension=extension)
+
+    def test_levels(self):
+        levels = tiles.get_levels((3000, 2000))
+        self.assertEqual(len(levels), 13)
+        self.assertEqual(levels[0], (1, 1))
+        self.assertEqual(levels[-2:], [(1500, 1000), (3000, 2000)])
+        self.assertEqual(tiles.get_tile_box((3000, 2000), 11, 7, 256, 1), (2815, 1791, 3000, 2000))
+        self.assertIsNone(tiles.get_tile_box((3000, 2000), 12, 0, 256, 1))
+
+    def test_descriptor(self):
+        url = tiles.get_descriptor_url(self.name)
+        self.assertIn('/%s/' % self.signature, url)
+        response = views.tiles_descriptor(self.factory.get(url),
+            signature=self.signature, name=self.name)
+        (w, h) = PIL.Image.open(self.image.image.path).size
+        self.assertIn(b'Format="jpg"', response.content)
+        self.assertIn(('<Size Width="%d" Height="%d"/>' % (w, h)).encode('ascii'), response.content)
+
+    def test_tiles(self):
+        original = PIL.Image.open(self.image.image.path)
+        levels = tiles.get_levels(original.size)
+        top = len(levels) - 1
+
+        response = self.get_tile(top, 0, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(PIL.Image.open(six.BytesIO(b''.join(response))).size, (257, 257))
+
+        # Only the requested level was rendered; the others are on demand
+        cache = tiles.get_tile_cache()
+        pyramid_key = tiles._get_pyramid_key(self.name, 'jpg')
+        self.assertIsNone(cache.get(tiles._get_tile_key(cache, pyramid_key, 0, 0, 0)))
+        self.assertEqual(PIL.Image.open(six.BytesIO(b''.join(self.get_tile(0, 0, 0)))).size,
+            (1, 1))
+
+        from django.http import Http404
+        self.assertRaises(Http404, self.get_tile, top + 1, 0, 0)
+        self.assertRaises(Http404, self.get_tile, top, 0, 0, extension='png')
+        self.assertRaises(Http404, self.get_tile, top, 0, 0, signature='0' * 20)
+
+
+class TestPreview(DerivativeTestRunner):
+
+    def setUp(self):
+        super(TestPreview, self).setUp()
+        shutil.copy(self.image.image.path, self.image.get_image_path('_preview'))
+        self.url = self.image.get_preview_url('_preview')
+        self.name = self.image.get_image_name('_preview')
+
+    def get(self, **headers):
+        return views.preview(self.factory.get(self.url, **headers), name=self.name)
+
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        etag = response['ETag']
+
+        # A matching ETag is answered without opening the file
+        from cropduster.storage import StrFileSystemStorage
+        def fail_open(*args, **kwargs):
+            raise AssertionError("File was opened")
+        StrFileSystemStorage.open = fail_open
+        try:
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            # Weak and listed validators match too
+            self.assertEqual(self.get(
+                HTTP_IF_NONE_MATCH='"other", W/%s' % etag).status_code, 304)
+        finally:
+            del StrFileSystemStorage.open
+
+        # Replacing the file changes the ETag
+        os.utime(self.image.get_image_path('_preview'), (0, 0))
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_range(self):
+        with open(self.image.image.path, 'rb') as f:
+            contents = f.read()
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), contents[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % len(contents))
+
+        response = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), contents[-5:])
+
+        self.assertEqual(self.get(HTTP_RANGE='bytes=%d-' % len(contents)).status_code, 416)
+
+    def test_only_previews_are_served(self):
+        from django.http import Http404
+        self.assertFalse(Image.is_preview_name(self.image.image.name))
+        self.assertFalse(Image.is_preview_name('../etc/_preview.jpg'))
+        self.assertRaises(Http404, views.preview,
+            self.factory.get(self.url), name=self.image.image.name)
@@ -0,0 +1,197 @@
+"""
+Deep zoom (DZI) tile pyramids of originals, so that the crop dialog can zoom
+into the detail of very large images without downloading them in full::
+
+    /cropduster/tiles/<signature>/<name>.dzi
+    /cropduster/tiles/<signature>/<name>_files/<level>/<col>_<row>.<ext>
+
+The .dzi descriptor is built from the original's header. Level 0 of the
+pyramid is a single pixel and each level doubles the size of the one below
+it, up to the original's size at the top level; every level is cut into
+CROPDUSTER_TILE_SIZE pixel square tiles, overlapping their neighbours by
+CROPDUSTER_TILE_OVERLAP pixels.
+
+Each level is rendered on the first request for one of its tiles, and only
+that level: the original is resized to the level's size (decoded in draft
+mode, at a reduced scale, when the render was degraded by
+cropduster.admission) and cut into tiles. The tiles are kept in an LRU disk
+cache.
+"""
+from __future__ import division
+
+import math
+
+from django.core.urlresolvers import reverse
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+import PIL.Image
+
+from cropduster.utils import is_transparent, save_image, file_lock
+from cropduster.utils.cache import DiskCache
+from cropduster.utils.formats import convert_for_format
+from cropduster.utils.image import crop_image
+from cropduster.utils.roi import is_decoded
+from cropduster import settings as cropduster_settings
+from cropduster import storage as cropduster_storage
+from cropduster import admission
+
+
+__all__ = (
+    'get_signature', 'check_signature', 'get_descriptor_url', 'get_levels',
+    'get_tile_box', 'get_tile_format', 'get_descriptor', 'get_tile_cache',
+    'get_tile_file', 'render_level')
+
+
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+
+def get_signature(name):
+    return salted_hmac('cropduster.tiles', name).hexdigest()[:20]
+
+
+def check_signature(signature, name):
+    return constant_time_compare(signature, get_signature(name))
+
+
+def get_descriptor_url(name):
+    """The signed URL of the .dzi descriptor of the original `name`."""
+    return reverse('cropduster-tiles-descriptor', kwargs={
+        'signature': get_signature(name),
+        'name': name,
+    })
+
+
+def get_levels(size):
+    """The (width, height) of each level of the pyramid of an image of `size`."""
+    (w, h) = size
+    max_level = int(math.ceil(math.log(max(w, h, 1), 2)))
+    levels = []
+    for level in range(max_level + 1):
+        scale = 2 ** (max_level - level)
+        levels.append((int(math.ceil(w / scale)), int(math.ceil(h / scale))))
+    return levels
+
+
+def get_tile_box(level_size, col, row, tile_size=None, overlap=None):
+    """
+    The box, in the level's pixels, of the tile at `col`, `row`, or None if
+    the level has no such tile.
+    """
+    tile_size = tile_size or cropduster_settings.CROPDUSTER_TILE_SIZE
+    if overlap is None:
+        overlap = cropduster_settings.CROPDUSTER_TILE_OVERLAP
+    (w, h) = level_size
+    x = col * tile_size
+    y = row * tile_size
+    if col < 0 or row < 0 or x >= w or y >= h:
+        return None
+    return (
+        max(0, x - overlap), max(0, y - overlap),
+        min(w, x + tile_size + overlap), min(h, y + tile_size + overlap))
+
+
+def get_tile_format(im):
+    """The extension of the tiles of `im`: png for transparent images, else jpg."""
+    return 'png' if is_transparent(im) else 'jpg'
+
+
+def get_descriptor(name, storage=None):
+    """The .dzi descriptor (XML) of the original `name`, read from its header."""
+    im = cropduster_storage.open_image(name, storage)
+    (w, h) = im.size
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="%s" Format="%s" Overlap="%d" TileSize="%d">'
+        '<Size Width="%d" Height="%d"/></Image>\n') % (
+            DZI_NAMESPACE, get_tile_format(im), cropduster_settings.CROPDUSTER_TILE_OVERLAP,
+            cropduster_settings.CROPDUSTER_TILE_SIZE, w, h)
+
+
+_tile_cache = None
+
+
+def get_tile_cache():
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = DiskCache(
+            cropduster_settings.CROPDUSTER_TILE_CACHE_DIR,
+            cropduster_settings.CROPDUSTER_TILE_CACHE_MAX_BYTES)
+    return _tile_cache
+
+
+def _get_pyramid_key(name, extension):
+    return '%s|%s|%s|%s' % (
+        name, cropduster_settings.CROPDUSTER_TILE_SIZE,
+        cropduster_settings.CROPDUSTER_TILE_OVERLAP, extension)
+
+
+def _get_level_key(pyramid_key, level):
+    return '%s|%d' % (pyramid_key, level)
+
+
+def _get_tile_key(cache, pyramid_key, level, col, row):
+    return cache.get_key('%s|%d_%d' % (_get_level_key(pyramid_key, level), col, row))
+
+
+def get_tile_file(name, level, col, row, extension, storage=None):
+    """
+    Return the path of a tile of the pyramid of the original `name`,
+    rendering the tile's level into the tile cache if the tile is not
+    already there, or None if the pyramid has no such tile.
+    """
+    im = cropduster_storage.open_image(name, storage)
+    if extension != get_tile_format(im):
+        return None
+    levels = get_levels(im.size)
+    if not 0 <= level < len(levels) or not get_tile_box(levels[level], col, row):
+        return None
+
+    cache = get_tile_cache()
+    pyramid_key = _get_pyramid_key(name, extension)
+    key = _get_tile_key(cache, pyramid_key, level, col, row)
+    path = cache.get(key)
+    if path:
+        return path
+    with file_lock(cache.get_lock_path(cache.get_key(_get_level_key(pyramid_key, level)))):
+        # Another process may have rendered the level while we waited
+        path = cache.get(key)
+        if not path:
+            render_level(name, level, storage=storage)
+            path = cache.get(key)
+    return path
+
+
+def render_level(name, level, storage=None):
+    """
+    Render every tile of one level of the pyramid of the original `name`
+    into the tile cache.
+    """
+    cache = get_tile_cache()
+    original = cropduster_storage.open_image(name, storage, decoded=True)
+    extension = get_tile_format(original)
+    format = 'PNG' if extension == 'png' else 'JPEG'
+    pyramid_key = _get_pyramid_key(name, extension)
+    (w, h) = get_levels(original.size)[level]
+    info = dict(original.info)
+
+    with admission.admit(original, draft_scale=min(1, w / original.size[0])) as reservation:
+        if reservation.degraded and not is_decoded(original):
+            original.draft(original.mode, (w, h))
+        original.load()
+        cropduster_storage.cache_decoded_image(original)
+        im = original
+        if im.size != (w, h):
+            im = im.resize((w, h), PIL.Image.ANTIALIAS)
+        tile_size = cropduster_settings.CROPDUSTER_TILE_SIZE
+        for row in range(int(math.ceil(h / tile_size))):
+            for col in range(int(math.ceil(w / tile_size))):
+                tile = convert_for_format(
+                    crop_image(im, get_tile_box((w, h), col, row)), format)
+
+                def write(f, tile=tile):
+                    save_image(tile, f, format=format, size_name='_tile', info=info,
+                        draft=True)
+
+                cache.fill(_get_tile_key(cache, pyramid_key, level, col, row), write,
+                    evict=False)
+    cache.evict()
@@ -0,0 +1,132 @@
+"""
+Signed URLs for crops rendered at arbitrary widths, for responsive layouts::
+
+    /cropduster/t/<signature>/<image_id>/<crop_name>/w<width>.<ext>
+
+The crop box is taken from the image's Thumb named `crop_name`. Widths are
+rounded up to the nearest width in CROPDUSTER_TRANSFORM_WIDTHS, so that a
+small number of renders serve every layout, and the rendered files are kept
+in an LRU disk cache keyed by everything that determines their content.
+"""
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+from django.core.urlresolvers import reverse
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from cropduster.resizing import Crop
+from cropduster.utils.cache import DiskCache
+from cropduster.utils.formats import normalize_format, get_format_extension
+from cropduster.utils.image import get_alternate_filename
+from cropduster import settings as cropduster_settings
+from cropduster import storage as cropduster_storage
+from cropduster import admission
+
+
+__all__ = (
+    'quantize_width', 'get_signature', 'check_signature', 'get_transform_url',
+    'get_transform_cache', 'get_transform_file')
+
+
+def quantize_width(width, widths=None):
+    """Round `width` up to the nearest width in the ladder."""
+    widths = sorted(widths or cropduster_settings.CROPDUSTER_TRANSFORM_WIDTHS)
+    for ladder_width in widths:
+        if ladder_width >= width:
+            return ladder_width
+    return widths[-1]
+
+
+def get_signature(image_id, crop_name, width, extension):
+    value = '%s/%s/%s/%s' % (image_id, crop_name, width, extension)
+    return salted_hmac('cropduster.transforms', value).hexdigest()[:20]
+
+
+def check_signature(signature, image_id, crop_name, width, extension):
+    return constant_time_compare(
+        signature, get_signature(image_id, crop_name, width, extension))
+
+
+def get_transform_url(image, crop_name, width, format=None):
+    """
+    The signed URL of the crop `crop_name` of `image` (a cropduster Image)
+    at `width` (rounded up to the width ladder), in `format` (defaulting to
+    the format of the original).
+    """
+    width = quantize_width(int(width))
+    extension = (get_format_extension(format) if format else image.extension).lstrip('.')
+    return reverse('cropduster-transform', kwargs={
+        'signature': get_signature(image.pk, crop_name, width, extension),
+        'image_id': image.pk,
+        'crop_name': crop_name,
+        'width': width,
+        'extension': extension,
+    })
+
+
+_transform_cache = None
+
+
+def get_transform_cache():
+    global _transform_cache
+    if _transform_cache is None:
+        _transform_cache = DiskCache(
+            cropduster_settings.CROPDUSTER_TRANSFORM_CACHE_DIR,
+            cropduster_settings.CROPDUSTER_TRANSFORM_CACHE_MAX_BYTES)
+    return _transform_cache
+
+
+def get_transform_file(thumb, width, format=None):
+    """
+    Return the path of `thumb`'s crop rendered `width` pixels wide (rounded
+    up to the width ladder), rendering it into the transform cache if it is
+    not already there. The crop is never scaled beyond the size of its crop
+    box.
+
+    Renders go through Crop.create_image(), as thumbs do, under admission
+    control (see cropduster.admission), which may raise
+    CropDusterAdmissionException.
+    """
+    image = thumb.image
+    crop_box = thumb.get_crop_box()
+    if crop_box is None:
+        return None
+    width = quantize_width(int(width))
+    source_format = normalize_format(image.extension)
+    format = normalize_format(format) or source_format
+
+    cache = get_transform_cache()
+    key = cache.get_key('%s|%s|%sx%s|%s|%s' % (
+        image.image.name, crop_box.as_tuple(), thumb.width, thumb.height, width, format))
+
+    def write(f):
+        original = cropduster_storage.open_image(image.image.name, image.image.storage,
+            decoded=True)
+        crop = Crop(crop_box, original)
+        if thumb.width and thumb.height:
+            crop = crop.best_fit(w=thumb.width, h=thumb.height)
+        box = crop.box
+        w = min(width, int(round(box.w)))
+        h = max(1, min(int(round(box.h * w / box.w)), int(box.h)))
+
+        with admission.admit(original, draft_scale=min(1, w / box.w)) as reservation:
+            original.shrink_on_load = reservation.degraded
+            temp_dir = tempfile.mkdtemp()
+            try:
+                # create_image() writes the source format, and any other
+                # format alongside it
+                path = os.path.join(temp_dir, 'transform%s' % get_format_extension(source_format))
+                crop.create_image(path, width=w, height=h, size_name=thumb.name,
+                    formats=[format] if format != source_format else None)
+                if format != source_format:
+                    path = get_alternate_filename(path, format)
+                with open(path, 'rb') as rendered:
+                    shutil.copyfileobj(rendered, f)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        cropduster_storage.cache_decoded_image(original)
+
+    return cache.get_or_fill(key, write)
@@ -8,5 +8,14 @@ urlpatterns = patterns('',
     url(r'^$', 'cropduster.views.index', name='cropduster-index'),
     url(r'^crop/', 'cropduster.views.crop', name='cropduster-crop'),
     url(r'^upload/', 'cropduster.views.upload', name='cropduster-upload'),
+    url(r'^image/(?P<image_id>\d+)/(?P<size_name>[^/.]+)(?:\.(?P<content_hash>[0-9a-f]{8}))?\.(?P<extension>\w+)$',
+        'cropduster.views.derivative', name='cropduster-derivative'),
+    url(r'^t/(?P<signature>[0-9a-f]+)/(?P<image_id>\d+)/(?P<crop_name>[^/.]+)/w(?P<width>\d+)\.(?P<extension>\w+)$',
+        'cropduster.views.transform', name='cropduster-transform'),
+    url(r'^tiles/(?P<signature>[0-9a-f]+)/(?P<name>.+)\.dzi$',
+        'cropduster.views.tiles_descriptor', name='cropduster-tiles-descriptor'),
+    url(r'^tiles/(?P<signature>[0-9a-f]+)/(?P<name>.+)_files/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)\.(?P<extension>jpg|png)$',
+        'cropduster.views.tile', name='cropduster-tile'),
+    url(r'^preview/(?P<name>.+)$', 'cropduster.views.preview', name='cropduster-preview'),
     url(r'^standalone/', 'cropduster.standalone.views.index', name='cropduster-standalone'),
 )
@@ -1,8 +1,8 @@
 from .image import (
     get_image_extension, is_transparent, exif_orientation,
     correct_colorspace, is_animated_gif, has_animated_gif_support, process_image,
-    smart_resize)
-from .paths import get_upload_foldername
+    save_image, smart_resize)
+from .paths import get_upload_foldername, clone_file, file_lock
 from .sizes import get_min_size
 from .thumbs import set_as_auto_crop, unset_as_auto_crop
 from . import jsonutils as json
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import mmap
+import errno
+import base64
+import struct
+import hashlib
+import uuid
+import threading
+from collections import OrderedDict
+
+import six
+
+import PIL.Image
+
+from .paths import file_lock
+from .image import get_decoded_bytes
+
+
+__all__ = ('DiskCache', 'DecodedImageCache', 'RawPixelCache')
+
+
+class DiskCache(object):
+    """
+    A bounded, least-recently-used cache of files on local disk, which can
+    be shared between processes.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers never see partial files. Filling an entry holds a lock on that
+    key, so that concurrent misses for the same key fetch it only once.
+    When the cache grows beyond `max_bytes`, the least recently used entries
+    (by mtime, which is bumped on every hit) are evicted, as are entries
+    unused for more than `max_age` seconds, if given.
+    """
+
+    def __init__(self, root, max_bytes, max_age=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def get_key(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return hashlib.sha1(value).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[0:2], key)
+
+    def get_lock_path(self, key=None):
+        return os.path.join(self.root, '.locks', key or '_cache')
+
+    def get(self, key):
+        """Return the path of the cached file for `key`, or None."""
+        path = self.get_path(key)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def fill(self, key, write, evict=True):
+        """
+        Create the entry for `key` by calling `write` with a file object
+        opened for writing, and return its path. Callers filling many
+        entries at once can pass evict=False, and call evict() once done.
+        """
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        temp_path = os.path.join(dirname, '.%s.%s' % (uuid.uuid4().hex[:8], key))
+        try:
+            with open(temp_path, 'wb') as f:
+                write(f)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        if evict:
+            self.evict()
+        return path
+
+    def get_or_fill(self, key, write):
+        path = self.get(key)
+        if path:
+            return path
+        with file_lock(self.get_lock_path(key)):
+            # Another process may have filled the entry while we waited
+            return self.get(key) or self.fill(key, write)
+
+    def evict(self):
+        """
+        Remove expired entries, then the least recently used entries until
+        under budget.
+        """
+        if not self.max_bytes and not self.max_age:
+            return
+        expires = time.time() - self.max_age if self.max_age else None
+        with file_lock(self.get_lock_path()):
+            entries = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                for filename in filenames:
+                    if filename.startswith('.'):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if expires is not None and stat.st_mtime < expires:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            if not self.max_bytes or total <= self.max_bytes:
+                return
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+class RawPixelCache(DiskCache):
+    """
+    A DiskCache of decoded images, stored as raw pixels which are mapped
+    into memory rather than read. Opening a cached image costs no decoding
+    and no copying: the pages holding its pixels are read from disk (or the
+    OS page cache, which processes share) only when they're accessed, so
+    cropping it only reads the rows the crop covers.
+
+    Each file is a small header (RAW_MAGIC, the length of a JSON object with
+    the image's mode, size, format and ICC profile, and the object) padded
+    to RAW_ALIGNMENT bytes, followed by the rows of pixels. Pillow can only
+    map images in some modes; RGB images are stored, and mapped, as RGBX,
+    so crops of them should be converted to RGB (see utils.image.crop_image).
+    """
+
+    RAW_MAGIC = b'CDRAW\x00\x01\x00'
+    RAW_ALIGNMENT = 4096
+
+    # The mode each supported image mode is stored and mapped in
+    RAW_MODES = {
+        'RGB': 'RGBX',
+        'RGBA': 'RGBA',
+        'L': 'L',
+        'CMYK': 'CMYK',
+        'I;16': 'I;16',
+    }
+    RAW_PIXEL_BYTES = {'RGBX': 4, 'RGBA': 4, 'L': 1, 'CMYK': 4, 'I;16': 2}
+
+    # The number of rows written at a time, so that filling an entry needs
+    # little more memory than the decoded image
+    STRIP_BYTES = 4 * 1024 * 1024
+
+    @classmethod
+    def is_supported(cls, im):
+        return im.mode in cls.RAW_MODES
+
+    def get_image(self, key):
+        """Return the cached image for `key`, mapped into memory, or None."""
+        path = self.get(key)
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # Evicted since, or truncated
+            return None
+        magic_len = len(self.RAW_MAGIC)
+        if mapped[:magic_len] != self.RAW_MAGIC:
+            return None
+        (header_len,) = struct.unpack('<I', mapped[magic_len:magic_len + 4])
+        header = json.loads(mapped[magic_len + 4:magic_len + 4 + header_len].decode('utf-8'))
+        (w, h) = header['size']
+        offset = header['offset']
+        if len(mapped) < offset + w * h * self.RAW_PIXEL_BYTES[header['rawmode']]:
+            return None
+
+        if six.PY2:
+            # Python 2's mmap only has the old-style buffer interface
+            pixels = buffer(mapped, offset)  # noqa: F821
+        else:
+            pixels = memoryview(mapped)[offset:]
+        im = PIL.Image.frombuffer(header['rawmode'], (w, h), pixels,
+            'raw', header['rawmode'], 0, 1)
+        im.format = header['format']
+        if header.get('icc_profile'):
+            im.info['icc_profile'] = base64.b64decode(header['icc_profile'].encode('ascii'))
+        # Keep the mapping open for as long as the image is
+        im._cropduster_mmap = mapped
+        return im
+
+    def put_image(self, key, im):
+        """Store the decoded image `im` as `key`, returning its path."""
+        rawmode = self.RAW_MODES[im.mode]
+        (w, h) = im.size
+        icc_profile = im.info.get('icc_profile')
+        header = {
+            'mode': im.mode,
+            'rawmode': rawmode,
+            'size': [w, h],
+            'format': im.format,
+            'icc_profile': base64.b64encode(icc_profile).decode('ascii') if icc_profile else None,
+        }
+        # Leave room in the header for the offset itself
+        header_len = len(self.RAW_MAGIC) + 4 + len(json.dumps(header)) + len(', "offset": ') + 20
+        header['offset'] = -(-header_len // self.RAW_ALIGNMENT) * self.RAW_ALIGNMENT
+        header_bytes = json.dumps(header).encode('utf-8')
+
+        strip = max(1, self.STRIP_BYTES // (w * self.RAW_PIXEL_BYTES[rawmode]))
+
+        def write(f):
+            f.write(self.RAW_MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\x00' * (header['offset'] - f.tell()))
+            for y in range(0, h, strip):
+                rows = im.crop((0, y, w, min(h, y + strip)))
+                f.write(rows.tobytes('raw', rawmode))
+
+        return self.fill(key, write)
+
+
+class DecodedImageCache(object):
+    """
+    A per-process, least-recently-used cache of decoded PIL images, bounded
+    by the total bytes of their pixels.
+
+    The cache never hands out the image it holds: get() returns a new image
+    object sharing its pixels, marked read-only, so that Pillow copies the
+    pixels before any operation which would modify them in place. Every
+    caller is free to set attributes on, crop, resize or even paste into the
+    image it gets, and only pays for a copy in the last case.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get_view(self, im):
+        view = im._new(im.im)
+        view.format = im.format
+        view.readonly = 1
+        if getattr(im, 'filename', None):
+            view.filename = im.filename
+        return view
+
+    def get(self, key):
+        with self.lock:
+            im = self.entries.pop(key, None)
+            if im is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move it to the most recently used end
+            self.entries[key] = im
+        return self._get_view(im)
+
+    def put(self, key, im):
+        """
+        Cache the decoded image `im`. Its pixels are shared with the cache
+        from then on, so `im` is marked read-only too.
+        """
+        nbytes = get_decoded_bytes(im)
+        if not self.max_bytes or nbytes > self.max_bytes:
+            return
+        im.readonly = 1
+        im = self._get_view(im)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total -= get_decoded_bytes(old)
+            self.entries[key] = im
+            self.total += nbytes
+            while self.total > self.max_bytes:
+                (evicted_key, evicted) = self.entries.popitem(last=False)
+                self.total -= get_decoded_bytes(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
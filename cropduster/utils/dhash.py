@@ -0,0 +1,55 @@
+"""
+Difference hashes (dHash) of images, which change little when an image is
+resized or re-encoded, so that near-duplicate uploads can be found by the
+Hamming distance between their hashes (see cropduster.duplicates).
+"""
+from __future__ import division
+
+from six.moves import xrange
+
+import PIL.Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ('get_dhash', 'hamming_distance')
+
+
+HASH_SIZE = 8
+
+
+def get_dhash(im, hash_size=HASH_SIZE):
+    """
+    Return the dHash of PIL image `im` as a hex string of hash_size ** 2 bits:
+    one bit per pair of horizontally adjacent pixels in a greyscale
+    (hash_size + 1) x hash_size thumbnail, set where brightness increases.
+
+    If `im` is a JPEG that has not been loaded yet, it is draft-decoded, in
+    greyscale and at a fraction of its size, as only a few pixels are needed.
+    """
+    # The draft size is a lower bound; stay well above the thumbnail size so
+    # that the decoder's reduction doesn't alias. A no-op for loaded images.
+    im.draft('L', (hash_size * 8, hash_size * 8))
+    im = im.convert('L').resize((hash_size + 1, hash_size), PIL.Image.ANTIALIAS)
+
+    if numpy is not None:
+        pixels = numpy.asarray(im, dtype=numpy.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        value = int(''.join('1' if b else '0' for b in bits), 2)
+    else:
+        pixels = list(im.getdata())
+        width = hash_size + 1
+        value = 0
+        for y in xrange(hash_size):
+            for x in xrange(hash_size):
+                left = pixels[y * width + x]
+                value = (value << 1) | int(pixels[y * width + x + 1] > left)
+    return '%0*x' % (hash_size ** 2 // 4, value)
+
+
+def hamming_distance(a, b):
+    """The number of bits in which the hex hashes `a` and `b` differ."""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
@@ -0,0 +1,196 @@
+from __future__ import division
+
+import io
+import re
+import time
+
+import PIL.Image
+
+
+__all__ = (
+    'normalize_format', 'get_format_extension', 'get_format_mimetype',
+    'is_format_supported', 'get_supported_formats', 'select_format',
+    'format_report')
+
+
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG':  '.png',
+    'GIF':  '.gif',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+
+FORMAT_MIMETYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG':  'image/png',
+    'GIF':  'image/gif',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+FORMAT_ALIASES = {
+    'JPG': 'JPEG',
+}
+
+# Modern formats in the order they should be preferred when the client
+# accepts more than one of them
+FORMAT_PREFERENCE = ('AVIF', 'WEBP')
+
+# Image modes which can be written by each format without conversion
+FORMAT_MODES = {
+    'JPEG': ('L', 'RGB', 'CMYK'),
+    'WEBP': ('RGB', 'RGBA'),
+    'AVIF': ('RGB', 'RGBA'),
+}
+
+
+def normalize_format(format):
+    """Return the PIL format name for a format name or file extension."""
+    if not format:
+        return None
+    format = format.lstrip('.').upper()
+    return FORMAT_ALIASES.get(format, format)
+
+
+def get_format_extension(format):
+    format = normalize_format(format)
+    return FORMAT_EXTENSIONS.get(format) or '.%s' % format.lower()
+
+
+def get_format_mimetype(format):
+    format = normalize_format(format)
+    return FORMAT_MIMETYPES.get(format) or 'image/%s' % format.lower()
+
+
+def is_format_supported(format):
+    """
+    Check whether the installed Pillow build can encode the given format.
+    """
+    format = normalize_format(format)
+    PIL.Image.init()
+    if format == 'AVIF' and format not in PIL.Image.SAVE:
+        # AVIF support for Pillow < 11.2 is provided by a plugin
+        try:
+            import pillow_avif  # noqa
+        except ImportError:
+            pass
+    return format in PIL.Image.SAVE
+
+
+def get_supported_formats(formats):
+    """Filter a list of format names down to those Pillow can write."""
+    seen = set()
+    supported = []
+    for format in (formats or []):
+        format = normalize_format(format)
+        if format in seen:
+            continue
+        seen.add(format)
+        if is_format_supported(format):
+            supported.append(format)
+    return supported
+
+
+def convert_for_format(im, format):
+    """
+    Convert an image into a mode that can be saved in the given format,
+    keeping the alpha channel where the format supports one.
+    """
+    from .image import is_transparent
+
+    modes = FORMAT_MODES.get(normalize_format(format))
+    if not modes or im.mode in modes:
+        return im
+    if is_transparent(im) and 'RGBA' in modes:
+        return im.convert('RGBA')
+    return im.convert('RGB')
+
+
+def parse_accept(accept):
+    """
+    Parse an HTTP Accept header into a dict mapping media types to their
+    quality values.
+    """
+    accepted = {}
+    for part in (accept or '').split(','):
+        params = [p.strip() for p in part.split(';')]
+        media_type = params.pop(0).lower()
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            match = re.match(r'^q=([0-9.]+)$', param)
+            if match:
+                try:
+                    q = float(match.group(1))
+                except ValueError:
+                    q = 0.0
+        accepted[media_type] = max(q, accepted.get(media_type, 0.0))
+    return accepted
+
+
+def select_format(accept, formats, default=None):
+    """
+    Pick the best format for a client from those available for a derivative.
+
+    accept
+        The value of the request's ``Accept`` header.
+    formats
+        The alternate formats that have been rendered for the derivative.
+    default
+        The format returned when the client does not explicitly accept any
+        of the alternate formats (typically the source format).
+
+    Wildcards are ignored, since browsers send ``*/*`` regardless of whether
+    they can decode WebP or AVIF. Responses that vary on this choice should
+    be sent with ``Vary: Accept``.
+    """
+    accepted = parse_accept(accept)
+    available = set(normalize_format(f) for f in (formats or []))
+    for format in FORMAT_PREFERENCE:
+        if format in available and accepted.get(get_format_mimetype(format), 0) > 0:
+            return format
+    return normalize_format(default)
+
+
+def format_report(im, formats=None, save_params=None):
+    """
+    Encode an image in several formats and report the encoded size and
+    encoding time of each, relative to JPEG. Useful for comparing the
+    trade-offs of alternate formats against a representative image::
+
+        >>> for row in format_report(PIL.Image.open(path), ['WEBP', 'AVIF']):
+        ...     print('%(format)s: %(bytes)d bytes (%(ratio).2f), %(time).1fms' % row)
+
+    Each format is encoded with its registered encoder profile, overridden
+    by any kwargs in `save_params` (a dict keyed by format name). Formats
+    that the installed Pillow build cannot write are omitted.
+    """
+    from .profiles import get_save_params
+
+    formats = get_supported_formats(['JPEG'] + list(formats or ['WEBP', 'AVIF']))
+    save_params = save_params or {}
+    (w, h) = im.size
+    im.load()
+
+    rows = []
+    for format in formats:
+        params = get_save_params(format, width=w, height=h, info=im.info)
+        params.update(save_params.get(format) or {})
+        converted = convert_for_format(im, format)
+        buf = io.BytesIO()
+        start = time.time()
+        converted.save(buf, format=format, **params)
+        elapsed = (time.time() - start) * 1000
+        rows.append({
+            'format': format,
+            'bytes': len(buf.getvalue()),
+            'time': elapsed,
+        })
+
+    jpeg_row = rows[0]
+    for row in rows:
+        row['ratio'] = row['bytes'] / jpeg_row['bytes'] if jpeg_row['bytes'] else 0
+        row['time_ratio'] = row['time'] / jpeg_row['time'] if jpeg_row['time'] else 0
+    return rows
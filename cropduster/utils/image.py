@@ -5,6 +5,7 @@ import six
 from six.moves import xrange
 
 import os
+import uuid
 import tempfile
 import warnings
 import math
@@ -22,15 +23,15 @@ try:
 except ImportError:
     scipy = None
 
-from cropduster.settings import get_jpeg_quality, JPEG_SAVE_ICC_SUPPORTED
-
+from .formats import get_format_extension, get_supported_formats, convert_for_format
 from .images2gif import read_gif, write_gif
+from .profiles import get_save_params
 
 
 __all__ = (
     'get_image_extension', 'is_transparent', 'exif_orientation',
-    'correct_colorspace', 'is_animated_gif', 'has_animated_gif_support',
-    'process_image', 'smart_resize')
+    'correct_colorspace', 'get_decoded_bytes', 'crop_image', 'is_animated_gif',
+    'has_animated_gif_support', 'process_image', 'save_image', 'smart_resize')
 
 
 IMAGE_EXTENSIONS = {
@@ -78,20 +79,22 @@ def exif_orientation(im):
         exif = None
     if exif:
         orientation = exif.get(0x0112)
+        # Transposing, unlike rotate(), swaps the width and height of images
+        # turned by 90 degrees rather than cropping them
         if orientation == 2:
             im = im.transpose(PIL.Image.FLIP_LEFT_RIGHT)
         elif orientation == 3:
-            im = im.rotate(180)
+            im = im.transpose(PIL.Image.ROTATE_180)
         elif orientation == 4:
             im = im.transpose(PIL.Image.FLIP_TOP_BOTTOM)
         elif orientation == 5:
-            im = im.rotate(-90).transpose(PIL.Image.FLIP_LEFT_RIGHT)
+            im = im.transpose(PIL.Image.TRANSPOSE)
         elif orientation == 6:
-            im = im.rotate(-90)
+            im = im.transpose(PIL.Image.ROTATE_270)
         elif orientation == 7:
-            im = im.rotate(90).transpose(PIL.Image.FLIP_LEFT_RIGHT)
+            im = im.transpose(PIL.Image.TRANSVERSE)
         elif orientation == 8:
-            im = im.rotate(90)
+            im = im.transpose(PIL.Image.ROTATE_90)
     return im
 
 
@@ -116,6 +119,31 @@ def correct_colorspace(im, bw=False):
     return im.convert('RGB')
 
 
+# Bytes per band of modes which don't have 8-bit bands
+MODE_BAND_BYTES = {'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+
+def get_decoded_bytes(im, size=None):
+    """
+    The number of bytes of the pixels of `im` once decoded (at `size`, if
+    given), which only needs the image's header.
+    """
+    (w, h) = size or im.size
+    return w * h * len(im.getbands()) * MODE_BAND_BYTES.get(im.mode, 1)
+
+
+def crop_image(im, box):
+    """
+    Crop `im` to `box`. Originals mapped from the raw pixel cache (see
+    cropduster.utils.cache.RawPixelCache) are RGBX, so their crops are
+    converted to RGB, which every format can save.
+    """
+    im = im.crop(box)
+    if im.mode == 'RGBX':
+        im = im.convert('RGB')
+    return im
+
+
 def is_animated_gif(im):
     info = getattr(im, 'info', None) or {}
     return bool((im.format == 'GIF' or not im.format) and info.get('extension'))
@@ -125,7 +153,23 @@ def has_animated_gif_support():
     return bool(numpy and scipy)
 
 
-def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None):
+def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_params=None, formats=None,
+        size_name=None, draft=False):
+    """
+    Run `callback` over every frame of `im` and, if `save_filename` is given,
+    save the result in the source image's format.
+
+    formats
+        A list of alternate formats (e.g. ['WEBP', 'AVIF']) that are written
+        from the same processed pixels alongside `save_filename`, with the
+        file extension swapped for that of the format. Ignored for animated
+        gifs.
+    size_name
+        The name of the size being generated, used to look up the encoder
+        profile (see cropduster.utils.profiles).
+    draft
+        Encode with the cheap draft encoder profile.
+    """
     is_animated = is_animated_gif(im)
     images = [im]
 
@@ -174,20 +218,92 @@ def process_image(im, save_filename=None, callback=lambda i: i, nq=0, save_param
             repeat = True
             if im.info.get('loop', 0) != 0:
                 repeat = im.info['loop']
+            if os.path.exists(save_filename):
+                # Don't write through a hard link
+                os.unlink(save_filename)
             write_gif(save_filename, new_images, duration=duration, repeat=repeat, nq=nq, dispose=dispose)
         else:
-            save_params = save_params or {}
-            if im.format == 'JPEG':
-                save_params.setdefault('quality', get_jpeg_quality(new_images[0].size[0], new_images[0].size[1]))
-            if im.format in ('JPEG', 'PNG') and JPEG_SAVE_ICC_SUPPORTED:
-                save_params.setdefault('icc_profile', im.info.get('icc_profile'))
-            new_images[0].save(save_filename, **save_params)
+            save_image(new_images[0], save_filename, format=im.format, size_name=size_name,
+                info=im.info, save_params=save_params, draft=draft)
+            save_alternate_formats(im, new_images[0], save_filename, formats,
+                size_name=size_name, draft=draft)
 
-        return PIL.Image.open(save_filename)
+        saved_image = PIL.Image.open(save_filename)
+        # The processed pixels, which are still in memory, so that callers
+        # which need them don't have to decode the saved file
+        saved_image.processed = new_images[0] if len(new_images) == 1 else None
+        return saved_image
 
     return new_images[0]
 
 
+def get_alternate_filename(filename, format):
+    return os.path.splitext(filename)[0] + get_format_extension(format)
+
+
+def save_image(im, filename, format=None, size_name=None, info=None, save_params=None, draft=False):
+    """
+    Save an image using the encoder profile registered for its format, size
+    name and dimensions. This is the single place where derivatives are
+    encoded, so that the profile registry applies uniformly to previews,
+    thumbs, tmp thumbs and standalone crops.
+
+    info
+        The `info` dict of the source image, from which the ICC profile is
+        copied unless the profile strips metadata.
+    save_params
+        Explicit save() kwargs, which take precedence over the profile.
+    draft
+        Use the draft profile, trading quality and size for encode speed.
+    """
+    format = format or im.format
+    (w, h) = im.size
+    params = get_save_params(format, size_name=size_name, width=w, height=h,
+        info=info if info is not None else im.info, draft=draft)
+    params.update(save_params or {})
+    # Encoders such as Pillow's WebP plugin read metadata kwargs with a
+    # default of '' and fail on an explicit None (e.g. icc_profile=None)
+    params = dict((k, v) for (k, v) in six.iteritems(params) if v is not None)
+    if format:
+        params['format'] = format
+
+    if not isinstance(filename, six.string_types):
+        # A file-like object
+        im.save(filename, **params)
+        return
+
+    # Write to a temporary file and rename it into place, so that readers
+    # never see a partially written file, and so that a derivative which is
+    # a hard link to another file (see cropduster.utils.paths.clone_file)
+    # is replaced rather than written through.
+    dirname, basename = os.path.split(filename)
+    temp_filename = os.path.join(dirname, '.%s.%s' % (uuid.uuid4().hex[:8], basename))
+    try:
+        im.save(temp_filename, **params)
+        os.rename(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        raise
+
+
+def save_alternate_formats(orig_im, im, save_filename, formats, size_name=None, draft=False):
+    """
+    Save the processed image `im` in each of `formats` next to
+    `save_filename`. Returns a dict of format name to file path.
+    """
+    paths = {}
+    for format in get_supported_formats(formats):
+        if format == orig_im.format:
+            continue
+        alt_filename = get_alternate_filename(save_filename, format)
+        alt_im = convert_for_format(im, format)
+        save_image(alt_im, alt_filename, format=format, size_name=size_name, info=orig_im.info,
+            draft=draft)
+        paths[format] = alt_filename
+    return paths
+
+
 def smart_resize(im, final_w, final_h):
     """
     Resizes a given image in multiple steps to ensure maximum quality and performance
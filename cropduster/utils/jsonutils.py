@@ -38,7 +38,8 @@ def object_hook(dct):
             max_h=dct.get('max_h'),
             retina=dct.get('retina'),
             auto=dct.get('auto'),
-            required=dct.get('required'))
+            required=dct.get('required'),
+            formats=dct.get('formats'))
     return dct
 
 
@@ -0,0 +1,140 @@
+"""
+Normalization of originals at upload, so that renders never have to rotate
+or convert them:
+
+* With CROPDUSTER_NORMALIZE_ORIENTATION, the rotation and/or flip that the
+  EXIF orientation tag asks for is applied to the pixels, and the tag reset.
+* With CROPDUSTER_NORMALIZE_COLORSPACE, images in modes other than those of
+  NORMALIZED_MODES (e.g. CMYK or 16-bit) are converted to RGB, or RGBA if
+  they have an alpha band. CMYK images with an ICC profile are converted
+  through it to sRGB, where Pillow has ImageCms.
+
+Originals which need neither are left untouched. The others are re-encoded
+in place, JPEGs at CROPDUSTER_NORMALIZE_JPEG_QUALITY.
+"""
+import six
+
+import PIL.Image
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
+
+from cropduster import settings as cropduster_settings
+
+from .image import exif_orientation, correct_colorspace, is_animated_gif, save_image
+
+
+__all__ = (
+    'get_exif_orientation', 'get_normalized_size', 'needs_normalization',
+    'normalize_image', 'normalize_original')
+
+
+# The modes which originals are left in
+NORMALIZED_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+
+# EXIF orientations which swap the width and height of the image
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def get_exif_orientation(im):
+    """The EXIF orientation of `im` (1 to 8), read from its header, or None."""
+    try:
+        exif = im._getexif()
+    except (AttributeError, IndexError, KeyError, IOError):
+        exif = None
+    return (exif or {}).get(EXIF_ORIENTATION_TAG)
+
+
+def _get_options(orientation, colorspace):
+    if orientation is None:
+        orientation = cropduster_settings.CROPDUSTER_NORMALIZE_ORIENTATION
+    if colorspace is None:
+        colorspace = cropduster_settings.CROPDUSTER_NORMALIZE_COLORSPACE
+    return (orientation, colorspace)
+
+
+def get_normalized_size(im, orientation=None):
+    """The (width, height) of `im` once normalized, from its header."""
+    (orientation, _) = _get_options(orientation, False)
+    (w, h) = im.size
+    if orientation and get_exif_orientation(im) in TRANSPOSING_ORIENTATIONS:
+        return (h, w)
+    return (w, h)
+
+
+def needs_normalization(im, orientation=None, colorspace=None):
+    """Whether normalize_image() would change `im`, from its header."""
+    (orientation, colorspace) = _get_options(orientation, colorspace)
+    if is_animated_gif(im):
+        return False
+    if orientation and get_exif_orientation(im) not in (None, 1):
+        return True
+    return bool(colorspace and im.mode not in NORMALIZED_MODES)
+
+
+def _convert_colorspace(im):
+    icc_profile = im.info.get('icc_profile')
+    if im.mode == 'CMYK' and icc_profile and ImageCms is not None:
+        try:
+            converted = ImageCms.profileToProfile(im,
+                ImageCms.ImageCmsProfile(six.BytesIO(icc_profile)),
+                ImageCms.createProfile('sRGB'), outputMode='RGB')
+        except (ImageCms.PyCMSError, IOError, ValueError):
+            pass
+        else:
+            if converted is not None:
+                return converted
+    if 'A' in im.getbands():
+        return im.convert('RGBA')
+    return correct_colorspace(im)
+
+
+def normalize_image(im, orientation=None, colorspace=None):
+    """
+    Return `im` with its EXIF orientation applied and/or converted to RGB,
+    and the `info` to save it with.
+    """
+    (orientation, colorspace) = _get_options(orientation, colorspace)
+    info = dict(im.info)
+    exif_value = get_exif_orientation(im)
+    if orientation and exif_value not in (None, 1):
+        exif = im.getexif() if hasattr(im, 'getexif') else None
+        im = exif_orientation(im)
+        if exif is not None:
+            exif[EXIF_ORIENTATION_TAG] = 1
+            info['exif'] = exif.tobytes()
+        else:
+            # Pillow < 6 can't rewrite EXIF data, so drop it rather than
+            # have the tag rotate the image a second time
+            info.pop('exif', None)
+    if colorspace and im.mode not in NORMALIZED_MODES:
+        converted = _convert_colorspace(im)
+        if converted.mode != im.mode:
+            # The profile described the pixels before conversion
+            info.pop('icc_profile', None)
+        im = converted
+    return (im, info)
+
+
+def normalize_original(path, orientation=None, colorspace=None):
+    """
+    Normalize the original at `path` in place. Returns whether the file was
+    rewritten.
+    """
+    im = PIL.Image.open(path)
+    if not needs_normalization(im, orientation=orientation, colorspace=colorspace):
+        return False
+    format = im.format
+    (im, info) = normalize_image(im, orientation=orientation, colorspace=colorspace)
+    save_params = {}
+    if info.get('exif'):
+        save_params['exif'] = info['exif']
+    if format == 'JPEG':
+        save_params['quality'] = cropduster_settings.CROPDUSTER_NORMALIZE_JPEG_QUALITY
+    save_image(im, path, format=format, size_name='original', info=info,
+        save_params=save_params)
+    return True
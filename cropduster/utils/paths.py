@@ -4,18 +4,65 @@ import six
 
 import os
 import re
+import errno
+import hashlib
+import shutil
+import uuid
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.db.models.fields.files import FileField
 
+try:
+    from django.utils.encoding import force_bytes
+except ImportError:
+    from django.utils.encoding import smart_str as force_bytes
 
-__all__ = ('get_upload_foldername')
+from cropduster.settings import (
+    CROPDUSTER_CLONE_METHODS, CROPDUSTER_UPLOAD_FOLDER_STRATEGY,
+    CROPDUSTER_UPLOAD_FOLDER_SHARDING)
+
+
+__all__ = ('get_upload_foldername', 'clone_file', 'file_lock')
 
 
 MEDIA_ROOT = os.path.abspath(settings.MEDIA_ROOT)
 
 
-def get_upload_foldername(file_name, upload_to='%Y/%m'):
+def get_upload_foldername(file_name, upload_to='%Y/%m', content_hash=None, strategy=None,
+        shard=None):
+    """
+    Create, and return the absolute path of, a new empty directory for an
+    upload named `file_name`.
+
+    strategy
+        How the directory is made unique (defaults to
+        CROPDUSTER_UPLOAD_FOLDER_STRATEGY):
+
+        'sequential'
+            ``<name>``, then ``<name>-1``, ``<name>-2``, etc. Allocation
+            time grows with the number of uploads sharing a name.
+        'random'
+            ``<name>-<random hex>``
+        'hash'
+            ``<name>-<content_hash>``, falling back to a random suffix if
+            `content_hash` is not given or the directory already exists
+            (i.e. the same file was uploaded under the same name before).
+    shard
+        Nest the directory under two levels of fan-out taken from its suffix
+        (``<upload_to>/ab/cd/<name>-abcd...``), so that no single directory
+        grows without bound. Defaults to CROPDUSTER_UPLOAD_FOLDER_SHARDING.
+
+    Directories are claimed with an atomic mkdir, so concurrent uploads of
+    the same file name never end up sharing a directory.
+    """
+    if strategy is None:
+        strategy = CROPDUSTER_UPLOAD_FOLDER_STRATEGY
+    if shard is None:
+        shard = CROPDUSTER_UPLOAD_FOLDER_SHARDING
+    if strategy not in ('sequential', 'random', 'hash'):
+        raise ValueError("Unknown upload folder strategy %r" % strategy)
+
     # Generate date based path to put uploaded file.
     file_field = FileField(upload_to=upload_to)
     if not file_name:
@@ -23,17 +70,132 @@ def get_upload_foldername(file_name, upload_to='%Y/%m'):
     filename = file_field.generate_filename(None, file_name)
     filename = re.sub(r'[_\-]+', '_', filename)
 
-    if six.PY2 and isinstance(filename, unicode):
-        filename = filename.encode('utf-8')
-
     root_dir = os.path.splitext(filename)[0]
-    root_dir = dir_name = os.path.join(settings.MEDIA_ROOT, root_dir)
-    i = 1
-    while os.path.exists(dir_name):
-        if six.PY2:
-            dir_name = b'%s-%d' % (root_dir, i)
+    (parent_dir, name) = os.path.split(os.path.join(settings.MEDIA_ROOT, root_dir))
+
+    def get_suffixes():
+        if strategy == 'sequential':
+            yield None
+            i = 1
+            while True:
+                yield '%d' % i
+                i += 1
+        if strategy == 'hash' and content_hash:
+            yield content_hash[:16]
+        for i in six.moves.xrange(100):
+            yield uuid.uuid4().hex[:12]
+
+    for suffix in get_suffixes():
+        dir_name = name if suffix is None else '%s-%s' % (name, suffix)
+        if shard:
+            token = suffix if strategy != 'sequential' else None
+            token = token or hashlib.md5(force_bytes(dir_name)).hexdigest()
+            dir_name = os.path.join(token[0:2], token[2:4], dir_name)
+        dir_name = os.path.join(parent_dir, dir_name)
+        if six.PY2 and isinstance(dir_name, unicode):
+            dir_name = dir_name.encode('utf-8')
+
+        try:
+            os.makedirs(os.path.dirname(dir_name))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.mkdir(dir_name)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
         else:
-            dir_name = '%s-%d' % (root_dir, i)
-        i += 1
-    os.makedirs(dir_name)
-    return dir_name
+            return dir_name
+
+    raise OSError(errno.EEXIST, "Could not allocate an upload folder for %s" % file_name)
+
+
+# ioctl request number for FICLONE on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    Create `dst` as a copy-on-write clone of `src`. Raises OSError if the
+    platform or filesystem does not support reflinks.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except IOError as e:
+                raise OSError(e.errno, e.strerror)
+
+
+def clone_file(src, dst, methods=None):
+    """
+    Make `dst` a copy of `src` as cheaply as the filesystem allows: a hard
+    link, then a copy-on-write reflink, falling back to a byte copy. `dst` is
+    replaced atomically if it already exists. Returns the method that was
+    used ('link', 'reflink' or 'copy').
+
+    Because a hard-linked `dst` shares its inode with `src`, it must only ever
+    be replaced (as cropduster.utils.image.save_image() does), never
+    written to in place.
+    """
+    if methods is None:
+        methods = CROPDUSTER_CLONE_METHODS
+    dirname, basename = os.path.split(dst)
+    temp_dst = os.path.join(dirname, '.%s.%s' % (uuid.uuid4().hex[:8], basename))
+
+    method = 'copy'
+    for clone_method in methods:
+        try:
+            if clone_method == 'link':
+                os.link(src, temp_dst)
+            elif clone_method == 'reflink':
+                reflink(src, temp_dst)
+            else:
+                continue
+        except (OSError, AttributeError):
+            if os.path.exists(temp_dst):
+                os.unlink(temp_dst)
+        else:
+            method = clone_method
+            break
+    else:
+        shutil.copy(src, temp_dst)
+
+    os.rename(temp_dst, dst)
+    return method
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    A context manager holding an advisory lock (flock) on the file at
+    `path`, which is created if it does not exist. Locks are held per open
+    file, so they exclude other threads as well as other processes. On
+    platforms without fcntl this is a no-op.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
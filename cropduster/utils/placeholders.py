@@ -0,0 +1,173 @@
+"""
+Low-quality image placeholders, computed from the pixels of a rendered crop
+so that pages can inline them while the crop itself is lazy-loaded:
+
+blurhash
+    A BlurHash (https://blurha.sh) string of a few dozen characters.
+lqip
+    A data URI of the crop scaled down to a few pixels across.
+dominant_color
+    The average colour of the crop, as '#rrggbb'.
+
+They are only computed with CROPDUSTER_PLACEHOLDERS, which is off by default.
+"""
+from __future__ import division
+
+import io
+import math
+import base64
+
+from six.moves import xrange
+
+import PIL.Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .formats import normalize_format, get_format_mimetype
+
+
+__all__ = ('get_blurhash', 'get_lqip', 'get_dominant_color', 'get_placeholders')
+
+
+BASE83_CHARS = (
+    '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~')
+
+# The BlurHash components are computed from a copy of the image no larger
+# than this; more pixels do not change the result noticeably.
+BLURHASH_SAMPLE_SIZE = 32
+
+
+def _base83(value, length):
+    return ''.join(
+        BASE83_CHARS[(value // (83 ** (length - i - 1))) % 83] for i in xrange(length))
+
+
+def _srgb_to_linear(value):
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * (v ** (1 / 2.4)) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exp):
+    return math.copysign(abs(value) ** exp, value)
+
+
+def _rgb_thumbnail(im, size):
+    im = im.convert('RGBA') if im.mode in ('P', 'LA') else im
+    if im.mode == 'RGBA':
+        # Flatten transparency onto white, as browsers show it on most pages
+        background = PIL.Image.new('RGB', im.size, (255, 255, 255))
+        background.paste(im, mask=im.split()[-1])
+        im = background
+    else:
+        im = im.convert('RGB')
+    im = im.copy()
+    im.thumbnail((size, size), PIL.Image.ANTIALIAS)
+    return im
+
+
+def _blurhash_factors(im, x_components, y_components):
+    """The BlurHash DCT factors of `im`, as a list of (r, g, b) tuples."""
+    width, height = im.size
+    if numpy is not None:
+        linear = numpy.asarray(im, dtype=numpy.float64) / 255
+        linear = numpy.where(
+            linear <= 0.04045, linear / 12.92, ((linear + 0.055) / 1.055) ** 2.4)
+        cos_x = numpy.cos(numpy.pi * numpy.outer(numpy.arange(x_components), numpy.arange(width)) / width)
+        cos_y = numpy.cos(numpy.pi * numpy.outer(numpy.arange(y_components), numpy.arange(height)) / height)
+        # factors[j, i, c] = sum over (y, x) of cos_y[j, y] * cos_x[i, x] * linear[y, x, c]
+        factors = numpy.einsum('jy,ix,yxc->jic', cos_y, cos_x, linear) / (width * height)
+        factors[1:, :, :] *= 2
+        factors[:, 1:, :] *= 2
+        factors[1:, 1:, :] /= 2
+        return [tuple(f) for f in factors.reshape(-1, 3).tolist()]
+
+    pixels = [tuple(_srgb_to_linear(c) for c in p) for p in im.getdata()]
+    factors = []
+    for j in xrange(y_components):
+        for i in xrange(x_components):
+            normalisation = 1 if i == j == 0 else 2
+            r = g = b = 0.0
+            for y in xrange(height):
+                cos_y = math.cos(math.pi * j * y / height)
+                for x in xrange(width):
+                    basis = cos_y * math.cos(math.pi * i * x / width)
+                    pr, pg, pb = pixels[y * width + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = normalisation / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+    return factors
+
+
+def get_blurhash(im, x_components=4, y_components=3):
+    """Return the BlurHash string of PIL image `im`."""
+    im = _rgb_thumbnail(im, BLURHASH_SAMPLE_SIZE)
+    factors = _blurhash_factors(im, x_components, y_components)
+    dc, ac = factors[0], factors[1:]
+
+    blurhash = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = int(max(0, min(82, math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    blurhash += _base83(quantised_max, 1)
+
+    r, g, b = [_linear_to_srgb(c) for c in dc]
+    blurhash += _base83((r << 16) + (g << 8) + b, 4)
+
+    for factor in ac:
+        qr, qg, qb = [
+            int(max(0, min(18, math.floor(_sign_pow(c / max_value, 0.5) * 9 + 9.5))))
+            for c in factor]
+        blurhash += _base83(qr * 19 * 19 + qg * 19 + qb, 2)
+    return blurhash
+
+
+def get_lqip(im, size=20, format='JPEG'):
+    """
+    Return a data URI of `im` scaled to fit within `size` x `size` pixels,
+    encoded as `format`.
+    """
+    format = normalize_format(format)
+    im = _rgb_thumbnail(im, size)
+    buf = io.BytesIO()
+    im.save(buf, format=format, quality=40)
+    return 'data:%s;base64,%s' % (
+        get_format_mimetype(format), base64.b64encode(buf.getvalue()).decode('ascii'))
+
+
+def get_dominant_color(im):
+    """Return the average colour of `im`, as '#rrggbb'."""
+    im = _rgb_thumbnail(im, BLURHASH_SAMPLE_SIZE)
+    if numpy is not None:
+        r, g, b = numpy.asarray(im, dtype=numpy.float64).reshape(-1, 3).mean(axis=0)
+    else:
+        pixels = list(im.getdata())
+        r, g, b = [sum(p[c] for p in pixels) / len(pixels) for c in xrange(3)]
+    return '#%02x%02x%02x' % (int(round(r)), int(round(g)), int(round(b)))
+
+
+def get_placeholders(im, lqip_size=20, lqip_format='JPEG'):
+    """
+    Return a dict of the `blurhash`, `lqip` and `dominant_color`
+    placeholders of `im`.
+    """
+    return {
+        'blurhash': get_blurhash(im),
+        'lqip': get_lqip(im, size=lqip_size, format=lqip_format),
+        'dominant_color': get_dominant_color(im),
+    }
@@ -0,0 +1,212 @@
+from __future__ import division
+
+import six
+
+from .formats import normalize_format
+
+
+__all__ = (
+    'EncoderProfile', 'EncoderProfileRegistry', 'registry', 'register_profile',
+    'get_profile', 'get_save_params', 'DRAFT_PROFILES')
+
+
+class EncoderProfile(object):
+    """
+    A set of encoder settings. Attributes left as None are inherited from
+    less specific profiles (see `EncoderProfileRegistry.get_profile`), and
+    are otherwise left to Pillow's defaults.
+
+    quality
+        An int, or a callable taking (width, height) and returning an int.
+        Used by JPEG, WebP and AVIF.
+    progressive, optimize
+        JPEG flags; `optimize` is also passed to PNG.
+    subsampling
+        JPEG chroma subsampling: 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0).
+    compress_level
+        PNG zlib compression level, 0-9.
+    method
+        WebP encoder effort, 0 (fast) - 6 (slow).
+    speed
+        AVIF encoder speed, 0 (slow) - 10 (fast).
+    strip_metadata
+        Do not copy the ICC profile of the source image onto the output.
+    """
+
+    attrs = (
+        'quality', 'progressive', 'optimize', 'subsampling', 'compress_level',
+        'method', 'speed', 'strip_metadata')
+
+    def __init__(self, **kwargs):
+        for attr in self.attrs:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError("Unexpected EncoderProfile kwargs: %s" % ", ".join(kwargs))
+
+    def __repr__(self):
+        values = ["%s=%r" % (a, getattr(self, a)) for a in self.attrs
+                  if getattr(self, a) is not None]
+        return "<EncoderProfile: %s>" % ", ".join(values)
+
+    def merge(self, other):
+        """Return a new profile with the non-None values of `other` applied."""
+        merged = EncoderProfile(**dict([(a, getattr(self, a)) for a in self.attrs]))
+        for attr in self.attrs:
+            value = getattr(other, attr)
+            if value is not None:
+                setattr(merged, attr, value)
+        return merged
+
+    def get_save_params(self, format, width, height, info=None):
+        """Return the kwargs for PIL.Image.Image.save()"""
+        from cropduster.settings import JPEG_SAVE_ICC_SUPPORTED
+
+        format = normalize_format(format)
+        params = {}
+
+        quality = self.quality
+        if six.callable(quality):
+            quality = quality(width, height)
+
+        if format == 'JPEG':
+            if quality is not None:
+                params['quality'] = quality
+            if self.progressive:
+                params['progressive'] = True
+            if self.optimize:
+                params['optimize'] = True
+            if self.subsampling is not None:
+                params['subsampling'] = self.subsampling
+        elif format == 'PNG':
+            if self.compress_level is not None:
+                params['compress_level'] = self.compress_level
+            if self.optimize:
+                params['optimize'] = True
+        elif format == 'WEBP':
+            if quality is not None:
+                params['quality'] = quality
+            if self.method is not None:
+                params['method'] = self.method
+        elif format == 'AVIF':
+            if quality is not None:
+                params['quality'] = quality
+            if self.speed is not None:
+                params['speed'] = self.speed
+
+        icc_formats = ('JPEG', 'PNG', 'WEBP', 'AVIF')
+        if format in icc_formats and JPEG_SAVE_ICC_SUPPORTED and not self.strip_metadata:
+            icc_profile = (info or {}).get('icc_profile')
+            if icc_profile:
+                params['icc_profile'] = icc_profile
+        return params
+
+
+class EncoderProfileRegistry(object):
+    """
+    Maps (format, size name, output dimensions) to an `EncoderProfile`.
+
+    Every registered profile whose conditions match a lookup is applied in
+    the order it was registered, so general profiles should be registered
+    before more specific ones::
+
+        registry.register(EncoderProfile(progressive=True), format='JPEG')
+        registry.register(EncoderProfile(quality=70), size_name='thumb')
+        registry.register(EncoderProfile(compress_level=9), format='PNG',
+                          max_pixels=200 * 200)
+    """
+
+    def __init__(self):
+        self.rules = []
+
+    def register(self, profile, format=None, size_name=None, min_pixels=None, max_pixels=None,
+            draft=None):
+        """
+        draft
+            If True, the profile only applies to draft encodes (the `_tmp`
+            files rendered while a crop is being edited); if False, it only
+            applies to final encodes. Draft profiles are applied after all
+            others, regardless of the order in which they were registered.
+        """
+        if isinstance(profile, dict):
+            profile = EncoderProfile(**profile)
+        self.rules.append({
+            'profile': profile,
+            'format': normalize_format(format),
+            'size_name': size_name,
+            'min_pixels': min_pixels,
+            'max_pixels': max_pixels,
+            'draft': draft,
+        })
+        return profile
+
+    def clear(self):
+        self.rules = []
+
+    def matches(self, rule, format, size_name, width, height):
+        if rule['format'] and rule['format'] != format:
+            return False
+        if rule['size_name'] and rule['size_name'] != size_name:
+            return False
+        pixels = (width or 0) * (height or 0)
+        if rule['min_pixels'] is not None and pixels < rule['min_pixels']:
+            return False
+        if rule['max_pixels'] is not None and pixels > rule['max_pixels']:
+            return False
+        return True
+
+    def get_profile(self, format, size_name=None, width=None, height=None, draft=False):
+        format = normalize_format(format)
+        profile = EncoderProfile()
+        rules = [r for r in self.rules if r['draft'] is None or r['draft'] is bool(draft)]
+        # Sort draft-only rules last (sorted() is stable)
+        rules = sorted(rules, key=lambda r: r['draft'] is True)
+        for rule in rules:
+            if self.matches(rule, format, size_name, width, height):
+                profile = profile.merge(rule['profile'])
+        return profile
+
+
+# Cheap encoder settings used for drafts, which are discarded or re-encoded
+# once the crop is saved.
+DRAFT_PROFILES = {
+    'JPEG': EncoderProfile(quality=75, progressive=False, optimize=False, subsampling=2),
+    'PNG': EncoderProfile(compress_level=1, optimize=False),
+    'WEBP': EncoderProfile(quality=75, method=0),
+    'AVIF': EncoderProfile(quality=60, speed=10),
+}
+
+
+def get_default_registry():
+    from cropduster.settings import get_jpeg_quality, CROPDUSTER_ENCODER_PROFILES
+
+    default_registry = EncoderProfileRegistry()
+    for format in ('JPEG', 'WEBP', 'AVIF'):
+        default_registry.register(EncoderProfile(quality=get_jpeg_quality), format=format)
+    for format, profile in six.iteritems(DRAFT_PROFILES):
+        default_registry.register(profile, format=format, draft=True)
+    for profile_kwargs in CROPDUSTER_ENCODER_PROFILES:
+        profile_kwargs = dict(profile_kwargs)
+        conditions = dict([
+            (k, profile_kwargs.pop(k, None))
+            for k in ('format', 'size_name', 'min_pixels', 'max_pixels', 'draft')])
+        default_registry.register(EncoderProfile(**profile_kwargs), **conditions)
+    return default_registry
+
+
+registry = get_default_registry()
+
+
+def register_profile(profile, format=None, size_name=None, min_pixels=None, max_pixels=None,
+        draft=None):
+    return registry.register(profile, format=format, size_name=size_name,
+        min_pixels=min_pixels, max_pixels=max_pixels, draft=draft)
+
+
+def get_profile(format, size_name=None, width=None, height=None, draft=False):
+    return registry.get_profile(format, size_name=size_name, width=width, height=height,
+        draft=draft)
+
+
+def get_save_params(format, size_name=None, width=None, height=None, info=None, draft=False):
+    profile = get_profile(format, size_name=size_name, width=width, height=height, draft=draft)
+    return profile.get_save_params(format, width, height, info=info)
@@ -0,0 +1,178 @@
+"""
+Region-of-interest decoding: decoding only the part of an original that a
+crop needs, so that the memory and time a crop of a very large image takes
+scale with the crop rather than with the original.
+
+How much of the original can be skipped depends on its format and layout:
+
+* TIFFs (and other formats) stored as several independently encoded tiles
+  or strips: only the tiles which intersect the box are decoded.
+* Uncompressed images stored as one block of rows: only the rows of the box
+  are read, from their offset in the file.
+* Non-interlaced PNGs, which are compressed as one stream of rows: decoding
+  stops after the last row of the box.
+* JPEGs: when the crop is to be downscaled, the image is decoded in draft
+  mode at the smallest DCT scale (1/2, 1/4 or 1/8) that is still at least as
+  large as needed, and the box is scaled to match.
+
+Anything else (and TIFFs which Pillow decodes as a whole with libtiff) is
+decoded in full.
+"""
+from __future__ import division
+
+import math
+
+import PIL.Image
+
+from .image import MODE_BAND_BYTES
+
+
+__all__ = ('decode_region', 'is_decoded')
+
+
+# Decoders which decode each tile independently of the others
+TILE_DECODERS = ('raw', 'packbits')
+
+
+def is_decoded(im):
+    """
+    Whether the pixels of `im` are in memory. Image files have tiles left
+    to decode until they are loaded.
+    """
+    return not getattr(im, 'tile', None)
+
+
+def decode_region(path, box, scale=1):
+    """
+    Decode the `box` (x1, y1, x2, y2) of the image at `path`, which is to be
+    resized by `scale` once cropped.
+
+    Returns a tuple (im, region_box), where `im` is the decoded region, with
+    the format and info of the original, and `region_box` is the box to crop
+    from it (scaled, if the region was decoded at a reduced scale); or None
+    if the format of the image doesn't allow decoding it in part.
+    """
+    im = PIL.Image.open(path)
+    if getattr(im, 'is_animated', False) or not im.tile:
+        return None
+
+    box = _clamp_box(box, im.size)
+    (x1, y1, x2, y2) = box
+    if x2 <= x1 or y2 <= y1:
+        return None
+
+    if im.format == 'JPEG':
+        region = _decode_jpeg_region(im, box, scale)
+    elif len(im.tile) > 1:
+        region = _decode_tiles(im, box)
+    elif im.tile[0][0] == 'raw':
+        region = _decode_raw_rows(im, box)
+    elif im.format == 'PNG':
+        region = _decode_png_rows(im, box)
+    else:
+        region = None
+
+    if region is None:
+        return None
+    (region_im, region_box) = region
+    region_im.format = im.format
+    region_im.info = dict(im.info)
+    return (region_im, region_box)
+
+
+def _clamp_box(box, size):
+    (w, h) = size
+    (x1, y1, x2, y2) = [int(round(v)) for v in box]
+    return (max(0, x1), max(0, y1), min(w, x2), min(h, y2))
+
+
+def _get_tile_name(tile):
+    return tile[0]
+
+
+def _replace_tile(tile, extents, offset=None):
+    (name, _, tile_offset, args) = tile
+    if offset is None:
+        offset = tile_offset
+    if hasattr(tile, '_replace'):
+        return tile._replace(extents=extents, offset=offset)
+    return (name, extents, offset, args)
+
+
+def _set_size(im, size):
+    # Pillow 5.3+ keeps the size of images in a private attribute
+    if hasattr(im, '_size'):
+        im._size = size
+    else:
+        im.size = size
+
+
+def _decode_jpeg_region(im, box, scale):
+    if scale >= 1:
+        return None
+    (w, h) = im.size
+    im.draft(im.mode, (int(math.ceil(w * scale)), int(math.ceil(h * scale))))
+    (draft_w, draft_h) = im.size
+    if (draft_w, draft_h) == (w, h):
+        return None
+    (x1, y1, x2, y2) = box
+    (scale_x, scale_y) = (draft_w / w, draft_h / h)
+    region_box = _clamp_box(
+        (x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y), im.size)
+    im.load()
+    return (im, region_box)
+
+
+def _decode_tiles(im, box):
+    """Decode the tiles of `im` which intersect `box`."""
+    if any(_get_tile_name(t) not in TILE_DECODERS for t in im.tile):
+        return None
+    (x1, y1, x2, y2) = box
+    tiles = [t for t in im.tile
+        if t[1][0] < x2 and t[1][2] > x1 and t[1][1] < y2 and t[1][3] > y1]
+    if not tiles or len(tiles) == len(im.tile):
+        return None
+    left = min(t[1][0] for t in tiles)
+    top = min(t[1][1] for t in tiles)
+    right = max(t[1][2] for t in tiles)
+    bottom = max(t[1][3] for t in tiles)
+    im.tile = [
+        _replace_tile(t, (t[1][0] - left, t[1][1] - top, t[1][2] - left, t[1][3] - top))
+        for t in tiles]
+    _set_size(im, (right - left, bottom - top))
+    im.load()
+    return (im, (x1 - left, y1 - top, x2 - left, y2 - top))
+
+
+def _decode_raw_rows(im, box):
+    """Read the rows of `box` from an uncompressed image stored top-down."""
+    (name, extents, offset, args) = im.tile[0]
+    if not isinstance(args, tuple):
+        args = (args, 0, 1)
+    (rawmode, stride, orientation) = (tuple(args) + (0, 1))[:3]
+    (w, h) = im.size
+    if rawmode != im.mode or orientation != 1 or extents != (0, 0, w, h):
+        return None
+    if not stride:
+        stride = w * len(im.getbands()) * MODE_BAND_BYTES.get(im.mode, 1)
+        if im.mode == '1':
+            stride = (w + 7) // 8
+    (x1, y1, x2, y2) = box
+    if (y1, y2) == (0, h):
+        return None
+    im.tile = [_replace_tile(im.tile[0], (0, 0, w, y2 - y1), offset=offset + y1 * stride)]
+    _set_size(im, (w, y2 - y1))
+    im.load()
+    return (im, (x1, 0, x2, y2 - y1))
+
+
+def _decode_png_rows(im, box):
+    """Decode a non-interlaced PNG up to the last row of `box`."""
+    (w, h) = im.size
+    (x1, y1, x2, y2) = box
+    if im.info.get('interlace') or im.tile[0][1] != (0, 0, w, h) or y2 == h:
+        return None
+    im.tile = [_replace_tile(im.tile[0], (0, 0, w, y2))]
+    _set_size(im, (w, y2))
+    im.load()
+    return (im, box)
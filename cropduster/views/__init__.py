@@ -16,6 +16,30 @@ information in the database and instead stores information about the original
 image and crop dimensions in metadata on the generated image. The intended use
 case for standalone mode is a dialog in a WYSIWYG editor.
 
+derivative() / transform()
+==========================
+
+Serves the file of a thumb, rendering it from the thumb's crop geometry first
+if it does not exist yet (e.g. for a size added since the image was cropped).
+transform() serves the signed, arbitrary-width crops of cropduster.transforms.
+
+
+tiles_descriptor() / tile()
+===========================
+
+Serve the signed deep zoom (DZI) descriptor and tiles of an original (see
+cropduster.tiles), with which the dialog can zoom into originals larger than
+the preview. upload() returns the descriptor's URL as "dzi_url" for them.
+
+
+preview()
+=========
+
+Serves the `_preview` and `_tmp` files shown in the cropduster dialog, with
+validators (ETag, Last-Modified) and Range support, so that the dialog does
+not re-download unchanged images.
+
+
 upload() / crop()
 =================
 
@@ -23,6 +47,10 @@ Both upload() and crop() interact with the index page's html in the same way:
 they receive a POST with data from the django forms and formsets, create new
 image and thumb instances (respectively), and return a JSON object that map
 back onto fields on the index page's forms / formsets.
+
+upload() also returns the images in the library which are near-duplicates of
+the upload (see cropduster.duplicates), under "duplicates", so that they can
+be offered for reuse.
 """
 from __future__ import division
 
@@ -32,14 +60,13 @@ from six.moves import filter, map, zip
 
 import os
 import copy
-import shutil
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.forms.models import modelformset_factory
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.http import HttpResponse, Http404
+from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.utils.functional import cached_property
 from django.views.decorators.csrf import csrf_exempt
@@ -57,14 +84,26 @@ from cropduster.files import ImageFile
 from cropduster.models import Thumb, Size, StandaloneImage, Image
 from cropduster.settings import (
     CROPDUSTER_PREVIEW_WIDTH as PREVIEW_WIDTH,
-    CROPDUSTER_PREVIEW_HEIGHT as PREVIEW_HEIGHT)
+    CROPDUSTER_PREVIEW_HEIGHT as PREVIEW_HEIGHT,
+    CROPDUSTER_DUPLICATE_DETECTION)
 from cropduster.utils import (
     json, is_animated_gif, has_animated_gif_support, process_image)
-from cropduster.exceptions import json_error, CropDusterResizeException, full_exc_info
+from cropduster import storage as cropduster_storage
+from cropduster import transforms
+from cropduster import tiles
+from cropduster import admission
+from cropduster.duplicates import find_similar
+from cropduster.utils.dhash import get_dhash
+from cropduster.utils.normalize import needs_normalization, normalize_original
+from cropduster.exceptions import (
+    json_error, CropDusterResizeException, CropDusterAdmissionException, full_exc_info)
+from cropduster.utils.formats import normalize_format, is_format_supported, get_format_mimetype
 
 from .base import View
 from .forms import CropForm, ThumbForm, ThumbFormSet, UploadForm
-from .utils import get_admin_base_template, FakeQuerySet
+from .utils import (
+    get_admin_base_template, FakeQuerySet, materialize_derivative, serve_file, serve_path,
+    conditional_file_response)
 
 
 class CropDusterIndex(View):
@@ -206,6 +245,19 @@ class CropDusterIndex(View):
 index = CropDusterIndex.as_view()
 
 
+def get_duplicates_data(dhash, exclude=None):
+    """The JSON data of the images which are near-duplicates of an upload."""
+    return [{
+        'image_id': image.pk,
+        'orig_image': image.image.name,
+        'orig_w': image.width,
+        'orig_h': image.height,
+        'url': image.get_image_url('_preview'),
+        'preview_url': image.get_preview_url('_preview'),
+        'distance': distance,
+    } for (distance, image) in find_similar(dhash, exclude=exclude)]
+
+
 @csrf_exempt
 def upload(request):
     if request.method == 'GET':
@@ -231,6 +283,16 @@ def upload(request):
         orig_file_path = orig_file_path.encode('utf-8')
     orig_image = get_relative_media_url(orig_file_path)
     img = PIL.Image.open(orig_file_path)
+    if needs_normalization(img):
+        # Bake the EXIF orientation and colorspace into the original once,
+        # so that none of its renders have to
+        try:
+            with admission.admit(img):
+                normalize_original(orig_file_path)
+        except CropDusterAdmissionException as e:
+            return json_error(request, 'upload', action="uploading file",
+                errors=[force_unicode(e)])
+        img = PIL.Image.open(orig_file_path)
     (w, h) = (orig_w, orig_h) = img.size
 
     if is_animated_gif(img) and not has_animated_gif_support():
@@ -244,20 +306,33 @@ def upload(request):
 
     # First pass resize if it's too large
     resize_ratio = min(preview_w / w, preview_h / h)
+    if resize_ratio < 1:
+        preview_size = (int(round(w * resize_ratio)), int(round(h * resize_ratio)))
+    else:
+        preview_size = (w, h)
 
     def fit_preview(im):
-        (w, h) = im.size
-        if resize_ratio < 1:
-            w = int(round(w * resize_ratio))
-            h = int(round(h * resize_ratio))
-            preview_img = im.resize((w, h), PIL.Image.ANTIALIAS)
-        else:
-            preview_img = im
-        return preview_img
+        if im.size != preview_size:
+            return im.resize(preview_size, PIL.Image.ANTIALIAS)
+        return im
 
     if not is_standalone:
         preview_file_path = tmp_image.get_image_path('_preview')
-        process_image(img, preview_file_path, fit_preview)
+        scale = admission.get_draft_scale(img, resize_ratio)
+        try:
+            with admission.admit(img, scale=scale):
+                if resize_ratio < 1 and not is_animated_gif(img):
+                    # The preview is the only thing rendered from this request, so
+                    # let the decoder downscale while decoding (JPEG only)
+                    img.draft(img.mode, preview_size)
+                preview_img = process_image(img, preview_file_path, fit_preview,
+                    size_name='_preview', draft=True)
+        except CropDusterAdmissionException as e:
+            return json_error(request, 'upload', action="uploading file",
+                errors=[force_unicode(e)])
+        if CROPDUSTER_DUPLICATE_DETECTION:
+            # Hash the preview's pixels rather than decoding the upload again
+            data['duplicates'] = get_duplicates_data(get_dhash(preview_img))
 
     data.update({
         'crop': {
@@ -267,6 +342,8 @@ def upload(request):
             'image_id': None,
         },
         'url': tmp_image.get_image_url('_preview'),
+        'preview_url': tmp_image.get_preview_url('_preview'),
+        'dzi_url': tiles.get_descriptor_url(orig_image) if resize_ratio < 1 else None,
         'orig_image': orig_image,
         'orig_w': orig_w,
         'orig_h': orig_h,
@@ -276,8 +353,6 @@ def upload(request):
     if not is_standalone:
         return HttpResponse(json.dumps(data), content_type='application/json')
 
-    size = Size('crop', w=img.size[0], h=img.size[1])
-
     md5 = form_data.get('md5')
     try:
         standalone_image = StandaloneImage.objects.get(md5=md5)
@@ -294,13 +369,32 @@ def upload(request):
     elif cropduster_image.image.name != orig_image:
         data['crop']['orig_image'] = data['orig_image'] = cropduster_image.image.name
         data['url'] = cropduster_image.get_image_url('_preview')
+        data['preview_url'] = cropduster_image.get_preview_url('_preview')
+        img = PIL.Image.open(cropduster_image.image.path)
+        (orig_w, orig_h) = img.size
+        if data['dzi_url']:
+            data['dzi_url'] = tiles.get_descriptor_url(cropduster_image.image.name)
 
-    img = PIL.Image.open(cropduster_image.image.path)
-    preview_file_path = cropduster_image.get_image_path('_preview')
-    if not os.path.exists(preview_file_path):
-        process_image(img, preview_file_path, fit_preview)
+    size = Size('crop', w=orig_w, h=orig_h)
 
-    thumb = cropduster_image.save_size(size, standalone=True)
+    # The standalone crop needs the full resolution image, so decode it once
+    # and render both the preview and the crop from it
+    try:
+        with admission.admit(img):
+            if not is_animated_gif(img):
+                img.load()
+            if CROPDUSTER_DUPLICATE_DETECTION:
+                data['duplicates'] = get_duplicates_data(get_dhash(img),
+                    exclude=cropduster_image.pk)
+            preview_file_path = cropduster_image.get_image_path('_preview')
+            if not os.path.exists(preview_file_path):
+                process_image(img, preview_file_path, fit_preview, size_name='_preview',
+                    draft=True)
+
+            thumb = cropduster_image.save_size(size, image=img, standalone=True)
+    except CropDusterAdmissionException as e:
+        return json_error(request, 'upload', action="uploading file",
+            errors=[force_unicode(e)])
 
     sizes = form_data.get('sizes') or []
     if len(sizes) == 1:
@@ -343,7 +437,9 @@ def crop(request):
     crop_data = copy.deepcopy(crop_form.cleaned_data)
     db_image = Image(image=crop_data['orig_image'])
     try:
-        pil_image = PIL.Image.open(db_image.image.path)
+        # Editors crop the same image many times in a row, so keep it decoded
+        pil_image = cropduster_storage.open_image(db_image.image.name, db_image.image.storage,
+            decoded=True)
     except IOError:
         pil_image = None
 
@@ -366,24 +462,37 @@ def crop(request):
 
     standalone_mode = crop_data['standalone']
 
+    # Collect every thumb whose crop changed, so that all of their sizes can
+    # be rendered from a single decode of the original image
+    crop_fields = set(['crop_x', 'crop_y', 'crop_w', 'crop_h'])
+    changed_indexes = []
     for i, (thumb, thumb_form) in enumerate(zip(cropped_thumbs, thumb_formset)):
         changed_fields = set(thumb_form.changed_data) - non_model_fields
         thumb_form._changed_data = list(changed_fields)
-        thumb_data = thumbs_data[i]
-        size = thumb_data['size']
-
-        if changed_fields & set(['crop_x', 'crop_y', 'crop_w', 'crop_h']):
+        if changed_fields & crop_fields:
             # Clear existing primary key to force new thumb creation
             thumb.pk = None
 
             thumb.width = min(filter(None, [thumb.width, thumb.crop_w]))
             thumb.height = min(filter(None, [thumb.height, thumb.crop_h]))
+            changed_indexes.append(i)
 
-            try:
-                new_thumbs = db_image.save_size(size, thumb, tmp=True, standalone=standalone_mode)
-            except CropDusterResizeException as e:
-                return json_error(request, 'crop',
-                                  action="saving size", errors=[force_unicode(e)])
+    rendered_thumbs = {}
+    if changed_indexes:
+        try:
+            results = db_image.save_sizes(
+                [(thumbs_data[i]['size'], cropped_thumbs[i]) for i in changed_indexes],
+                image=pil_image, tmp=True, standalone=standalone_mode)
+        except (CropDusterResizeException, CropDusterAdmissionException) as e:
+            return json_error(request, 'crop',
+                              action="saving size", errors=[force_unicode(e)])
+        rendered_thumbs = dict(zip(changed_indexes, results))
+        if pil_image is not None:
+            cropduster_storage.cache_decoded_image(pil_image)
+
+    for i, (thumb, thumb_form) in enumerate(zip(cropped_thumbs, thumb_formset)):
+        if i in rendered_thumbs:
+            new_thumbs = rendered_thumbs[i]
 
             if not new_thumbs:
                 continue
@@ -410,11 +519,13 @@ def crop(request):
                     continue
                 thumbs_data[i]['thumbs'].update({name: thumb_data})
         elif thumb.pk and thumb.name and thumb.crop_w and thumb.crop_h:
-            thumb_path = db_image.get_image_path(thumb.name, tmp=False)
-            tmp_thumb_path = db_image.get_image_path(thumb.name, tmp=True)
-            if os.path.exists(thumb_path):
-                if not thumb_form.cleaned_data.get('changed') or not os.path.exists(tmp_thumb_path):
-                    shutil.copy(thumb_path, tmp_thumb_path)
+            storage = db_image.image.storage
+            thumb_name = db_image.get_image_name(thumb.name, tmp=False)
+            tmp_thumb_name = db_image.get_image_name(thumb.name, tmp=True)
+            if cropduster_storage.exists(thumb_name, storage):
+                if (not thumb_form.cleaned_data.get('changed')
+                        or not cropduster_storage.exists(tmp_thumb_name, storage)):
+                    cropduster_storage.copy(thumb_name, tmp_thumb_name, storage)
 
         if not thumb.pk and not thumb.crop_w and not thumb.crop_h:
             if not len(thumbs_with_crops):
@@ -440,3 +551,110 @@ def crop(request):
         'thumbs': thumbs_data,
         'initial': True,
     }), content_type='application/json')
+
+
+def derivative(request, image_id, size_name, extension, content_hash=None):
+    db_image = get_object_or_404(Image, pk=image_id)
+    if not db_image.image:
+        raise Http404
+
+    storage = db_image.image.storage
+    source_format = normalize_format(db_image.extension)
+    format = normalize_format(extension)
+    if format == source_format:
+        format = None
+    elif not is_format_supported(format):
+        raise Http404
+
+    if size_name == 'original':
+        if format or content_hash:
+            raise Http404
+        name = db_image.image.name
+    else:
+        try:
+            thumb = db_image.thumbs.get(name=size_name)
+        except Thumb.DoesNotExist:
+            raise Http404
+        name = db_image.get_image_name(size_name, format=format)
+        try:
+            materialize_derivative(thumb, name, format=format)
+        except CropDusterResizeException:
+            raise Http404
+        if content_hash:
+            if content_hash != thumb.content_hash:
+                # Superseded, or never existed
+                raise Http404
+            name = db_image.get_image_name(size_name, format=format, content_hash=content_hash)
+
+    if not cropduster_storage.exists(name, storage):
+        raise Http404
+    response = serve_file(name, storage, get_format_mimetype(format or source_format))
+    if content_hash:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def transform(request, signature, image_id, crop_name, width, extension):
+    if not transforms.check_signature(signature, image_id, crop_name, width, extension):
+        raise Http404
+    width = int(width)
+    if width != transforms.quantize_width(width):
+        raise Http404
+
+    format = normalize_format(extension)
+    if not is_format_supported(format):
+        raise Http404
+
+    db_image = get_object_or_404(Image, pk=image_id)
+    try:
+        thumb = db_image.thumbs.get(name=crop_name)
+    except Thumb.DoesNotExist:
+        raise Http404
+
+    try:
+        path = transforms.get_transform_file(thumb, width, format=format)
+    except CropDusterResizeException:
+        raise Http404
+    except CropDusterAdmissionException as e:
+        return HttpResponse(force_unicode(e), status=503, content_type='text/plain')
+    if not path:
+        raise Http404
+    return serve_path(path, get_format_mimetype(format))
+
+
+def _get_tiles_original(signature, name):
+    if not tiles.check_signature(signature, name):
+        raise Http404
+    if name.startswith('/') or '..' in name.split('/'):
+        raise Http404
+    storage = cropduster_storage.get_storage()
+    if not cropduster_storage.exists(name, storage):
+        raise Http404
+    return storage
+
+
+def tiles_descriptor(request, signature, name):
+    storage = _get_tiles_original(signature, name)
+    return HttpResponse(tiles.get_descriptor(name, storage), content_type='application/xml')
+
+
+def tile(request, signature, name, level, col, row, extension):
+    storage = _get_tiles_original(signature, name)
+    try:
+        path = tiles.get_tile_file(name, int(level), int(col), int(row), extension,
+            storage=storage)
+    except CropDusterAdmissionException as e:
+        return HttpResponse(force_unicode(e), status=503, content_type='text/plain')
+    if not path:
+        raise Http404
+    return serve_path(path, get_format_mimetype(extension))
+
+
+def preview(request, name):
+    if not Image.is_preview_name(name):
+        raise Http404
+    storage = cropduster_storage.get_storage()
+    if not cropduster_storage.exists(name, storage):
+        raise Http404
+    extension = os.path.splitext(name)[1]
+    return conditional_file_response(request, name, storage, get_format_mimetype(extension))
@@ -4,9 +4,17 @@ import six
 
 import os
 import hashlib
+import uuid
 
 import PIL.Image
 
+try:
+    from PIL.Image import DecompressionBombError
+except ImportError:
+    # Pillow < 5.0 only warns about decompression bombs
+    class DecompressionBombError(Exception):
+        pass
+
 from django import forms
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
@@ -22,8 +30,10 @@ except ImportError:
     from django.utils.encoding import force_text as force_unicode
 
 from cropduster.models import Thumb
+from cropduster import settings as cropduster_settings
 from cropduster.utils import (json, get_upload_foldername, get_min_size,
     get_image_extension)
+from cropduster.utils.normalize import get_normalized_size
 
 
 class ErrorDict(_ErrorDict):
@@ -44,6 +54,7 @@ def clean_upload_data(data):
     image = data['image']
     image.seek(0)
     try:
+        # Only reads the image header; the pixel data is never decoded here
         pil_image = PIL.Image.open(image)
     except IOError as e:
         if e.errno:
@@ -51,14 +62,38 @@ def clean_upload_data(data):
         else:
             error_msg = u"Invalid or unsupported image file"
         raise forms.ValidationError({"image": [error_msg]})
+    except DecompressionBombError:
+        raise forms.ValidationError({"image": [u"Image is too large"]})
     else:
         extension = get_image_extension(pil_image)
 
-    upload_to = data['upload_to'] or None
-    folder_path = get_upload_foldername(image.name, upload_to=upload_to)
+    check_upload_size(pil_image, data.get('sizes'))
+
+    # File is good, stream it to disk, hashing it along the way, and then
+    # move it into a newly allocated upload folder
+    (tmp_file_path, data['md5']) = write_upload(image, settings.MEDIA_ROOT)
+    try:
+        upload_to = data['upload_to'] or None
+        folder_path = get_upload_foldername(image.name, upload_to=upload_to,
+            content_hash=data['md5'])
+        orig_file_path = os.path.join(folder_path, 'original' + extension)
+        os.rename(tmp_file_path, os.path.join(settings.MEDIA_ROOT, orig_file_path))
+    except:
+        os.unlink(tmp_file_path)
+        raise
+    data['image'] = open(os.path.join(settings.MEDIA_ROOT, orig_file_path), mode='rb')
+    return data
+
 
-    (w, h) = (orig_w, orig_h) = pil_image.size
-    sizes = data.get('sizes')
+def check_upload_size(pil_image, sizes=None):
+    """
+    Reject an image, given only its parsed header, if it is smaller than the
+    minimum dimensions of `sizes` or larger than CROPDUSTER_MAX_PIXELS /
+    CROPDUSTER_MAX_FRAMES.
+    """
+    # The size of the original once uploaded, rotated by its EXIF orientation
+    # if CROPDUSTER_NORMALIZE_ORIENTATION is set
+    (w, h) = (orig_w, orig_h) = get_normalized_size(pil_image)
     if sizes:
         (min_w, min_h) = get_min_size(sizes)
 
@@ -78,17 +113,50 @@ def clean_upload_data(data):
     elif h <= 0:
         raise forms.ValidationError({"image": [u"Invalid image: height is %d" % h]})
 
-    # File is good, get rid of the tmp file
-    orig_file_path = os.path.join(folder_path, 'original' + extension)
-    image.seek(0)
-    image_contents = image.read()
-    with open(os.path.join(settings.MEDIA_ROOT, orig_file_path), 'wb+') as f:
-        f.write(image_contents)
+    max_pixels = cropduster_settings.CROPDUSTER_MAX_PIXELS
+    if max_pixels and w * h > max_pixels:
+        raise forms.ValidationError({"image": [(
+            u"Image must be at most %(max_mp).1f megapixels. "
+            u"The image you uploaded was %(orig_w)sx%(orig_h)s pixels.") % {
+                "max_mp": max_pixels / 1000000,
+                "orig_w": orig_w,
+                "orig_h": orig_h,
+            }]})
+
+    max_frames = cropduster_settings.CROPDUSTER_MAX_FRAMES
+    if max_frames and getattr(pil_image, 'is_animated', False):
+        try:
+            n_frames = pil_image.n_frames
+        except (IOError, EOFError, ValueError):
+            raise forms.ValidationError({"image": [u"Invalid or unsupported image file"]})
+        if n_frames > max_frames:
+            raise forms.ValidationError({"image": [
+                u"Animated images may have at most %d frames; the image you "
+                u"uploaded has %d." % (max_frames, n_frames)]})
+        pil_image.seek(0)
+
+
+def write_upload(upload, dir_name):
+    """
+    Copy an uploaded file to a temporary file in `dir_name` in chunks, so
+    that large uploads are never held in memory. Returns a tuple of the path
+    of the temporary file and the md5 hexdigest of its contents.
+    """
     md5_hash = hashlib.md5()
-    md5_hash.update(image_contents)
-    data['md5'] = md5_hash.hexdigest()
-    data['image'] = open(os.path.join(settings.MEDIA_ROOT, orig_file_path), mode='rb')
-    return data
+    tmp_path = os.path.join(dir_name, '.upload-%s' % uuid.uuid4().hex)
+    upload.seek(0)
+    chunks = upload.chunks() if hasattr(upload, 'chunks') else iter(
+        lambda: upload.read(64 * 1024), b'')
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                md5_hash.update(chunk)
+                f.write(chunk)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return (tmp_path, md5_hash.hexdigest())
 
 
 class FormattedErrorMixin(object):
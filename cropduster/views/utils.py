@@ -1,4 +1,28 @@
+import os
+import re
+import hashlib
+import calendar
+from wsgiref.util import FileWrapper
+
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.utils.http import urlquote, http_date, parse_http_date_safe
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5
+    StreamingHttpResponse = HttpResponse
+
+try:
+    from django.utils.encoding import force_bytes
+except ImportError:
+    from django.utils.encoding import smart_str as force_bytes
+
+from cropduster import storage as cropduster_storage
+from cropduster.settings import (
+    CROPDUSTER_LOCK_DIR, CROPDUSTER_SENDFILE_HEADER, CROPDUSTER_SENDFILE_PREFIX)
+from cropduster.utils import file_lock
 
 
 def get_admin_base_template():
@@ -37,3 +61,181 @@ class FakeQuerySet(object):
 
     def __getitem__(self, index):
         return self.objs[index]
+
+
+def materialize_derivative(thumb, name, format=None):
+    """
+    Render the file `name` for `thumb` if it does not exist. Concurrent
+    calls for the same file, in any process, wait on a lock for the first
+    one to render it rather than rendering it again.
+    """
+    storage = thumb.image.image.storage
+    if cropduster_storage.exists(name, storage):
+        return
+    lock_path = os.path.join(CROPDUSTER_LOCK_DIR, hashlib.sha1(force_bytes(name)).hexdigest())
+    with file_lock(lock_path):
+        # Another request may have rendered it while we waited for the lock
+        if not cropduster_storage.exists(name, storage):
+            thumb.render(formats=[format] if format else None)
+
+
+def serve_file(name, storage, content_type):
+    """
+    Respond with a file from `storage`: by redirecting to it for remote
+    storages, through the web server if CROPDUSTER_SENDFILE_HEADER is set,
+    and otherwise by streaming it.
+    """
+    if not cropduster_storage.is_local(storage):
+        return HttpResponseRedirect(storage.url(name))
+    return serve_path(storage.path(name), content_type,
+        accel_url=CROPDUSTER_SENDFILE_PREFIX + urlquote(name))
+
+
+def serve_path(path, content_type, accel_url=None):
+    """
+    Respond with a local file, through the web server if
+    CROPDUSTER_SENDFILE_HEADER is set (for X-Accel-Redirect, only if the
+    file has an `accel_url`), and otherwise by streaming it.
+    """
+    if CROPDUSTER_SENDFILE_HEADER == 'X-Accel-Redirect' and accel_url:
+        response = HttpResponse(content_type=content_type)
+        response[CROPDUSTER_SENDFILE_HEADER] = accel_url
+    elif CROPDUSTER_SENDFILE_HEADER and CROPDUSTER_SENDFILE_HEADER != 'X-Accel-Redirect':
+        response = HttpResponse(content_type=content_type)
+        response[CROPDUSTER_SENDFILE_HEADER] = path
+    else:
+        response = StreamingHttpResponse(FileWrapper(open(path, 'rb')), content_type=content_type)
+        response['Content-Length'] = os.path.getsize(path)
+    return response
+
+
+def get_file_validators(name, storage):
+    """
+    Return a strong ETag and the last-modified timestamp of a file, from its
+    metadata alone. Derivatives are always replaced, never modified in place
+    (see cropduster.utils.save_image), so their size and modification time
+    fingerprint each render.
+    """
+    if cropduster_storage.is_local(storage):
+        stat = os.stat(storage.path(name))
+        size, mtime = stat.st_size, stat.st_mtime
+    else:
+        size = storage.size(name)
+        modified = cropduster_storage.get_modified_time(name, storage)
+        mtime = calendar.timegm(modified.utctimetuple())
+    fingerprint = '%s:%d:%r' % (name, size, mtime)
+    etag = '"%s"' % hashlib.md5(force_bytes(fingerprint)).hexdigest()[:20]
+    return etag, int(mtime), size
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range from a Range header. Returns (start, end)
+    (inclusive) or None if the header is absent, malformed, or asks for
+    several ranges, in which case the whole file should be served. Raises
+    ValueError if the range cannot be satisfied.
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        # A suffix range: the last `end` bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return (start, end)
+
+
+def parse_etags(header):
+    """
+    The entity tags of an If-None-Match header, with any weak (W/) prefix
+    removed, since If-None-Match uses the weak comparison.
+    """
+    etags = []
+    for etag in (header or '').split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            etags.append(etag)
+    return etags
+
+
+class RangeFileWrapper(object):
+    """
+    Iterate over the `length` bytes of the file object `f` from its current
+    position, `blksize` bytes at a time. Closing the wrapper closes the file.
+    """
+
+    def __init__(self, f, length, blksize=8192):
+        self.f = f
+        self.length = length
+        self.blksize = blksize
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            data = self.f.read(min(self.blksize, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+def conditional_file_response(request, name, storage, content_type):
+    """
+    Respond with a file, honouring If-None-Match / If-Modified-Since (with a
+    304 that never opens the file) and single byte Range requests. The file
+    is streamed rather than read into memory.
+    """
+    etag, mtime, size = get_file_validators(name, storage)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        not_modified = etag in etags or '*' in etags
+    else:
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        not_modified = if_modified_since is not None and mtime <= if_modified_since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        if byte_range and request.META.get('HTTP_IF_RANGE', etag) != etag:
+            byte_range = None
+
+        f = storage.open(name, 'rb')
+        try:
+            if byte_range:
+                (start, end) = byte_range
+                f.seek(start)
+                response = StreamingHttpResponse(RangeFileWrapper(f, end - start + 1),
+                    content_type=content_type, status=206)
+                response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+                response['Content-Length'] = end - start + 1
+            else:
+                response = StreamingHttpResponse(FileWrapper(f), content_type=content_type)
+                response['Content-Length'] = size
+        except:
+            f.close()
+            raise
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+    # Always revalidate; the files change as the user edits the crop
+    response['Cache-Control'] = 'private, no-cache'
+    return response